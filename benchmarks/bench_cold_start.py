@@ -0,0 +1,103 @@
+"""Benchmark the cold start of each Lambda handler module.
+
+Imports each module in a fresh interpreter, as the Lambda init phase does,
+and reports the init duration, the time the first invocation then spends
+creating the client it needs first and the memory added by the init. Each
+module is measured with PREWARM_CLIENTS set to true and to false. No API
+calls are made.
+
+    python benchmarks/bench_cold_start.py
+    python benchmarks/bench_cold_start.py --runs 50
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# The client each handler creates first, called after the import
+FIRST_CLIENTS = {
+    'normalization': "module.get_client('sns')",
+    'plumbing': "module.get_client(module.get_region_session('us-east-1'), "
+                "'lambda')",
+    'invitation_manager': "module.get_client(None, 'sts')",
+}
+
+MEASURE = """
+import importlib
+import json
+import resource
+import sys
+import time
+
+sys.path.insert(0, {root!r})
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+module = importlib.import_module('lambda_functions.{name}')
+init = time.perf_counter() - start
+start = time.perf_counter()
+{first_client}
+first_client = time.perf_counter() - start
+print(json.dumps({{
+    'init': init, 'first_client': first_client,
+    'rss': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024}}))
+"""
+
+ENVIRONMENT = {
+    'AWS_LAMBDA_FUNCTION_NAME': 'bench-cold-start',
+    'AWS_REGION': 'us-west-2',
+    'AWS_DEFAULT_REGION': 'us-west-2',
+    'AWS_ACCESS_KEY_ID': 'FAKE',
+    'AWS_SECRET_ACCESS_KEY': 'FAKE',
+    'SNS_OUTPUT_TOPIC_ARN': 'arn:aws:sns:us-west-2:111111111111:output',
+    'METRICS_NAMESPACE': '',
+}
+
+
+def measure(name, prewarm):
+    """Import a module in a new interpreter and return its measurements."""
+    env = dict(os.environ, **ENVIRONMENT)
+    env['PREWARM_CLIENTS'] = 'true' if prewarm else 'false'
+    output = subprocess.run(
+        [sys.executable, '-c', MEASURE.format(
+            root=ROOT, name=name, first_client=FIRST_CLIENTS[name])],
+        env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Fresh interpreters per module and mode')
+    args = parser.parse_args()
+
+    print('{:<20} {:<8} {:>10} {:>10} {:>12} {:>10} {:>10}'.format(
+        'module', 'prewarm', 'init p50', 'init p99', 'first call', 'total p99',
+        'rss (MiB)'))
+    for name in FIRST_CLIENTS:
+        for prewarm in (False, True):
+            runs = [measure(name, prewarm) for _ in range(args.runs)]
+            totals = [x['init'] + x['first_client'] for x in runs]
+            print('{:<20} {:<8} {:>10.1f} {:>10.1f} {:>12.1f} {:>10.1f} '
+                  '{:>10.1f}'.format(
+                      name, str(prewarm).lower(),
+                      statistics.median(x['init'] for x in runs) * 1000,
+                      percentile([x['init'] for x in runs], 0.99) * 1000,
+                      statistics.median(
+                          x['first_client'] for x in runs) * 1000,
+                      percentile(totals, 0.99) * 1000,
+                      statistics.median(x['rss'] for x in runs)))
+    print('\ntimes in ms, first call is the time the first invocation spends '
+          'creating its first client')
+
+
+if __name__ == '__main__':
+    main()
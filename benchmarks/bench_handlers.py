@@ -0,0 +1,269 @@
+"""Benchmark the Lambda handlers against a local AWS stand-in.
+
+Runs the real invitation_manager.handle, plumbing.handle,
+normalization.handle and normalization.backfill against FakeAWS
+organizations, and numbers of findings, of increasing size spread over every
+GuardDuty region, and reports wall time, peak memory and
+API call counts by operation. The handlers create real boto3 sessions and
+botocore clients, so the figures include their construction.
+invitation_manager is run over long running organizations and, for the
+onboarding sizes, over organizations none of whose accounts are members yet.
+FakeAWS can add a fixed latency to each call, throttle a fraction of calls
+and treat some regions as opt-in regions which aren't enabled.
+
+    python benchmarks/bench_handlers.py
+    python benchmarks/bench_handlers.py --sizes 100 1000 --latency 0.02 \\
+        --throttle-rate 0.01 --regions 4 --disabled-regions 1 \\
+        --onboarding-sizes 100
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+import botocore.session
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lambda_functions import invitation_manager  # noqa: E402
+from lambda_functions import normalization  # noqa: E402
+from lambda_functions import plumbing  # noqa: E402
+from fake_aws import FakeAWS  # noqa: E402
+
+SAMPLES_PATH = os.path.join(
+    os.path.dirname(__file__), 'samples', 'guardduty_findings.json')
+# Most members of a long running organization are ENABLED, with a few new
+# accounts and some stuck at each stage of the invitation lifecycle
+STATUS_WEIGHTS = {
+    'Enabled': 90,
+    None: 4,
+    'Created': 2,
+    'Invited': 2,
+    'Disabled': 1,
+    'EmailVerificationFailed': 1,
+}
+SQS_BATCH_SIZE = 10
+# Regions which have to be enabled in an account before they can be used
+OPT_IN_REGIONS = [
+    'af-south-1', 'ap-east-1', 'ap-south-2', 'ap-southeast-3',
+    'ap-southeast-4', 'ca-west-1', 'eu-central-2', 'eu-south-1',
+    'eu-south-2', 'il-central-1', 'me-central-1', 'me-south-1']
+# Seconds each call to a region which isn't enabled takes to fail
+DISABLED_REGION_DELAY = 0.5
+
+
+def run_scenario(name, size, aws, function, measure_memory):
+    """Run function once and return a dict of measurements."""
+    aws.reset_counters()
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    error = None
+    try:
+        function()
+    except Exception as e:
+        error = repr(e)
+    wall = time.perf_counter() - start
+    peak = None
+    if measure_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {
+        'scenario': name,
+        'accounts': size,
+        'wall': wall,
+        'peak': peak,
+        'calls': dict(aws.calls),
+        'throttled': sum(aws.throttled.values()),
+        'error': error,
+    }
+
+
+def disable_regions(aws, regions, args):
+    """Treat the first --disabled-regions opt-in regions as regions which
+    the accounts haven't enabled."""
+    aws.regions = list(regions)
+    aws.disabled_regions = set(
+        [x for x in OPT_IN_REGIONS if x in regions][:args.disabled_regions])
+    aws.disabled_region_delay = DISABLED_REGION_DELAY
+
+
+def invitation_manager_scenario(size, regions, args, onboarding=False):
+    """Run invitation_manager.handle over an organization of size accounts.
+
+    When onboarding, no account is a member yet or has a detector. Members
+    are created by a first run and invited by the second, and the third
+    creates each member's detector and accepts its invitation in every
+    region, so all three runs are measured.
+    """
+    aws = FakeAWS(latency=args.latency, throttle_rate=args.throttle_rate)
+    aws.populate_organization(
+        size, regions, {None: 1} if onboarding else STATUS_WEIGHTS)
+    disable_regions(aws, regions, args)
+    aws.install(invitation_manager)
+
+    def run():
+        for _ in range(3 if onboarding else 1):
+            invitation_manager.handle({}, None)
+    return run_scenario(
+        'invitation_manager' + (' (onboarding)' if onboarding else ''), size,
+        aws, run, args.memory)
+
+
+def plumbing_scenarios(regions, args):
+    aws = FakeAWS(latency=args.latency, throttle_rate=args.throttle_rate)
+    disable_regions(aws, regions, args)
+    aws.install(plumbing)
+    results = [
+        run_scenario('plumbing (first run)', 0, aws, plumbing.handle,
+                     args.memory),
+        run_scenario('plumbing (no drift)', 0, aws, plumbing.handle,
+                     args.memory),
+    ]
+    # Switch the same regions to the fan-in topology
+    plumbing.PLUMBING_TOPOLOGY = 'fan-in'
+    plumbing.FAN_IN_QUEUE_ARN = 'arn:aws:sqs:{}:111111111111:fan-in'.format(
+        regions[0])
+    plumbing.FAN_IN_ROLE_ARN = 'arn:aws:iam::111111111111:role/fan-in'
+    try:
+        results.extend([
+            run_scenario('plumbing (fan-in switch)', 0, aws, plumbing.handle,
+                         args.memory),
+            run_scenario('plumbing (fan-in)', 0, aws,
+                         plumbing.handle, args.memory),
+        ])
+    finally:
+        plumbing.PLUMBING_TOPOLOGY = 'sns'
+    return results
+
+
+def normalization_scenario(size, args, archive_backend=''):
+    """Send size findings through normalization.handle in SQS batches,
+    archiving them to the archive_backend when it's set."""
+    aws = FakeAWS(latency=args.latency, throttle_rate=args.throttle_rate)
+    aws.install(normalization)
+    normalization.SNS_OUTPUT_TOPIC_ARN = (
+        'arn:aws:sns:us-west-2:111111111111:output')
+    normalization.ARCHIVE_BACKEND = archive_backend
+    normalization.ARCHIVE_BUCKET = 'archive'
+    with open(SAMPLES_PATH) as f:
+        messages = [json.dumps(x) for x in json.load(f)]
+    records = [
+        {'eventSource': 'aws:sqs', 'messageId': str(i),
+         'body': json.dumps({
+             'Type': 'Notification',
+             'Timestamp': '2021-07-19T16:45:{:02d}.{:03d}Z'.format(
+                 (i // 1000) % 60, i % 1000),
+             'Message': messages[i % len(messages)]})}
+        for i in range(size)]
+    batches = [records[i:i + SQS_BATCH_SIZE]
+               for i in range(0, len(records), SQS_BATCH_SIZE)]
+
+    def run():
+        for batch in batches:
+            normalization.handle({'Records': batch}, None)
+        if normalization.ARCHIVE is not None:
+            normalization.ARCHIVE.flush(force=True)
+    return run_scenario(
+        'normalization' + (' ({})'.format(archive_backend)
+                           if archive_backend else ''),
+        size, aws, run, args.memory)
+
+
+def backfill_scenario(size, regions, args):
+    """Backfill size findings spread over the regions to the output topic."""
+    aws = FakeAWS(latency=args.latency, throttle_rate=args.throttle_rate)
+    aws.populate_organization(0, regions)
+    with open(SAMPLES_PATH) as f:
+        aws.populate_findings(
+            json.load(f), max(1, size // len(regions)), regions)
+    disable_regions(aws, regions, args)
+    aws.install(normalization)
+    normalization.SNS_OUTPUT_TOPIC_ARN = (
+        'arn:aws:sns:us-west-2:111111111111:output')
+    return run_scenario(
+        'normalization backfill', size, aws,
+        lambda: normalization.backfill({'regions': regions}), args.memory)
+
+
+def report(results, show_calls):
+    print('{:<32} {:>8} {:>10} {:>10} {:>10} {:>10}  {}'.format(
+        'scenario', 'accounts', 'wall (s)', 'peak (MiB)', 'api calls',
+        'throttled', 'error'))
+    for result in results:
+        print('{:<32} {:>8} {:>10.3f} {:>10} {:>10} {:>10}  {}'.format(
+            result['scenario'], result['accounts'], result['wall'],
+            '{:.1f}'.format(result['peak'] / 2 ** 20)
+            if result['peak'] is not None else '-',
+            sum(result['calls'].values()), result['throttled'],
+            result['error'] or ''))
+    if show_calls:
+        for result in results:
+            print('\n{} ({} accounts)'.format(
+                result['scenario'], result['accounts']))
+            for (service, operation), count in sorted(
+                    result['calls'].items(), key=lambda x: -x[1]):
+                print('  {:<14} {:<32} {:>8}'.format(
+                    service, operation, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000, 5000],
+                        help='Organization sizes in accounts')
+    parser.add_argument('--onboarding-sizes', type=int, nargs='*',
+                        default=[10, 100],
+                        help='Organization sizes in accounts to onboard, '
+                             'which assumes a role in every member account '
+                             'of every region')
+    parser.add_argument('--regions', type=int, default=None,
+                        help='Limit the number of GuardDuty regions')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every API call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='Fraction of API calls which are throttled')
+    parser.add_argument('--disabled-regions', type=int, default=0,
+                        help='Number of the regions which are opt-in regions '
+                             "the accounts haven't enabled")
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help="Don't trace peak memory, which is slow")
+    parser.add_argument('--calls', action='store_true',
+                        help='Show API call counts by operation')
+    parser.add_argument('--verbose', action='store_true',
+                        help="Show the handlers' log output")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(
+        logging.INFO if args.verbose else logging.CRITICAL)
+    if not args.verbose:
+        # Keep the metrics documents each handler prints out of the report
+        for module in (invitation_manager, normalization, plumbing):
+            module.METRICS.namespace = ''
+    regions = botocore.session.get_session().get_available_regions(
+        'guardduty')[:args.regions]
+
+    results = []
+    for size in args.sizes:
+        results.append(invitation_manager_scenario(size, regions, args))
+    for size in args.onboarding_sizes:
+        results.append(invitation_manager_scenario(
+            size, regions, args, onboarding=True))
+    results.extend(plumbing_scenarios(regions, args))
+    for size in args.sizes:
+        results.append(normalization_scenario(size, args))
+    for size in args.sizes:
+        results.append(normalization_scenario(size, args, 's3'))
+    for size in args.sizes:
+        results.append(backfill_scenario(size, regions, args))
+    print('{} regions ({} not enabled), {}s latency per call, {} throttle '
+          'rate\n'.format(len(regions), args.disabled_regions, args.latency,
+                         args.throttle_rate))
+    report(results, args.calls)
+
+
+if __name__ == '__main__':
+    main()
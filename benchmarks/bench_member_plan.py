@@ -0,0 +1,94 @@
+"""Benchmark planning a region's member actions for synthetic organizations.
+
+Compares MemberPlan with the per-account status filtering which it replaced
+and shows that MemberPlan's cost per account stays flat as the organization
+grows.
+
+    python benchmarks/bench_member_plan.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lambda_functions.invitation_manager import MemberPlan  # noqa: E402
+
+STATUSES = ['Created', 'Invited', 'Disabled', 'Enabled', 'Removed',
+            'Resigned', 'EmailVerificationInProgress',
+            'EmailVerificationFailed']
+SIZES = [100, 500, 1000, 2000, 5000]
+
+
+def synthetic_org(size, seed=0):
+    """Return an account to email map and a member status map where most
+    members are Enabled and some are missing or in another status."""
+    rng = random.Random(seed)
+    account_ids = ['{:012d}'.format(100000000000 + i) for i in range(size)]
+    accounts = {x: '{}@example.com'.format(x) for x in account_ids}
+    members = {}
+    for account_id in account_ids:
+        roll = rng.random()
+        if roll < 0.05:
+            continue
+        members[account_id] = (
+            'Enabled' if roll < 0.8 else rng.choice(STATUSES))
+    return accounts, members
+
+
+def legacy_plan(members, account_ids, accounts):
+    """The status filtering done before MemberPlan, one scan of every member
+    per status lookup and up to three lookups per account."""
+    def get_members(*args):
+        return [k for k, v in members.items()
+                if v.lower() in [x.lower() for x in args]]
+
+    create = [{'AccountId': x, 'Email': accounts[x]} for x in account_ids
+              if x not in members or x in get_members('REMOVED')]
+    delete = get_members('EMAILVERIFICATIONFAILED')
+    invite = get_members('CREATED', 'RESIGNED')
+    member_actions = {}
+    for account_id in account_ids:
+        if account_id in get_members('DISABLED'):
+            member_actions.setdefault(account_id, []).append('re_enable')
+        if account_id in get_members(
+                'RESIGNED', 'REMOVED', 'INVITED',
+                'EMAILVERIFICATIONINPROGRESS'):
+            if account_id in get_members(
+                    'RESIGNED', 'INVITED', 'EMAILVERIFICATIONINPROGRESS'):
+                member_actions.setdefault(account_id, []).append('accept')
+    return create, delete, invite, member_actions
+
+
+def new_plan(members, account_ids, accounts):
+    plan = MemberPlan(members, account_ids, accounts)
+    return plan.create, plan.delete, plan.invite, plan.member_actions()
+
+
+def best_of(function, args, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    print('{:>8} {:>14} {:>14} {:>16} {:>16}'.format(
+        'accounts', 'legacy (ms)', 'planner (ms)', 'legacy us/acct',
+        'planner us/acct'))
+    for size in SIZES:
+        accounts, members = synthetic_org(size)
+        args = (members, list(accounts), accounts)
+        legacy = (best_of(legacy_plan, args, 1)
+                  if size <= 2000 else float('nan'))
+        planner = best_of(new_plan, args, 5)
+        print('{:>8} {:>14.2f} {:>14.2f} {:>16.2f} {:>16.2f}'.format(
+            size, legacy * 1e3, planner * 1e3, legacy / size * 1e6,
+            planner / size * 1e6))
+
+
+if __name__ == '__main__':
+    main()
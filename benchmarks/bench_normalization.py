@@ -0,0 +1,140 @@
+"""Micro-benchmark the normalization transform over recorded GuardDuty
+findings.
+
+Each sample in benchmarks/samples/guardduty_findings.json is wrapped in an SNS
+record and transformed and serialized repeatedly. The samples cover every
+resource type in normalization.RESOURCE_HOSTNAME_PATHS. The original transform
+(json, strptime) is measured alongside the current transform of each output
+schema with the standard library json backend and, when it's installed,
+orjson.
+
+    python benchmarks/bench_normalization.py
+"""
+import json
+import os
+import sys
+import time
+
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lambda_functions import normalization  # noqa: E402
+
+SAMPLES_PATH = os.path.join(
+    os.path.dirname(__file__), 'samples', 'guardduty_findings.json')
+RECORDS = 5000
+REPEATS = 5
+
+
+def load_samples(path=SAMPLES_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def sns_records(samples, count=RECORDS):
+    """Wrap the samples in SNS records, cycling through the samples with a
+    new millisecond timestamp every few records as in a burst of findings."""
+    messages = [json.dumps(x) for x in samples]
+    return [
+        {'Sns': {
+            'MessageId': str(i),
+            'Timestamp': '2021-07-19T16:{:02d}:{:02d}.{:03d}Z'.format(
+                (i // 60000) % 60, (i // 1000) % 60, (i // 3) % 1000),
+            'Message': messages[i % len(messages)]}}
+        for i in range(count)]
+
+
+def legacy_transform(record):
+    """The transform and serialization before the fast path."""
+    guardduty_event = json.loads(record['Sns']['Message'])
+    iso_8601 = record['Sns'].get('Timestamp')
+    assert iso_8601[-1] == 'Z'
+    timestamp = str(datetime.strptime(
+        iso_8601[:-1] + '000', '%Y-%m-%dT%H:%M:%S.%f'))
+    resource = guardduty_event['detail'].get('resource', {})
+    instance_detail = resource.get('instanceDetails', None)
+    mozdef_event = {
+        'timestamp': timestamp,
+        'hostname': (instance_detail.get('instanceId')
+                     if instance_detail is not None
+                     else 'guardduty-{}'.format(guardduty_event['account'])),
+        'processname': 'guardduty',
+        'processid': 1337,
+        'severity': 'INFO',
+        'summary': guardduty_event['detail']['description'],
+        'category': guardduty_event['detail']['type'],
+        'source': 'guardduty',
+        'tags': [
+            guardduty_event['detail']['service']['action']['actionType']
+        ],
+        'details': guardduty_event.get('detail')
+    }
+    mozdef_event['details']['finding'] = (
+        mozdef_event['details'].pop('service'))
+    return json.dumps(mozdef_event)
+
+
+def current_transform(record, schema='mozdef'):
+    return normalization.json_dumps(
+        normalization.transform_event(record, schema))
+
+
+def with_backend(loads, dumps, schema):
+    """The current transform of a schema with a JSON backend."""
+    def transform(record):
+        normalization.json_loads = loads
+        normalization.json_dumps = dumps
+        return current_transform(record, schema)
+    return transform
+
+
+def seconds(transform, records):
+    start = time.perf_counter()
+    for record in records:
+        transform(record)
+    return time.perf_counter() - start
+
+
+def main():
+    samples = load_samples()
+    missing = set(normalization.RESOURCE_HOSTNAME_PATHS) - {
+        x['detail']['resource']['resourceType'] for x in samples}
+    if missing:
+        raise SystemExit('No samples of resource types {}'.format(missing))
+    records = sns_records(samples)
+    transforms = [('legacy (json, strptime)', legacy_transform)]
+
+    # the standard library backend as normalization sets it up without orjson
+    backends = [
+        ('json', json.loads, json.JSONEncoder(check_circular=False).encode)]
+    try:
+        import orjson
+    except ImportError:
+        print('orjson is not installed, only the json backend is measured')
+    else:
+        backends.append((
+            'orjson', orjson.loads,
+            lambda obj: orjson.dumps(obj).decode('utf-8')))
+    for backend, loads, dumps in backends:
+        for schema in normalization.SCHEMAS:
+            transforms.append(('{} ({})'.format(schema, backend),
+                               with_backend(loads, dumps, schema)))
+
+    # The transforms take turns and the fastest pass of each is kept, which
+    # is the least disturbed by the garbage collector and other processes
+    elapsed = [[] for _ in transforms]
+    for _ in range(REPEATS):
+        for (name, transform), times in zip(transforms, elapsed):
+            times.append(seconds(transform, records))
+    results = [(name, len(records) / min(times))
+               for (name, _), times in zip(transforms, elapsed)]
+
+    baseline = results[0][1]
+    print('{:<26} {:>14} {:>8}'.format('transform', 'findings/sec', 'speedup'))
+    for name, rate in results:
+        print('{:<26} {:>14,.0f} {:>7.2f}x'.format(name, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,847 @@
+"""A local, in-memory stand-in for the AWS APIs used by the Lambda functions.
+
+FakeAWS keeps the state of an organization (accounts, the cross account
+outputs DynamoDB table, GuardDuty detectors, members, invitations and
+findings, SNS topics, EventBridge rules, the normalizer's Lambda policy and
+its archive objects) and serves the API calls the Lambda functions make.
+
+The Lambda functions use real boto3 sessions and botocore clients, so their
+construction, parameter validation, request signing, retries and event
+hooks are all measured. FakeAWS only short-circuits HTTP: its before-send
+hook answers each signed request instead of sending it, identifying the
+account by the request's access key, and its before-parse hook hands the
+parser the response of the API handler.
+
+Every request is counted by (service, operation), can be slowed down with a
+fixed latency to model network round trips and can be throttled at random
+with a ThrottlingException response which botocore's retry handler retries.
+
+    aws = FakeAWS(latency=0.01, throttle_rate=0.001)
+    aws.populate_organization(1000, regions)
+    aws.install(invitation_manager, plumbing, normalization)
+"""
+import collections
+import copy
+import datetime
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import types
+import uuid
+
+import boto3
+from botocore import xform_name
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+
+MASTER_ACCOUNT_ID = '111111111111'
+MEMBER_ROLE_CATEGORY = 'GuardDuty Multi Account Member Role'
+PAGE_SIZES = {
+    'list_accounts': 20,
+    'list_findings': 50,
+    'list_members': 50,
+    'list_topics': 100,
+    'list_subscriptions_by_topic': 100,
+    'scan': 1000,
+}
+# Header of the requests, and their responses, which identifies the call
+CALL_HEADER = 'x-fake-aws-call'
+# Access keys of assumed role credentials are FAKE followed by the account ID
+ACCESS_KEY_PREFIX = 'FAKE'
+CREDENTIAL = re.compile(r'Credential=([^/]+)/')
+
+
+def client_error(code, operation_name, message=''):
+    return ClientError(
+        {'Error': {'Code': code, 'Message': message or code}},
+        operation_name)
+
+
+def _pascal_case_keys(value):
+    """The GetFindings form of a finding delivered through EventBridge."""
+    if isinstance(value, dict):
+        return {key[:1].upper() + key[1:]: _pascal_case_keys(item)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [_pascal_case_keys(item) for item in value]
+    return value
+
+
+def header(request, name):
+    """A header of a prepared request, which some services' handlers encode."""
+    value = request.headers[name]
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class Caller:
+    """The account and region a request was made in."""
+
+    def __init__(self, account_id, region_name):
+        self.account_id = account_id
+        self.region_name = region_name
+
+
+class RawBody:
+    """The raw HTTP response of a short-circuited request."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def response_body(operation_model, error=None):
+    """A response body in the operation's protocol which the parser accepts.
+
+    Error bodies carry the error code and message. Success bodies are empty
+    documents whose content is replaced by the before-parse hook.
+    """
+    protocol = operation_model.service_model.resolved_protocol
+    if protocol in ('json', 'rest-json'):
+        return json.dumps({'__type': error['Code'],
+                           'message': error['Message']}
+                          if error else {}).encode('utf-8')
+    if error:
+        xml = '<Error><Code>{Code}</Code><Message>{Message}</Message></Error>'
+        xml = xml.format(**error)
+        if protocol == 'query':
+            return '<ErrorResponse>{}</ErrorResponse>'.format(xml).encode()
+        if protocol == 'ec2':
+            return '<Response><Errors>{}</Errors></Response>'.format(
+                xml).encode()
+        return xml.encode()
+    if protocol == 'query':
+        wrapper = (operation_model.output_shape.serialization.get(
+            'resultWrapper') if operation_model.output_shape else None)
+        return '<{0}Response>{1}</{0}Response>'.format(
+            operation_model.name,
+            '<{}/>'.format(wrapper) if wrapper else '').encode()
+    if protocol == 'ec2':
+        return '<{0}Response/>'.format(operation_model.name).encode()
+    return b''
+
+
+class FakeAWS:
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.calls = collections.Counter()
+        self.throttled = collections.Counter()
+        self.regions = []
+        # Opt-in regions listed by get_available_regions which the accounts
+        # haven't enabled, where every call fails after a connection delay
+        self.disabled_regions = set()
+        self.disabled_region_delay = 0.0
+        self.accounts = {}
+        self.table = []
+        self.items = {}
+        self.detectors = {}
+        self.members = {}
+        self.invitations = {}
+        self.findings = {}
+        self.topics = {}
+        self.subscriptions = {}
+        self.rules = {}
+        self.targets = {}
+        self.policies = {}
+        self.published = collections.Counter()
+        self.messages = collections.defaultdict(list)
+        self.invocations = collections.defaultdict(list)
+        self.objects = {}
+        # (region, operation model, params) of the calls being made and the
+        # responses waiting to be parsed, by call
+        self.in_flight = {}
+        self.responses = {}
+        self.call_ids = itertools.count()
+
+    # Setup
+
+    def populate_organization(self, account_count, regions,
+                              status_weights=None, other_table_rows=3):
+        """Create an organization of account_count member accounts which all
+        have deployed the member role, and a master with a detector in every
+        region whose members have statuses picked with status_weights.
+
+        :param account_count: Number of member accounts
+        :param regions: List of region names
+        :param status_weights: dict of RelationshipStatus (or None for not a
+                               member) and relative weight
+        :param other_table_rows: Rows of other categories in the cross
+                                 account outputs table per member account
+        """
+        status_weights = status_weights or {None: 1}
+        statuses = list(status_weights)
+        weights = [status_weights[x] for x in statuses]
+        self.regions = list(regions)
+        for i in range(account_count):
+            account_id = '{:012d}'.format(200000000000 + i)
+            self.accounts[account_id] = '{}@example.com'.format(account_id)
+            self.table.append({
+                'id': {'S': uuid.UUID(int=i).hex},
+                'aws-account-id': {'S': account_id},
+                'category': {'S': MEMBER_ROLE_CATEGORY},
+                'GuardDutyMemberAccountIAMRoleArn': {
+                    'S': 'arn:aws:iam::{}:role/multi-account-guard-duty/'
+                         'GuardDutyInvitationAcceptor'.format(account_id)},
+                'GuardDutyMemberAccountIAMRoleName': {
+                    'S': 'GuardDutyInvitationAcceptor'}})
+            for j in range(other_table_rows):
+                self.table.append({
+                    'id': {'S': uuid.UUID(int=(j + 1) << 64 | i).hex},
+                    'aws-account-id': {'S': account_id},
+                    'category': {'S': 'Other Stack Output {}'.format(j)},
+                    'OutputValue': {'S': 'x' * 200}})
+        for region_name in self.regions:
+            self._create_detector(MASTER_ACCOUNT_ID, region_name)
+            members = self.members.setdefault(region_name, {})
+            for account_id in self.accounts:
+                status = self.random.choices(statuses, weights)[0]
+                if status is None:
+                    continue
+                members[account_id] = status
+                if status in ('Enabled', 'Disabled', 'Invited', 'Resigned'):
+                    self._create_detector(account_id, region_name)
+                if status in ('Invited', 'Resigned'):
+                    self.invitations[(account_id, region_name)] = [{
+                        'AccountId': MASTER_ACCOUNT_ID,
+                        'InvitationId': uuid.uuid4().hex,
+                        'RelationshipStatus': 'Invited'}]
+
+    def populate_findings(self, samples, count, regions=None,
+                          start=datetime.datetime(2021, 1, 1)):
+        """Create count findings in the master's detector of each region,
+        cycling through sample EventBridge events, updated a second apart.
+
+        Findings are kept as (finding ID, sample, updatedAt) and only built
+        in the GetFindings format, with PascalCase keys, when they're read.
+
+        :param samples: List of EventBridge GuardDuty Finding events
+        :param count: Number of findings per region
+        :param regions: List of region names, every region by default
+        :param start: datetime of the first update
+        """
+        for region_name in regions or self.regions:
+            findings = self.findings.setdefault(region_name, [])
+            for i in range(count):
+                updated_at = start + datetime.timedelta(seconds=i)
+                findings.append((
+                    '{:032x}'.format(len(findings) + (
+                        self.regions.index(region_name) << 64)),
+                    samples[i % len(samples)],
+                    int(updated_at.replace(
+                        tzinfo=datetime.timezone.utc).timestamp() * 1000)))
+
+    def install(self, *modules):
+        """Hook the boto3 sessions and clients each Lambda function module
+        creates up to this stand-in and reset the modules' caches.
+
+        The modules get a boto3 namespace whose sessions are real boto3
+        sessions with this stand-in's handlers registered before any client
+        is created, and whose client function creates clients of such a
+        session. Credentials are set to the master account's so that no
+        real credentials are ever looked up or used.
+        """
+        os.environ['AWS_ACCESS_KEY_ID'] = ACCESS_KEY_PREFIX + MASTER_ACCOUNT_ID
+        os.environ['AWS_SECRET_ACCESS_KEY'] = 'secret'
+        os.environ.pop('AWS_SESSION_TOKEN', None)
+        os.environ.pop('AWS_PROFILE', None)
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+        def session(**kwargs):
+            return self.attach(boto3.session.Session(**kwargs))
+        default_session = session()
+        hooked_boto3 = types.SimpleNamespace(
+            session=types.SimpleNamespace(Session=session),
+            client=default_session.client)
+        for module in modules:
+            module.boto3 = hooked_boto3
+            reset_module_caches(module)
+
+    def attach(self, session):
+        """Register the handlers which short-circuit HTTP on a boto3 session,
+        whose clients copy them when they're created."""
+        events = session.events
+        events.register('before-parameter-build', self._before_parameter_build)
+        events.register('before-call', self._before_call)
+        events.register('before-send', self._before_send)
+        events.register('before-parse', self._before_parse)
+        events.register('after-call', self._after_call)
+        events.register('after-call-error', self._after_call)
+        return session
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttled.clear()
+            self.published.clear()
+
+    # Dispatch
+
+    def _before_parameter_build(self, params, model, context, **kwargs):
+        # The API handlers take the parameters the client was called with,
+        # before they're serialized
+        context['fake_aws_params'] = copy.deepcopy(params)
+
+    def _before_call(self, params, model, context, **kwargs):
+        call_id = str(next(self.call_ids))
+        params['headers'][CALL_HEADER] = call_id
+        context['fake_aws_call'] = call_id
+        self.in_flight[call_id] = (
+            context['client_region'], model, context.pop('fake_aws_params'))
+
+    def _before_send(self, request, **kwargs):
+        call_id = header(request, CALL_HEADER)
+        region_name, model, params = self.in_flight[call_id]
+        service_name = model.service_model.service_name
+        access_key = CREDENTIAL.search(
+            header(request, 'Authorization')).group(1)
+        caller = Caller(
+            access_key[len(ACCESS_KEY_PREFIX):]
+            if access_key.startswith(ACCESS_KEY_PREFIX) else MASTER_ACCOUNT_ID,
+            region_name)
+        with self.lock:
+            self.calls[(service_name, model.name)] += 1
+            throttled = (self.throttle_rate
+                         and self.random.random() < self.throttle_rate)
+            if throttled:
+                self.throttled[(service_name, model.name)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            if throttled:
+                raise client_error('ThrottlingException', model.name,
+                                   'Rate exceeded')
+            if region_name in self.disabled_regions:
+                time.sleep(self.disabled_region_delay)
+                raise client_error(
+                    'UnrecognizedClientException', model.name,
+                    'The security token included in the request is invalid')
+            handler = getattr(self, '{}_{}'.format(
+                service_name.replace('-', '_'), xform_name(model.name)))
+            with self.lock:
+                response = handler(caller, **params)
+        except ClientError as e:
+            return AWSResponse(request.url, 400, {CALL_HEADER: call_id},
+                               RawBody(response_body(model, e.response['Error'])))
+        self.responses[call_id] = response
+        return AWSResponse(request.url, 200, {CALL_HEADER: call_id},
+                           RawBody(response_body(model)))
+
+    def _before_parse(self, response_dict, customized_response_dict,
+                      **kwargs):
+        call_id = response_dict['headers'].get(CALL_HEADER)
+        if call_id in self.responses:
+            customized_response_dict.update(self.responses.pop(call_id))
+
+    def _after_call(self, context, **kwargs):
+        self.in_flight.pop(context.get('fake_aws_call'), None)
+
+    @staticmethod
+    def _page(items, kwargs, method_name, items_key):
+        start = int(kwargs.get('NextToken') or 0)
+        size = int(kwargs.get('MaxResults') or PAGE_SIZES[method_name])
+        page = {items_key: items[start:start + size]}
+        if start + size < len(items):
+            page['NextToken'] = str(start + size)
+        return page
+
+    def _create_detector(self, account_id, region_name):
+        detector_id = uuid.uuid4().hex
+        self.detectors.setdefault((account_id, region_name), {})[
+            detector_id] = {'Status': 'ENABLED'}
+        return detector_id
+
+    # EC2
+
+    def ec2_describe_regions(self, caller, AllRegions=False, **kwargs):
+        return {'Regions': [
+            {'RegionName': x, 'OptInStatus': (
+                'not-opted-in' if x in self.disabled_regions
+                else 'opt-in-not-required')}
+            for x in self.regions
+            if AllRegions or x not in self.disabled_regions]}
+
+    # STS
+
+    def sts_assume_role(self, caller, RoleArn, RoleSessionName,
+                        DurationSeconds=3600, **kwargs):
+        account_id = RoleArn.split(':')[4]
+        return {'Credentials': {
+            'AccessKeyId': 'FAKE' + account_id,
+            'SecretAccessKey': 'secret',
+            'SessionToken': 'token',
+            'Expiration': datetime.datetime.now(datetime.timezone.utc)
+            + datetime.timedelta(seconds=DurationSeconds)}}
+
+    def sts_get_caller_identity(self, caller, **kwargs):
+        return {'Account': caller.account_id,
+                'Arn': 'arn:aws:sts::{}:assumed-role/x/y'.format(
+                    caller.account_id)}
+
+    # Organizations
+
+    def organizations_list_accounts(self, caller, **kwargs):
+        accounts = [{'Id': k, 'Email': v, 'Status': 'ACTIVE'}
+                    for k, v in self.accounts.items()]
+        return self._page(accounts, kwargs, 'list_accounts', 'Accounts')
+
+    # DynamoDB
+
+    def dynamodb_scan(self, caller, TableName, **kwargs):
+        if TableName in self.items:
+            rows = list(self.items[TableName].values())
+        else:
+            rows = self.table
+        if 'ExpressionAttributeValues' in kwargs and 'FilterExpression' in kwargs:
+            rows = self._filter(rows, kwargs)
+        segment = kwargs.get('Segment')
+        if segment is not None:
+            total = kwargs['TotalSegments']
+            rows = [x for x in rows
+                    if int(x['id']['S'], 16) % total == segment]
+        start = int(kwargs.get('ExclusiveStartKey', {}).get(
+            'offset', {}).get('N', 0))
+        size = int(kwargs.get('Limit') or PAGE_SIZES['scan'])
+        page_rows = rows[start:start + size]
+        if 'ProjectionExpression' in kwargs:
+            page_rows = self._project(page_rows, kwargs)
+        page = {'Items': copy.deepcopy(page_rows), 'Count': len(page_rows),
+                'ScannedCount': len(page_rows)}
+        if start + size < len(rows):
+            page['LastEvaluatedKey'] = {'offset': {'N': str(start + size)}}
+        return page
+
+    def dynamodb_query(self, caller, TableName, **kwargs):
+        return self.dynamodb_scan(caller, TableName, FilterExpression=(
+            kwargs['KeyConditionExpression']), **{
+            k: v for k, v in kwargs.items()
+            if k not in ('KeyConditionExpression', 'IndexName')})
+
+    @staticmethod
+    def _names(kwargs):
+        return kwargs.get('ExpressionAttributeNames', {})
+
+    def _filter(self, rows, kwargs):
+        names = self._names(kwargs)
+        values = kwargs['ExpressionAttributeValues']
+        conditions = re.findall(
+            r'(#?[\w-]+)\s*=\s*(:[\w-]+)', kwargs['FilterExpression'])
+        return [x for x in rows if all(
+            x.get(names.get(attribute, attribute)) == values[value]
+            for attribute, value in conditions)]
+
+    def _project(self, rows, kwargs):
+        names = self._names(kwargs)
+        attributes = [names.get(x.strip(), x.strip())
+                      for x in kwargs['ProjectionExpression'].split(',')]
+        return [{k: v for k, v in x.items() if k in attributes}
+                for x in rows]
+
+    def dynamodb_get_item(self, caller, TableName, Key, **kwargs):
+        item = self.items.get(TableName, {}).get(json.dumps(
+            Key, sort_keys=True))
+        return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def dynamodb_put_item(self, caller, TableName, Item, **kwargs):
+        key_name = next(x for x in Item
+                        if x.endswith(('key', '-id')) or x == 'id')
+        key = json.dumps({key_name: Item[key_name]}, sort_keys=True)
+        existing = self.items.get(TableName, {}).get(key)
+        condition = kwargs.get('ConditionExpression', '')
+        if condition.startswith('attribute_not_exists') and existing:
+            raise client_error('ConditionalCheckFailedException', 'PutItem')
+        self.items.setdefault(TableName, {})[key] = Item
+        return {}
+
+    def dynamodb_update_item(self, caller, TableName, Key, UpdateExpression,
+                             **kwargs):
+        # Supports SET of values and a condition of attribute_not_exists
+        # and < or <= comparisons of numbers joined by OR
+        key = json.dumps(Key, sort_keys=True)
+        existing = self.items.get(TableName, {}).get(key)
+        values = kwargs.get('ExpressionAttributeValues', {})
+        condition = kwargs.get('ConditionExpression')
+        if condition and existing is not None:
+            for clause in condition.split(' OR '):
+                match = re.fullmatch(r'attribute_not_exists\((\S+)\)', clause)
+                if match and match.group(1) not in existing:
+                    break
+                match = re.fullmatch(r'(\S+) (<=?) (\S+)', clause)
+                if match and match.group(1) in existing:
+                    name, operator, value = match.groups()
+                    difference = (float(values[value]['N'])
+                                  - float(existing[name]['N']))
+                    if difference > 0 or (operator == '<=' and difference == 0):
+                        break
+            else:
+                raise client_error('ConditionalCheckFailedException',
+                                   'UpdateItem')
+        item = dict(existing or Key)
+        for assignment in UpdateExpression[len('SET '):].split(','):
+            name, value = (x.strip() for x in assignment.split('='))
+            item[name] = values[value]
+        self.items.setdefault(TableName, {})[key] = item
+        if kwargs.get('ReturnValues') == 'ALL_OLD' and existing is not None:
+            return {'Attributes': copy.deepcopy(existing)}
+        return {}
+
+    def dynamodb_delete_item(self, caller, TableName, Key, **kwargs):
+        self.items.get(TableName, {}).pop(json.dumps(Key, sort_keys=True),
+                                          None)
+        return {}
+
+    # GuardDuty
+
+    def _detector_for(self, caller, DetectorId):
+        detectors = self.detectors.get(
+            (caller.account_id, caller.region_name), {})
+        if DetectorId not in detectors:
+            raise client_error('BadRequestException', 'GuardDuty',
+                               'The request is rejected because the input '
+                               'detectorId is not owned by the current '
+                               'account.')
+        return detectors[DetectorId]
+
+    def guardduty_list_detectors(self, caller, **kwargs):
+        return {'DetectorIds': list(self.detectors.get(
+            (caller.account_id, caller.region_name), {}))}
+
+    def guardduty_create_detector(self, caller, Enable=True, **kwargs):
+        if self.detectors.get((caller.account_id, caller.region_name)):
+            raise client_error('BadRequestException', 'CreateDetector',
+                               'A detector already exists for the current '
+                               'account.')
+        return {'DetectorId': self._create_detector(
+            caller.account_id, caller.region_name)}
+
+    def guardduty_update_detector(self, caller, DetectorId, Enable=True,
+                                  **kwargs):
+        self._detector_for(caller, DetectorId)['Status'] = (
+            'ENABLED' if Enable else 'DISABLED')
+        members = self.members.get(caller.region_name, {})
+        if members.get(caller.account_id) == 'Disabled' and Enable:
+            members[caller.account_id] = 'Enabled'
+        return {}
+
+    def guardduty_delete_detector(self, caller, DetectorId, **kwargs):
+        self._detector_for(caller, DetectorId)
+        del self.detectors[(caller.account_id, caller.region_name)][
+            DetectorId]
+        members = self.members.get(caller.region_name, {})
+        if members.get(caller.account_id) == 'Enabled':
+            members[caller.account_id] = 'Removed'
+        return {}
+
+    def guardduty_list_members(self, caller, DetectorId, **kwargs):
+        self._detector_for(caller, DetectorId)
+        members = self.members.get(caller.region_name, {})
+        page = self._page(list(members), kwargs, 'list_members', 'Members')
+        page['Members'] = [
+            self._member(caller, x, members[x]) for x in page['Members']]
+        return page
+
+    def _member(self, caller, account_id, status):
+        member = {'AccountId': account_id, 'RelationshipStatus': status,
+                  'Email': self.accounts.get(account_id, ''),
+                  'MasterId': caller.account_id}
+        detectors = self.detectors.get((account_id, caller.region_name))
+        if detectors:
+            member['DetectorId'] = next(iter(detectors))
+        return member
+
+    def guardduty_get_members(self, caller, DetectorId, AccountIds,
+                              **kwargs):
+        self._check_batch(AccountIds, 'GetMembers')
+        members = self.members.get(caller.region_name, {})
+        return {
+            'Members': [self._member(caller, x, members[x])
+                        for x in AccountIds if x in members],
+            'UnprocessedAccounts': [
+                {'AccountId': x, 'Result': 'The request is rejected '
+                 'because the input accountId is not a member.'}
+                for x in AccountIds if x not in members]}
+
+    @staticmethod
+    def _check_batch(items, operation):
+        if not 1 <= len(items) <= 50:
+            raise client_error(
+                'BadRequestException', operation,
+                '1 validation error detected: Value at accountIds failed '
+                'to satisfy constraint: Member must have length less than '
+                'or equal to 50')
+
+    def guardduty_create_members(self, caller, DetectorId, AccountDetails,
+                                 **kwargs):
+        self._detector_for(caller, DetectorId)
+        self._check_batch(AccountDetails, 'CreateMembers')
+        members = self.members.setdefault(caller.region_name, {})
+        for detail in AccountDetails:
+            members[detail['AccountId']] = 'Created'
+        return {'UnprocessedAccounts': []}
+
+    def guardduty_invite_members(self, caller, DetectorId, AccountIds,
+                                 **kwargs):
+        self._detector_for(caller, DetectorId)
+        self._check_batch(AccountIds, 'InviteMembers')
+        members = self.members.setdefault(caller.region_name, {})
+        for account_id in AccountIds:
+            members[account_id] = 'Invited'
+            self.invitations[(account_id, caller.region_name)] = [{
+                'AccountId': caller.account_id,
+                'InvitationId': uuid.uuid4().hex,
+                'RelationshipStatus': 'Invited'}]
+        return {'UnprocessedAccounts': []}
+
+    def guardduty_delete_members(self, caller, DetectorId, AccountIds,
+                                 **kwargs):
+        self._detector_for(caller, DetectorId)
+        self._check_batch(AccountIds, 'DeleteMembers')
+        members = self.members.setdefault(caller.region_name, {})
+        for account_id in AccountIds:
+            members.pop(account_id, None)
+        return {'UnprocessedAccounts': []}
+
+    def _findings_for(self, caller, DetectorId):
+        self._detector_for(caller, DetectorId)
+        if caller.account_id != MASTER_ACCOUNT_ID:
+            return []
+        return self.findings.get(caller.region_name, [])
+
+    def guardduty_list_findings(self, caller, DetectorId,
+                                FindingCriteria=None, SortCriteria=None,
+                                **kwargs):
+        if not (kwargs.get('NextToken') or '0').isdigit():
+            raise client_error('BadRequestException', 'ListFindings',
+                               'The request is rejected because the input '
+                               'nextToken is not valid.')
+        since = ((FindingCriteria or {}).get('Criterion', {}).get(
+            'updatedAt', {}).get('GreaterThanOrEqual', 0))
+        findings = sorted(
+            (x for x in self._findings_for(caller, DetectorId)
+             if x[2] >= since), key=lambda x: x[2],
+            reverse=(SortCriteria or {}).get('OrderBy') == 'DESC')
+        page = self._page(findings, kwargs, 'list_findings', 'FindingIds')
+        page['FindingIds'] = [x[0] for x in page['FindingIds']]
+        return page
+
+    def guardduty_get_findings(self, caller, DetectorId, FindingIds,
+                               **kwargs):
+        self._check_batch(FindingIds, 'GetFindings')
+        findings = {x[0]: x for x in self._findings_for(caller, DetectorId)}
+        return {'Findings': [
+            self._finding(caller, *findings[x])
+            for x in FindingIds if x in findings]}
+
+    def _finding(self, caller, finding_id, sample, updated_at):
+        detail = dict(
+            sample['detail'], id=finding_id, accountId=caller.account_id,
+            region=caller.region_name,
+            updatedAt=datetime.datetime.fromtimestamp(
+                updated_at / 1000, datetime.timezone.utc).strftime(
+                '%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z')
+        return _pascal_case_keys(detail)
+
+    def guardduty_list_invitations(self, caller, **kwargs):
+        return {'Invitations': list(self.invitations.get(
+            (caller.account_id, caller.region_name), []))}
+
+    def guardduty_accept_invitation(self, caller, DetectorId, MasterId,
+                                    InvitationId, **kwargs):
+        self._detector_for(caller, DetectorId)
+        self.invitations.pop((caller.account_id, caller.region_name), None)
+        self.members.setdefault(caller.region_name, {})[
+            caller.account_id] = 'Enabled'
+        return {}
+
+    def guardduty_disassociate_from_master_account(self, caller, DetectorId,
+                                                   **kwargs):
+        self._detector_for(caller, DetectorId)
+        members = self.members.get(caller.region_name, {})
+        if caller.account_id in members:
+            members[caller.account_id] = 'Resigned'
+        return {}
+
+    def guardduty_delete_invitations(self, caller, AccountIds, **kwargs):
+        self.invitations.pop((caller.account_id, caller.region_name), None)
+        return {'UnprocessedAccounts': []}
+
+    # SNS
+
+    def _topic_arn(self, caller, name):
+        return 'arn:aws:sns:{}:{}:{}'.format(
+            caller.region_name, caller.account_id, name)
+
+    def sns_list_topics(self, caller, **kwargs):
+        topics = [{'TopicArn': x} for x in self.topics.get(
+            (caller.account_id, caller.region_name), [])]
+        return self._page(topics, kwargs, 'list_topics', 'Topics')
+
+    def sns_create_topic(self, caller, Name, **kwargs):
+        topic_arn = self._topic_arn(caller, Name)
+        topics = self.topics.setdefault(
+            (caller.account_id, caller.region_name), [])
+        if topic_arn not in topics:
+            topics.append(topic_arn)
+        return {'TopicArn': topic_arn}
+
+    def sns_list_subscriptions_by_topic(self, caller, TopicArn, **kwargs):
+        return self._page(
+            list(self.subscriptions.get(TopicArn, [])), kwargs,
+            'list_subscriptions_by_topic', 'Subscriptions')
+
+    def sns_subscribe(self, caller, TopicArn, Protocol, Endpoint, **kwargs):
+        subscription_arn = '{}:{}'.format(TopicArn, uuid.uuid4())
+        self.subscriptions.setdefault(TopicArn, []).append({
+            'SubscriptionArn': subscription_arn, 'TopicArn': TopicArn,
+            'Protocol': Protocol, 'Endpoint': Endpoint})
+        return {'SubscriptionArn': subscription_arn}
+
+    def sns_unsubscribe(self, caller, SubscriptionArn, **kwargs):
+        for subscriptions in self.subscriptions.values():
+            subscriptions[:] = [x for x in subscriptions
+                                if x['SubscriptionArn'] != SubscriptionArn]
+        return {}
+
+    def sns_publish(self, caller, TopicArn, Message, **kwargs):
+        self.published[TopicArn] += 1
+        return {'MessageId': uuid.uuid4().hex}
+
+    def sns_publish_batch(self, caller, TopicArn, PublishBatchRequestEntries,
+                          **kwargs):
+        if len(PublishBatchRequestEntries) > 10 or sum(
+                len(x['Message'].encode('utf-8'))
+                for x in PublishBatchRequestEntries) > 262144:
+            raise client_error('BatchRequestTooLong', 'PublishBatch')
+        self.published[TopicArn] += len(PublishBatchRequestEntries)
+        return {'Successful': [{'Id': x['Id'], 'MessageId': uuid.uuid4().hex}
+                               for x in PublishBatchRequestEntries],
+                'Failed': []}
+
+    # SQS
+
+    def sqs_send_message_batch(self, caller, QueueUrl, Entries, **kwargs):
+        if len(Entries) > 10:
+            raise client_error('TooManyEntriesInBatchRequest',
+                               'SendMessageBatch')
+        if sum(len(x['MessageBody'].encode('utf-8'))
+               for x in Entries) > 262144:
+            raise client_error('BatchRequestTooLong', 'SendMessageBatch')
+        self.published[QueueUrl] += len(Entries)
+        successful = []
+        for entry in Entries:
+            message_id = uuid.uuid4().hex
+            self.messages[QueueUrl].append({
+                'eventSource': 'aws:sqs', 'messageId': message_id,
+                'body': entry['MessageBody']})
+            successful.append({'Id': entry['Id'], 'MessageId': message_id})
+        return {'Successful': successful, 'Failed': []}
+
+    # S3
+
+    def s3_put_object(self, caller, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body
+        return {'ETag': uuid.uuid4().hex}
+
+    # EventBridge
+
+    def events_describe_rule(self, caller, Name, **kwargs):
+        key = (caller.account_id, caller.region_name, Name)
+        if key not in self.rules:
+            raise client_error('ResourceNotFoundException', 'DescribeRule')
+        return dict(self.rules[key])
+
+    def events_put_rule(self, caller, Name, **kwargs):
+        rule_arn = 'arn:aws:events:{}:{}:rule/{}'.format(
+            caller.region_name, caller.account_id, Name)
+        self.rules[(caller.account_id, caller.region_name, Name)] = dict(
+            kwargs, Name=Name, Arn=rule_arn)
+        return {'RuleArn': rule_arn}
+
+    def events_list_targets_by_rule(self, caller, Rule, **kwargs):
+        return {'Targets': list(self.targets.get(
+            (caller.account_id, caller.region_name, Rule), []))}
+
+    def events_put_targets(self, caller, Rule, Targets, **kwargs):
+        targets = {x['Id']: x for x in self.targets.get(
+            (caller.account_id, caller.region_name, Rule), [])}
+        targets.update({x['Id']: x for x in Targets})
+        self.targets[(caller.account_id, caller.region_name, Rule)] = (
+            list(targets.values()))
+        return {'FailedEntryCount': 0, 'FailedEntries': []}
+
+    def events_remove_targets(self, caller, Rule, Ids, **kwargs):
+        key = (caller.account_id, caller.region_name, Rule)
+        self.targets[key] = [
+            x for x in self.targets.get(key, []) if x['Id'] not in Ids]
+        return {'FailedEntryCount': 0, 'FailedEntries': []}
+
+    # Lambda
+
+    def lambda_invoke(self, caller, FunctionName, Payload=b'',
+                      InvocationType='RequestResponse', **kwargs):
+        self.invocations[FunctionName].append(json.loads(Payload))
+        return {'StatusCode': 202 if InvocationType == 'Event' else 200}
+
+    def lambda_get_policy(self, caller, FunctionName, **kwargs):
+        statements = self.policies.get(FunctionName)
+        if not statements:
+            raise client_error('ResourceNotFoundException', 'GetPolicy')
+        return {'Policy': json.dumps({
+            'Version': '2012-10-17', 'Statement': list(statements.values())})}
+
+    def lambda_add_permission(self, caller, FunctionName, StatementId,
+                              Action, Principal, SourceArn=None, **kwargs):
+        statements = self.policies.setdefault(FunctionName, {})
+        if StatementId in statements:
+            raise client_error('ResourceConflictException', 'AddPermission',
+                               'The statement id provided already exists.')
+        statement = {'Sid': StatementId, 'Effect': 'Allow',
+                     'Principal': {'Service': Principal}, 'Action': Action}
+        if SourceArn is not None:
+            statement['Condition'] = {'ArnLike': {'AWS:SourceArn': SourceArn}}
+        statements[StatementId] = statement
+        return {'Statement': json.dumps(statement)}
+
+    def lambda_remove_permission(self, caller, FunctionName, StatementId,
+                                 **kwargs):
+        if StatementId not in self.policies.get(FunctionName, {}):
+            raise client_error('ResourceNotFoundException',
+                               'RemovePermission')
+        del self.policies[FunctionName][StatementId]
+        return {}
+
+
+def reset_module_caches(module):
+    """Empty the module level caches of a Lambda function module so that a
+    benchmark scenario starts cold."""
+    if hasattr(module, 'SESSION_CACHE'):
+        module.SESSION_CACHE.clear()
+    if hasattr(module, 'MEMBER_SESSION_CACHE'):
+        module.MEMBER_SESSION_CACHE.clear()
+    if hasattr(module, 'ClientRegistry'):
+        module.CLIENT_REGISTRY = module.ClientRegistry()
+    for name in ('SESSIONS', 'TOPIC_ARNS', 'ENABLED_REGIONS', 'REGION_HEALTH'):
+        if isinstance(getattr(module, name, None), dict):
+            getattr(module, name).clear()
+    if hasattr(module, 'CLIENTS'):
+        module.CLIENTS.clear()
+    if hasattr(module, 'RATE_LIMITER'):
+        module.RATE_LIMITER.buckets.clear()
+        module.RATE_LIMITER.reset_stats()
+    if hasattr(module, 'SESSION_ACCOUNT_IDS'):
+        module.SESSION_ACCOUNT_IDS.clear()
+    if hasattr(module, 'MEMBER_SESSIONS'):
+        module.MEMBER_SESSIONS.clear()
+    if hasattr(module, 'METRICS'):
+        module.METRICS.reset()
+    if hasattr(module, 'DEDUP_CACHE'):
+        module.DEDUP_CACHE = None
+    if hasattr(module, 'ARCHIVE'):
+        module.ARCHIVE = None
@@ -1,8 +1,21 @@
 import boto3
+import collections
+import contextlib
+import functools
+import hashlib
+import json
 import logging
 import os
-from boto3.dynamodb.types import TypeDeserializer
-from boto3.dynamodb.transform import TransformationInjector
+import threading
+import time
+import uuid
+import weakref
+import zlib
+import botocore.loaders
+import botocore.session
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 root = logging.getLogger()
 if root.handlers:
@@ -24,57 +37,692 @@ DB_CATEGORY = os.environ.get(
 ORGANIZATION_IAM_ROLE_ARNS = os.environ.get(
     'ORGANIZATION_IAM_ROLE_ARNS')
 ACCOUNT_FILTER_LIST = os.environ.get('ACCOUNT_FILTER_LIST', '')
+MAX_REGION_WORKERS = int(os.environ.get('MAX_REGION_WORKERS', 8))
+MAX_ACCOUNT_WORKERS = int(os.environ.get('MAX_ACCOUNT_WORKERS', 8))
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME')
+FULL_SWEEP_INTERVAL = int(os.environ.get('FULL_SWEEP_INTERVAL', 86400))
+# Maximum age in seconds of a cached AWS Organization account map
+ORGANIZATION_CACHE_TTL = int(os.environ.get('ORGANIZATION_CACHE_TTL', 3600))
+# Maximum age in seconds of the cached list of regions enabled in an account
+REGION_CACHE_TTL = int(os.environ.get('REGION_CACHE_TTL', 86400))
+# Space delimited lists of regions to use even if they aren't found to be
+# enabled, and to never use
+REGION_ALLOW_LIST = os.environ.get('REGION_ALLOW_LIST', '')
+REGION_DENY_LIST = os.environ.get('REGION_DENY_LIST', '')
+# AWS Organizations events, recorded by CloudTrail, of accounts joining or
+# leaving an organization. An invited account joins when it accepts the
+# invitation's handshake.
+ORGANIZATION_ACCOUNT_EVENTS = {
+    'CreateAccountResult', 'AcceptHandshake',
+    'RemoveAccountFromOrganization'}
+# Name of a global secondary index of the cross account outputs table with a
+# category partition key. When it's unset the table is scanned instead.
+DYNAMODB_CATEGORY_INDEX_NAME = os.environ.get('DYNAMODB_CATEGORY_INDEX_NAME')
+DYNAMODB_SCAN_SEGMENTS = int(os.environ.get('DYNAMODB_SCAN_SEGMENTS', 4))
+# How to run the work of each (region, account chunk) shard. Empty to
+# reconcile every region within this invocation, lambda to invoke this
+# function asynchronously for each shard, sqs to send each shard to
+# SHARD_QUEUE_URL or local to run the shards in process.
+SHARD_DISPATCH = os.environ.get('SHARD_DISPATCH', '')
+SHARD_SIZE = int(os.environ.get('SHARD_SIZE', 500))
+SHARD_QUEUE_URL = os.environ.get('SHARD_QUEUE_URL')
+# SendMessageBatch accepts up to 10 messages with a combined size of up to
+# 256 KiB, which is also the largest a single message can be
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_BATCH_BYTES = 262144
+# Number of finished teardown pairs between writes of the teardown report
+TEARDOWN_CHECKPOINT_INTERVAL = int(
+    os.environ.get('TEARDOWN_CHECKPOINT_INTERVAL', 50))
+# Number of assumed member role sessions, and of clients created from them,
+# kept between uses
+MEMBER_SESSION_CACHE_SIZE = int(
+    os.environ.get('MEMBER_SESSION_CACHE_SIZE', 64))
+MEMBER_CLIENT_CACHE_SIZE = int(
+    os.environ.get('MEMBER_CLIENT_CACHE_SIZE', 64))
+# botocore's adaptive retry mode gives each client a token bucket, charged
+# for every attempt including retries, which only starts limiting the
+# client's request rate once it's throttled. There is one client per
+# (session, service, region) so each (service, region, account) adapts to its
+# own limits.
+API_MAX_ATTEMPTS = int(os.environ.get('API_MAX_ATTEMPTS', 10))
+BOTO_CONFIG = Config(
+    retries={'max_attempts': API_MAX_ATTEMPTS, 'mode': 'adaptive'})
+# CloudWatch namespace of the metrics emitted at the end of each invocation,
+# set to an empty string to not emit them
+METRICS_NAMESPACE = os.environ.get(
+    'METRICS_NAMESPACE', 'GuardDutyMultiAccountManager')
+# Number of accounts with the most API time listed in the metrics summary
+METRICS_TOP_ACCOUNTS = int(os.environ.get('METRICS_TOP_ACCOUNTS', 20))
+# Create the clients every invocation needs during the Lambda init phase,
+# which runs before the first invocation is billed
+PREWARM_CLIENTS = (os.environ.get('PREWARM_CLIENTS', 'true') == 'true'
+                   and 'AWS_LAMBDA_FUNCTION_NAME' in os.environ)
+# Maximum number of accounts in a CreateMembers, InviteMembers,
+# DeleteMembers or GetMembers call
+GUARDDUTY_MEMBER_BATCH_SIZE = 50
 
 
-class GetMembers:
-    """Return a function which allows for filtering the member dict"""
+class MemberPlan:
+    """Plan the actions needed to move a region's members towards a
+    functioning member master relationship
 
-    def __init__(self, all_members):
-        self.all_members = all_members
+    The members are indexed by RelationshipStatus once, after which each
+    action list is built with set operations so the cost of planning grows
+    linearly with the number of accounts.
 
-    def __call__(self, *args):
-        """Return the account IDs of accounts with one of the passed
+    RelationshipStatus values
+
+    CREATED  : Member created by master but master hasn't invited member
+    INVITED  : Member invited by master with DisableEmailNotification=True
+    DISABLED : Member has accepted invitation but detector has been updated
+               to Enable=False
+    ENABLED  : Member has accepted invitation
+    REMOVED  : Member has accepted invitation but detector has been deleted
+    RESIGNED : Member that had accepted the invitation, then later called
+               DisassociateFromMasterAccount or deselected the "Accept"
+               button in the web console
+    EMAILVERIFICATIONINPROGRESS : Member invited by master with
+                                  DisableEmailNotification=False
+    EMAILVERIFICATIONFAILED :
+    Not present : Member's never been created or member has resigned, and
+                  then clicked the `x` in the web console to delete
+                  themselves
+
+    Actions
+
+    create : Account details of accounts to create as members in the master
+    delete : Account IDs of members to delete from the master
+    invite : Account IDs of members to invite from the master
+    re_enable : Account IDs of members whose detector should be re-enabled
+    ensure_detector : Account IDs of members which need a detector
+    accept : Account IDs of members whose pending invitation should be
+             accepted in the member account
+
+    The delete and invite actions apply to every member of the region, not
+    only to account_ids. When a region is split into shards only one of them
+    is region wide and plans those actions.
+    """
+
+    def __init__(self, members, account_ids, organizations_account_id_map,
+                 region_wide=True):
+        """
+        :param members: dict of member account IDs and RelationshipStatus
+                        values
+        :param account_ids: Account IDs which should become members
+        :param organizations_account_id_map: dict of account IDs and emails
+        :param region_wide: Whether to plan the delete and invite actions
+                            for the members of the region
+        """
+        self.members = members
+        self.by_status = {}
+        for account_id, status in members.items():
+            self.by_status.setdefault(status.upper(), set()).add(account_id)
+
+        account_ids = set(account_ids)
+        removed = self.with_status('REMOVED')
+        self.create = [
+            {'AccountId': account_id,
+             'Email': organizations_account_id_map[account_id]}
+            for account_id in account_ids
+            if account_id not in members or account_id in removed]
+        self.delete = (list(self.with_status('EMAILVERIFICATIONFAILED'))
+                       if region_wide else [])
+        self.invite = (list(self.with_status('CREATED', 'RESIGNED'))
+                       if region_wide else [])
+        self.re_enable = list(account_ids & self.with_status('DISABLED'))
+        self.ensure_detector = list(account_ids & removed)
+        self.accept = list(account_ids & self.with_status(
+            'RESIGNED', 'INVITED', 'EMAILVERIFICATIONINPROGRESS'))
+
+    def with_status(self, *statuses):
+        """Return the account IDs of members with one of the passed
         relationship statuses
 
-        CREATED  : Member created by master but master hasn't invited member
-        INVITED  : Member invited by master with DisableEmailNotification=True
-        DISABLED : Member has accepted invitation but detector has been updated
-                   to Enable=False
-        ENABLED  : Member has accepted invitation
-        REMOVED  : Member has accepted invitation but detector has been deleted
-        RESIGNED : Member that had accepted the invitation, then later called
-                   DisassociateFromMasterAccount or deselected the "Accept"
-                   button in the web console
-        EMAILVERIFICATIONINPROGRESS : Member invited by master with
-                                      DisableEmailNotification=False
-        EMAILVERIFICATIONFAILED :
-        Not present : Member's never been created or member has resigned, and
-                      then clicked the `x` in the web console to delete
-                      themselves
-
-        :param args: Relationship status
-        :return: List of account IDs
+        :param statuses: Relationship status
+        :return: Set of account IDs
         """
-        return [k for k, v in self.all_members.items()
-                if v.lower() in [x.lower() for x in args]]
+        return set().union(*(self.by_status.get(x.upper(), ())
+                             for x in statuses))
 
+    def member_actions(self):
+        """Group the actions which are taken in member accounts by account
 
-def get_session(role_arn=None):
-    """Return a boto session either for the current IAM Role or for an assumed
-    role if role_arn is passed
+        :return: dict with account ID keys and list of action values
+        """
+        actions = {}
+        for action in ('re_enable', 'ensure_detector', 'accept'):
+            for account_id in getattr(self, action):
+                actions.setdefault(account_id, []).append(action)
+        return actions
 
-    :param role_arn: An ARN of an AWS IAM role to assume
+
+def chunks(items, size=GUARDDUTY_MEMBER_BATCH_SIZE):
+    """Split a list into lists of at most size items
+
+    :param items: List to split
+    :param size: Maximum number of items in each chunk
+    :return: Generator of lists
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Account IDs of the sessions created for assumed IAM Roles, which key the
+# API call timings of their clients. Clients of other sessions are counted as
+# the local account's.
+SESSION_ACCOUNT_IDS = weakref.WeakKeyDictionary()
+# Sessions of assumed member account IAM Roles, whose clients aren't shared
+# for the life of the container, see ClientRegistry
+MEMBER_SESSIONS = weakref.WeakSet()
+
+
+class Metrics:
+    """Timings of the phases of an invocation and of its API calls
+
+    Phases are timed with the phase context manager or the timed decorator.
+    A phase run concurrently, like the listing of each region's members, is
+    recorded once per run so its total can exceed the invocation's duration.
+
+    API calls are timed through the botocore event hooks of every client by
+    (service, operation, region, account), counting the retries botocore
+    made, the calls which returned an error and the time each call spent
+    waiting rather than sending requests, which is the time blocked in
+    botocore's adaptive rate limiter and backing off between retries.
+
+    emit writes a single CloudWatch Embedded Metric Format document at the
+    end of each invocation. Totals are metrics with the function name as
+    their dimension, while the breakdowns of API calls by operation, region
+    and account are properties of the document which can be queried with
+    CloudWatch Logs Insights.
+    """
+
+    def __init__(self, namespace, top_accounts=20):
+        self.namespace = namespace
+        self.top_accounts = top_accounts
+        self.lock = threading.Lock()
+        # The wait of the call in progress on each thread, as the
+        # before-send and needs-retry events aren't given its context
+        self.waits = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.perf_counter()
+            self.phases = {}
+            self.calls = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as a run of a phase
+
+        :param name: Phase name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(self.phases, name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """Return a decorator which times each call of a function as a run
+        of a phase
+
+        :param name: Phase name
+        :return: Decorator
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, counters, key, seconds, retries=0, error=False,
+               wait=0.0):
+        with self.lock:
+            counter = counters.get(key)
+            if counter is None:
+                counter = counters[key] = {
+                    'count': 0, 'time': 0.0, 'max': 0.0, 'retries': 0,
+                    'errors': 0, 'wait': 0.0}
+            counter['count'] += 1
+            counter['time'] += seconds
+            counter['max'] = max(counter['max'], seconds)
+            counter['retries'] += retries
+            counter['errors'] += error
+            counter['wait'] += wait
+
+    def attach(self, client, account_id):
+        """Time every call made by a client through its event hooks
+
+        :param client: Boto client
+        :param account_id: AWS account ID the client's credentials are for
+        """
+        service_name = client.meta.service_model.service_name
+        region_name = client.meta.region_name
+        waits = self.waits
+
+        def before_call(context=None, **kwargs):
+            if context is not None:
+                context['metrics_start'] = time.perf_counter()
+            waits.wait = 0.0
+            waits.sending = waits.retrying = None
+
+        def before_send(**kwargs):
+            # Runs before the adaptive rate limiter's before-send handler,
+            # and ends the backoff of a retry
+            now = time.perf_counter()
+            if getattr(waits, 'retrying', None) is not None:
+                waits.wait += now - waits.retrying
+            waits.sending = now
+            waits.retrying = None
+
+        def sending(**kwargs):
+            # Runs after every other before-send handler
+            if getattr(waits, 'sending', None) is not None:
+                waits.wait += time.perf_counter() - waits.sending
+                waits.sending = None
+
+        def needs_retry(**kwargs):
+            waits.retrying = time.perf_counter()
+
+        def after_call(event_name, context=None, parsed=None, **kwargs):
+            if context is None or 'metrics_start' not in context:
+                return
+            parsed = parsed or {}
+            self.record(
+                self.calls,
+                (service_name, event_name.rsplit('.', 1)[-1], region_name,
+                 account_id),
+                time.perf_counter() - context.pop('metrics_start'),
+                parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                'Error' in parsed, getattr(waits, 'wait', 0.0))
+
+        def after_call_error(event_name, context=None, **kwargs):
+            after_call(event_name, context, {'Error': {}})
+
+        client.meta.events.register('before-call', before_call)
+        client.meta.events.register_first('before-send', before_send)
+        client.meta.events.register_last('before-send', sending)
+        client.meta.events.register_last('needs-retry', needs_retry)
+        client.meta.events.register('after-call', after_call)
+        client.meta.events.register('after-call-error', after_call_error)
+
+    @staticmethod
+    def _rollup(counters, key_function):
+        rollup = {}
+        for key, counter in counters.items():
+            total = rollup.setdefault(key_function(key), {
+                'count': 0, 'time': 0.0, 'max': 0.0, 'retries': 0,
+                'errors': 0, 'wait': 0.0})
+            total['count'] += counter['count']
+            total['time'] += counter['time']
+            total['max'] = max(total['max'], counter['max'])
+            total['retries'] += counter['retries']
+            total['errors'] += counter['errors']
+            total['wait'] += counter['wait']
+        return rollup
+
+    @staticmethod
+    def _milliseconds(counters):
+        return {
+            key: dict(counter, time=round(counter['time'] * 1000, 1),
+                      max=round(counter['max'] * 1000, 1),
+                      wait=round(counter['wait'] * 1000, 1))
+            for key, counter in counters.items()}
+
+    def summary(self):
+        """Return the phase and API call timings of the invocation so far
+
+        :return: dict with duration, phases and api keys. Times are in
+            milliseconds and api breaks the calls down by_operation,
+            by_region and by account for the top_accounts accounts which
+            spent the most time in API calls
+        """
+        with self.lock:
+            phases = dict(self.phases)
+            calls = dict(self.calls)
+            duration = time.perf_counter() - self.start
+        by_account = self._rollup(calls, lambda x: x[3])
+        top_accounts = sorted(
+            by_account, key=lambda x: -by_account[x]['time'])[
+            :self.top_accounts]
+        total = self._rollup(calls, lambda x: 'total').get('total', {
+            'count': 0, 'time': 0.0, 'max': 0.0, 'retries': 0, 'errors': 0,
+            'wait': 0.0})
+        return {
+            'duration': round(duration * 1000, 1),
+            'phases': {
+                name: {'count': phase['count'], 'time': phase['time'],
+                       'max': phase['max']}
+                for name, phase in self._milliseconds(phases).items()},
+            'api': {
+                'total': self._milliseconds({'total': total})['total'],
+                'by_operation': self._milliseconds(self._rollup(
+                    calls, lambda x: '{}.{}'.format(x[0], x[1]))),
+                'by_region': self._milliseconds(self._rollup(
+                    calls, lambda x: x[2])),
+                'accounts': len(by_account),
+                'top_accounts': self._milliseconds(
+                    {x: by_account[x] for x in top_accounts}),
+            }}
+
+    def emit(self, **properties):
+        """Print the summary as a CloudWatch Embedded Metric Format document
+
+        :param properties: Extra properties to add to the document
+        :return: The document
+        """
+        summary = self.summary()
+        metrics = {
+            'Duration': summary['duration'],
+            'ApiCalls': summary['api']['total']['count'],
+            'ApiTime': summary['api']['total']['time'],
+            'ApiRetries': summary['api']['total']['retries'],
+            'ApiErrors': summary['api']['total']['errors'],
+            'ApiWaitTime': summary['api']['total']['wait'],
+        }
+        for name, phase in summary['phases'].items():
+            metrics['{}Time'.format(name)] = phase['time']
+        document = dict(properties, **summary)
+        document.update(metrics)
+        document['Function'] = os.environ.get(
+            'AWS_LAMBDA_FUNCTION_NAME', __name__.rsplit('.', 1)[-1])
+        document['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [['Function']],
+                'Metrics': [
+                    {'Name': name, 'Unit': 'Count' if name in (
+                        'ApiCalls', 'ApiRetries', 'ApiErrors')
+                        else 'Milliseconds'}
+                    for name in metrics]}]}
+        if self.namespace:
+            print(json.dumps(document, default=str), flush=True)
+        return document
+
+
+METRICS = Metrics(METRICS_NAMESPACE, METRICS_TOP_ACCOUNTS)
+
+
+def emit_metrics(function):
+    """Decorate a Lambda handler to reset METRICS before each invocation
+    and emit them after it
+
+    :param function: Lambda handler
+    :return: Decorated Lambda handler
+    """
+    @functools.wraps(function)
+    def wrapper(event, context):
+        METRICS.reset()
+        try:
+            return function(event, context)
+        finally:
+            try:
+                METRICS.emit(
+                    RequestId=getattr(context, 'aws_request_id', None))
+            except Exception as e:
+                logger.error('Failed to emit metrics : {}'.format(e))
+    return wrapper
+
+
+class ClientRegistry:
+    """Share boto clients keyed by (session, service, region)
+
+    Constructing a client loads its service model which is slow and memory
+    hungry, so each combination of session, service and region gets a single
+    client which is reused by every caller. Clients are released along with
+    the session they were created from.
+
+    There is a client for every member account in every region, so the
+    clients of member sessions (see get_member_session) are only kept in an
+    LRU of max_member_clients clients, which keeps memory flat however many
+    member accounts a run touches. Clients of the master and AWS
+    Organizations sessions are kept as long as their session.
+
+    boto3 sessions are not thread safe while the clients they create are, so
+    client creation is serialized and the resulting clients are shared across
+    threads.
+
+    Clients are created with BOTO_CONFIG's adaptive retry settings, which
+    rate limit each client once it's throttled, and their calls are timed by
+    METRICS.
+    """
+
+    def __init__(self, max_member_clients=64):
+        self.clients = weakref.WeakKeyDictionary()
+        self.default_session_clients = {}
+        self.member_clients = collections.OrderedDict()
+        self.max_member_clients = max_member_clients
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def get(self, boto_session, service_name, region_name=None):
+        """Return the shared client for the session, service and region,
+        creating it if it doesn't exist yet
+
+        :param boto_session: Boto session or None to use the default session
+        :param service_name: AWS service name (e.g. guardduty)
+        :param region_name: AWS region name
+        :return: Boto client
+        """
+        with self.lock:
+            if boto_session is not None and boto_session in MEMBER_SESSIONS:
+                key = (boto_session, service_name, region_name)
+                client = self.member_clients.get(key)
+                if client is None:
+                    client = self.member_clients[key] = self._create(
+                        boto_session, service_name, region_name)
+                    while len(self.member_clients) > self.max_member_clients:
+                        self.member_clients.popitem(last=False)
+                else:
+                    self.member_clients.move_to_end(key)
+                return client
+            clients = (self.default_session_clients if boto_session is None
+                       else self.clients.setdefault(boto_session, {}))
+            key = (service_name, region_name)
+            if key not in clients:
+                clients[key] = self._create(
+                    boto_session, service_name, region_name)
+            return clients[key]
+
+    def _create(self, boto_session, service_name, region_name):
+        if boto_session is None:
+            client = boto3.client(
+                service_name, region_name=region_name, config=BOTO_CONFIG)
+        else:
+            client = boto_session.client(
+                service_name, region_name=region_name, config=BOTO_CONFIG)
+        account_id = (
+            SESSION_ACCOUNT_IDS.get(boto_session, 'local')
+            if boto_session is not None else 'local')
+        METRICS.attach(client, account_id)
+        self.created += 1
+        return client
+
+    def size(self):
+        """Return the number of clients held
+
+        :return: int
+        """
+        with self.lock:
+            return (len(self.default_session_clients)
+                    + sum(len(x) for x in self.clients.values())
+                    + len(self.member_clients))
+
+
+CLIENT_REGISTRY = ClientRegistry(MEMBER_CLIENT_CACHE_SIZE)
+
+
+def get_client(boto_session, service_name, region_name=None):
+    """Return a shared boto client from CLIENT_REGISTRY
+
+    :param boto_session: Boto session or None to use the default session
+    :param service_name: AWS service name (e.g. guardduty)
+    :param region_name: AWS region name
+    :return: Boto client
+    """
+    return CLIENT_REGISTRY.get(boto_session, service_name, region_name)
+
+
+def run_concurrently(function, items, max_workers):
+    """Call function once for each item using a bounded pool of threads,
+    capturing the result or the exception raised for each item so that one
+    failing item doesn't affect the others
+
+    :param function: Callable accepting a single item
+    :param items: Iterable of hashable items
+    :param max_workers: Maximum number of concurrent calls
+    :return: dict with item keys and (result, exception) tuple values
+    """
+    items = list(items)
+    results = {}
+    if not items:
+        return results
+    with ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(items)))) as executor:
+        futures = {executor.submit(function, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = (future.result(), None)
+            except Exception as e:
+                results[futures[future]] = (None, e)
+    return results
+
+
+class SessionCache:
+    """Cache boto sessions for assumed IAM Roles keyed by role ARN
+
+    Sessions are reused until they are within refresh_margin seconds of the
+    expiration of their credentials, at which point the role is assumed
+    again. Concurrent requests for the same role ARN wait for a single
+    AssumeRole call instead of each making their own.
+
+    Sessions are dropped once their credentials expire and, when max_size is
+    set, the least recently used sessions are dropped to keep at most
+    max_size of them.
+    """
+
+    def __init__(self, refresh_margin=120, max_size=None):
+        self.refresh_margin = refresh_margin
+        self.max_size = max_size
+        self.sessions = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.role_locks = {}
+
+    def get(self, role_arn, create_session):
+        """Return a cached session for role_arn or create a new one
+
+        :param role_arn: An ARN of an AWS IAM role or None
+        :param create_session: Callable which accepts role_arn and returns a
+                               tuple of a boto session and the epoch time at
+                               which its credentials expire (or None)
+        :return: Boto session
+        """
+        with self.lock:
+            role_lock = self.role_locks.setdefault(role_arn, threading.Lock())
+        with role_lock:
+            with self.lock:
+                boto_session, expiration = self.sessions.get(
+                    role_arn, (None, None))
+                if boto_session is not None and not self._expired(
+                        expiration, time.time()):
+                    self.sessions.move_to_end(role_arn)
+                    self.hits += 1
+                    return boto_session
+            boto_session, expiration = create_session(role_arn)
+            with self.lock:
+                self.sessions[role_arn] = (boto_session, expiration)
+                self.sessions.move_to_end(role_arn)
+                self._evict(time.time())
+                self.misses += 1
+            return boto_session
+
+    def _expired(self, expiration, now):
+        return (expiration is not None
+                and expiration - self.refresh_margin <= now)
+
+    def _evict(self, now):
+        """Drop the expired sessions and then the least recently used ones
+        beyond max_size, with self.lock held
+
+        :param now: Epoch time
+        """
+        for role_arn in [k for k, (_, expiration) in self.sessions.items()
+                         if self._expired(expiration, now)]:
+            del self.sessions[role_arn]
+            self.role_locks.pop(role_arn, None)
+        while self.max_size is not None and len(self.sessions) > self.max_size:
+            role_arn, _ = self.sessions.popitem(last=False)
+            self.role_locks.pop(role_arn, None)
+
+    def stats(self):
+        """Return the hit and miss counters
+
+        :return: dict with hits and misses keys
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()
+            self.role_locks.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+SESSION_CACHE = SessionCache()
+# Member roles are assumed in every region, and in many accounts at once, so
+# only the most recently used member sessions are kept
+MEMBER_SESSION_CACHE = SessionCache(max_size=MEMBER_SESSION_CACHE_SIZE)
+
+
+# botocore's loader of its data files and service models. Each botocore
+# session otherwise parses the endpoints and the service models again for its
+# first client, so one loader is shared by every session of the container.
+DATA_LOADER = botocore.loaders.create_loader(os.environ.get('AWS_DATA_PATH'))
+
+
+def new_boto_session(**kwargs):
+    """Return a new boto session which shares DATA_LOADER
+
+    :param kwargs: boto3.session.Session arguments
     :return: Boto session
     """
+    botocore_session = botocore.session.get_session()
+    botocore_session.register_component('data_loader', DATA_LOADER)
+    return boto3.session.Session(botocore_session=botocore_session, **kwargs)
+
+
+@METRICS.timed('AssumeRole')
+def create_session(role_arn=None):
+    """Return a new boto session either for the current IAM Role or for an
+    assumed role if role_arn is passed, along with the time at which the
+    session's credentials expire
+
+    :param role_arn: An ARN of an AWS IAM role to assume
+    :return: tuple of a Boto session and the epoch time at which the assumed
+             role credentials expire or None if they don't expire
+    """
     if role_arn is not None:
-        client = boto3.client('sts')
+        client = get_client(None, 'sts')
         try:
             credentials = client.assume_role(
                 RoleArn=role_arn,
                 RoleSessionName='GuardDutyMultiAccountManager',
                 DurationSeconds=900
             )['Credentials']
-            boto_session = boto3.session.Session(
+            boto_session = new_boto_session(
                 aws_access_key_id=credentials['AccessKeyId'],
                 aws_secret_access_key=credentials['SecretAccessKey'],
                 aws_session_token=credentials['SessionToken']
@@ -82,13 +730,119 @@ def get_session(role_arn=None):
         except:
             logging.error('Failed to assume role %s' % role_arn)
             raise
+        SESSION_ACCOUNT_IDS[boto_session] = role_arn.split(':')[4]
+        return boto_session, credentials['Expiration'].timestamp()
     else:
-        boto_session = boto3.session.Session()
-    return boto_session
+        return new_boto_session(), None
+
+
+def get_session(role_arn=None):
+    """Return a boto session either for the current IAM Role or for an assumed
+    role if role_arn is passed
+
+    Sessions are cached in SESSION_CACHE so that each role is assumed once
+    and reused across regions and warm invocations until shortly before its
+    credentials expire. Member account roles are assumed with
+    get_member_session instead.
+
+    :param role_arn: An ARN of an AWS IAM role to assume
+    :return: Boto session
+    """
+    return SESSION_CACHE.get(role_arn, create_session)
+
+
+def create_member_session(role_arn):
+    """Return a new session for a member account IAM Role, as create_session
+    does, whose clients are only kept in ClientRegistry's member LRU
+
+    :param role_arn: An ARN of the IAM Role to assume in the member account
+    :return: tuple of a Boto session and the epoch time at which the assumed
+             role credentials expire
+    """
+    boto_session, expiration = create_session(role_arn)
+    MEMBER_SESSIONS.add(boto_session)
+    return boto_session, expiration
+
+
+def get_member_session(role_arn):
+    """Return a boto session for an assumed member account IAM Role
+
+    Sessions are cached in MEMBER_SESSION_CACHE, which only keeps the most
+    recently used ones, so that the cache doesn't grow with the number of
+    member accounts.
+
+    :param role_arn: An ARN of the IAM Role to assume in the member account
+    :return: Boto session
+    """
+    return MEMBER_SESSION_CACHE.get(role_arn, create_member_session)
+
+
+def prewarm_clients():
+    """Create the clients used by every invocation so that the botocore
+    data files and service models are loaded during the Lambda init phase
+    """
+    try:
+        get_client(None, 'sts')
+        if os.environ.get('MANAGER_IAM_ROLE_ARN') is None:
+            get_client(get_session(), 'dynamodb', 'us-west-2')
+    except Exception as e:
+        logger.warning('Failed to create clients at init : {}'.format(e))
+
+
+if PREWARM_CLIENTS:
+    prewarm_clients()
+
+
+class StateStore:
+    """Persist JSON serializable state between runs in a DynamoDB table
+
+    Each value is stored zlib compressed in the state attribute of an item
+    keyed by the state-key attribute so that large maps fit within the
+    DynamoDB item size limit.
+    """
+
+    def __init__(self, boto_session, table_name, region_name):
+        self.client = get_client(boto_session, 'dynamodb', region_name)
+        self.table_name = table_name
+
+    @METRICS.timed('StateLoad')
+    def get(self, key):
+        """Return the value stored under key or None if it doesn't exist
+
+        :param key: State key
+        :return: Stored value or None
+        """
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={'state-key': {'S': key}},
+            ConsistentRead=True).get('Item')
+        if item is None:
+            return None
+        return json.loads(zlib.decompress(item['state']['B']))
+
+    @METRICS.timed('StateSave')
+    def put(self, key, value):
+        """Store value under key
+
+        :param key: State key
+        :param value: JSON serializable value
+        """
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={
+                'state-key': {'S': key},
+                'state': {'B': zlib.compress(
+                    json.dumps(value, sort_keys=True).encode('utf-8'))},
+                'updated': {'N': str(int(time.time()))}})
+
+    def delete(self, key):
+        self.client.delete_item(
+            TableName=self.table_name,
+            Key={'state-key': {'S': key}})
 
 
 def create_detector(boto_session, region_name, account_id=''):
-    gd = boto_session.client('guardduty', region_name=region_name)
+    gd = get_client(boto_session, 'guardduty', region_name)
     response = gd.create_detector(
         Enable=True,
         # FindingPublishingFrequency='FIFTEEN_MINUTES'
@@ -102,7 +856,7 @@ def create_detector(boto_session, region_name, account_id=''):
 
 
 def get_all_detectors(boto_session, region_name):
-    gd = boto_session.client('guardduty', region_name=region_name)
+    gd = get_client(boto_session, 'guardduty', region_name)
     response = gd.list_detectors()
     return response
 
@@ -124,7 +878,7 @@ def get_account_id_email_map_from_organizations(boto_session, region_name):
     :param region_name: AWS region name
     :return: dict with account ID keys and email address values
     """
-    client = boto_session.client('organizations', region_name=region_name)
+    client = get_client(boto_session, 'organizations', region_name)
     paginator = client.get_paginator('list_accounts')
     accounts = []
     list(map(accounts.extend, [x['Accounts'] for x in paginator.paginate()]))
@@ -132,6 +886,288 @@ def get_account_id_email_map_from_organizations(boto_session, region_name):
     return account_map
 
 
+def organization_cache_key(org_arn):
+    return 'organizations/{}'.format(org_arn or 'local')
+
+
+@METRICS.timed('OrganizationFetch')
+def get_organizations_account_id_map(org_arn_list, region_name,
+                                     state_store=None):
+    """Fetch the account map of each AWS Organization concurrently, using the
+    cached map of an organization when it's younger than
+    ORGANIZATION_CACHE_TTL
+
+    Maps are cached in the state_store under organizations/<role ARN> keys.
+    An organization's role is only assumed when its map is fetched.
+
+    :param org_arn_list: List of IAM Role ARNs to assume to reach AWS
+                         Organization parent accounts, or [None] to use the
+                         current account
+    :param region_name: AWS region name
+    :param state_store: StateStore to cache the account maps in or None
+    :return: dict with account ID keys and email address values
+    """
+    def get_account_map(org_arn):
+        key = organization_cache_key(org_arn)
+        cached = state_store.get(key) if state_store is not None else None
+        if cached is not None and (
+                cached['updated'] + ORGANIZATION_CACHE_TTL > time.time()):
+            logger.debug('Using cached account map of {} from {}'.format(
+                key, cached['updated']))
+            return cached['accounts']
+        account_map = get_account_id_email_map_from_organizations(
+            get_session(org_arn), region_name=region_name)
+        if state_store is not None:
+            state_store.put(key, {'accounts': account_map,
+                                  'updated': int(time.time())})
+        return account_map
+
+    results = run_concurrently(
+        get_account_map, org_arn_list, MAX_REGION_WORKERS)
+    organizations_account_id_map = {}
+    for org_arn in org_arn_list:
+        account_map, error = results[org_arn]
+        if error is not None:
+            raise error
+        organizations_account_id_map.update(account_map)
+    return organizations_account_id_map
+
+
+def invalidate_organization_cache(event, org_arn_list, state_store):
+    """Drop the cached account maps which an AWS Organizations CloudTrail
+    event, delivered by EventBridge, shows to be out of date
+
+    Only the map of the organization whose management account the event came
+    from is dropped when it can be identified, otherwise every map is.
+
+    :param event: EventBridge event
+    :param org_arn_list: List of IAM Role ARNs to reach AWS Organization
+                         parent accounts, or [None]
+    :param state_store: StateStore the account maps are cached in
+    :return: List of IAM Role ARNs whose cached maps were dropped
+    """
+    event_name = event.get('detail', {}).get('eventName')
+    if event_name not in ORGANIZATION_ACCOUNT_EVENTS:
+        return []
+    invalidated = [x for x in org_arn_list
+                   if x is not None and x.split(':')[4] == event.get(
+                       'account')] or org_arn_list
+    for org_arn in invalidated:
+        state_store.delete(organization_cache_key(org_arn))
+    logger.info('Invalidated cached account maps {} after {}'.format(
+        invalidated, event_name))
+    return invalidated
+
+
+# Regions enabled in each account, fetched by this container, keyed by
+# account ID with (fetched time, region list) values
+ENABLED_REGIONS = {}
+# The latest health record of each region, see update_region_health
+REGION_HEALTH = {}
+
+
+@METRICS.timed('RegionDiscovery')
+def get_enabled_regions(boto_session, account_id, region_name,
+                        state_store=None):
+    """Return the GuardDuty regions which are enabled in an account
+
+    botocore's list of GuardDuty regions includes the opt-in regions, which
+    can't be called until they're enabled in the account. The regions
+    enabled in the account are fetched with EC2 DescribeRegions and cached
+    in this container, and in the state table if there is one, for
+    REGION_CACHE_TTL seconds. If they can't be fetched every GuardDuty region
+    is used.
+
+    Regions in REGION_ALLOW_LIST are always used and regions in
+    REGION_DENY_LIST are never used.
+
+    :param boto_session: Boto session of the account
+    :param account_id: AWS account ID of the session
+    :param region_name: Region to call DescribeRegions in
+    :param state_store: StateStore to cache the regions in or None
+    :return: List of region names
+    """
+    available = boto_session.get_available_regions('guardduty')
+    key = 'regions/{}'.format(account_id)
+    fetched, enabled = ENABLED_REGIONS.get(account_id, (0, None))
+    if fetched + REGION_CACHE_TTL < time.time() and state_store is not None:
+        cached = state_store.get(key)
+        if cached is not None:
+            fetched, enabled = cached['fetched'], cached['regions']
+    if fetched + REGION_CACHE_TTL < time.time():
+        try:
+            # Without AllRegions only the enabled regions are returned
+            enabled = [x['RegionName'] for x in get_client(
+                boto_session, 'ec2', region_name).describe_regions()[
+                'Regions']]
+        except ClientError as e:
+            logger.warning('{} : Failed to fetch the enabled regions, using '
+                           'every GuardDuty region : {}'.format(
+                               account_id, e))
+            enabled = None
+        else:
+            fetched = int(time.time())
+            if state_store is not None:
+                state_store.put(key, {'fetched': fetched, 'regions': enabled})
+        ENABLED_REGIONS[account_id] = (fetched, enabled)
+    allowed = set(REGION_ALLOW_LIST.split())
+    denied = set(REGION_DENY_LIST.split())
+    regions = [
+        x for x in available
+        if (enabled is None or x in enabled or x in allowed)
+        and x not in denied]
+    skipped = [x for x in available if x not in regions]
+    if skipped:
+        logger.debug('{} : Skipping regions which aren\'t enabled or are '
+                     'denied : {}'.format(account_id, skipped))
+    return regions
+
+
+def load_region_health(state_store=None):
+    """Return the health record of each region, from the state table if
+    there is one, or else from this container's previous runs
+
+    :param state_store: StateStore or None
+    :return: dict with region name keys and dict values with duration,
+             api_latency, failures and updated keys
+    """
+    if state_store is not None:
+        REGION_HEALTH.update(state_store.get('regions/health') or {})
+    return REGION_HEALTH
+
+
+def schedule_regions(regions, health):
+    """Order regions so that the slowest are started first
+
+    Regions are processed by a bounded pool of workers in the order they're
+    submitted, so starting the slowest regions first keeps a slow region
+    from being left to run alone at the end of the run. Regions without a
+    health record are started first as their duration is unknown.
+
+    :param regions: List of region names
+    :param health: dict of region health records
+    :return: List of region names
+    """
+    return sorted(
+        regions, key=lambda x: (x in health, -health.get(x, {}).get(
+            'duration', 0)))
+
+
+def update_region_health(health, results, state_store=None):
+    """Record the duration, average API call latency and consecutive
+    failures of each region reconciled in a run
+
+    Regions skipped by a delta run, or where it only reconciled the changed
+    accounts, keep their previous duration.
+
+    :param health: dict of region health records to update
+    :param results: dict with region name keys and (region summary,
+                    exception) tuple values
+    :param state_store: StateStore to save the records in or None
+    :return: health
+    """
+    api_by_region = METRICS.summary()['api']['by_region']
+    now = int(time.time())
+    for region_name, (region_summary, error) in results.items():
+        record = dict(health.get(region_name, {}), updated=now)
+        api = api_by_region.get(region_name)
+        if api and api['count']:
+            record['api_latency'] = round(api['time'] / api['count'], 1)
+        if error is not None:
+            record['failures'] = record.get('failures', 0) + 1
+        else:
+            record['failures'] = 0
+            if not region_summary.get('skipped') and (
+                    'changed_accounts' not in region_summary):
+                record['duration'] = region_summary.get('duration', 0)
+        health[region_name] = record
+    if state_store is not None:
+        state_store.put('regions/health', health)
+    return health
+
+
+def iter_member_role_items(boto_session, region_name):
+    """Yield the GuardDuty member role items of the cross account outputs
+    table inserted with
+    https://github.com/mozilla/cloudformation-cross-account-outputs
+
+    The category filter and the projection are done by DynamoDB so that only
+    the GuardDuty rows are returned and deserialized. If a category index is
+    configured in DYNAMODB_CATEGORY_INDEX_NAME it's queried, otherwise the
+    table is scanned in DYNAMODB_SCAN_SEGMENTS parallel segments. Items are
+    yielded page by page as they arrive rather than collected in a list.
+
+    :param boto_session: boto3 session
+    :param region_name: Region of the table
+    :return: generator of dicts with aws-account-id and
+             GuardDutyMemberAccountIAMRoleArn keys
+    """
+    client = get_client(boto_session, 'dynamodb', region_name)
+    operation_name = 'Query' if DYNAMODB_CATEGORY_INDEX_NAME else 'Scan'
+    # Imported here as only the role map and stream handling need them
+    from boto3.dynamodb.transform import TransformationInjector
+    from boto3.dynamodb.types import TypeDeserializer
+    service_model = client._service_model.operation_model(operation_name)
+    trans = TransformationInjector(deserializer=TypeDeserializer())
+    arguments = {
+        'TableName': DYNAMODB_TABLE_NAME,
+        'ProjectionExpression': '#account_id, #role_arn',
+        'ExpressionAttributeNames': {
+            '#category': 'category',
+            '#account_id': 'aws-account-id',
+            '#role_arn': 'GuardDutyMemberAccountIAMRoleArn'},
+        'ExpressionAttributeValues': {':category': {'S': DB_CATEGORY}}}
+    if DYNAMODB_CATEGORY_INDEX_NAME:
+        arguments['IndexName'] = DYNAMODB_CATEGORY_INDEX_NAME
+        arguments['KeyConditionExpression'] = '#category = :category'
+        page_iterators = [iter(
+            client.get_paginator('query').paginate(**arguments))]
+    else:
+        arguments['FilterExpression'] = '#category = :category'
+        segments = max(DYNAMODB_SCAN_SEGMENTS, 1)
+        segment_arguments = (
+            [{'Segment': x, 'TotalSegments': segments}
+             for x in range(segments)] if segments > 1 else [{}])
+        page_iterators = [
+            iter(client.get_paginator('scan').paginate(**arguments, **x))
+            for x in segment_arguments]
+
+    for page in iter_pages_concurrently(page_iterators):
+        # Only deserialize the items, the paginator sends LastEvaluatedKey
+        # back as the next ExclusiveStartKey once the page is consumed
+        items_page = {'Items': page['Items']}
+        trans.inject_attribute_value_output(items_page, service_model)
+        for item in items_page['Items']:
+            yield item
+
+
+def iter_pages_concurrently(page_iterators):
+    """Yield the pages of several page iterators, fetching the next page of
+    every iterator concurrently
+
+    Only one page per iterator is in flight at a time so memory use is
+    bounded by the number of iterators, not the number of pages.
+
+    :param page_iterators: list of iterators of pages
+    :return: generator of pages in the order they arrive
+    """
+    if len(page_iterators) == 1:
+        yield from page_iterators[0]
+        return
+    with ThreadPoolExecutor(max_workers=len(page_iterators)) as executor:
+        futures = {executor.submit(next, x, None): x for x in page_iterators}
+        while futures:
+            future = next(as_completed(futures))
+            page_iterator = futures.pop(future)
+            page = future.result()
+            if page is None:
+                continue
+            futures[executor.submit(next, page_iterator, None)] = (
+                page_iterator)
+            yield page
+
+
+@METRICS.timed('RoleMapScan')
 def get_account_role_map(boto_session, region_name):
     """Fetch the ARNs of all the IAM Roles which people have created in other
     AWS accounts which are inserted into DynamoDB with
@@ -139,115 +1175,1307 @@ def get_account_role_map(boto_session, region_name):
 
     :return: dict with account ID keys and IAM Role ARN values
     """
+    return {x['aws-account-id']: x['GuardDutyMemberAccountIAMRoleArn']
+            for x in iter_member_role_items(boto_session, region_name)
+            if {'aws-account-id', 'GuardDutyMemberAccountIAMRoleArn'}
+            <= set(x)}
 
-    client = boto_session.client('dynamodb', region_name=region_name)
 
-    paginator = client.get_paginator('scan')
-    service_model = client._service_model.operation_model('Scan')
-    trans = TransformationInjector(deserializer=TypeDeserializer())
-    items = []
-    for page in paginator.paginate(TableName=DYNAMODB_TABLE_NAME):
-        trans.inject_attribute_value_output(page, service_model)
-        items.extend([x for x in page['Items']])
+@METRICS.timed('MasterTearDown')
+def tear_down_master_region(local_boto_session, region_name, account_ids):
+    """Delete account_ids from the members of the master detector in a region
+
+    :param local_boto_session: Boto session for the GuardDuty master
+    :param region_name: AWS region name
+    :param account_ids: List of account IDs
+    :return: dict with the master detector ID (or None if the master has no
+             detector in the region) and the accounts which weren't deleted
+    """
+    detector_ids = get_all_detectors(
+        local_boto_session, region_name)['DetectorIds']
+    if not detector_ids:
+        # Without a master detector there are no members to delete
+        return {'detector_id': None, 'unprocessed': {}}
+    client = get_client(local_boto_session, 'guardduty', region_name)
+    unprocessed = call_in_batches(
+        client.delete_members, account_ids, 'AccountIds',
+        DetectorId=detector_ids[0])
+    log_unprocessed(region_name, 'delete', unprocessed)
+    logger.info('{} : Deleted members {} from master detector {}'.format(
+        region_name, account_ids, detector_ids[0]))
+    return {'detector_id': detector_ids[0],
+            'unprocessed': {x['AccountId']: x['Result'] for x in unprocessed}}
 
-    return {x['aws-account-id']: x['GuardDutyMemberAccountIAMRoleArn']
-            for x in items
-            if x.get('category') == DB_CATEGORY
-            and {'aws-account-id',
-                 'GuardDutyMemberAccountIAMRoleArn'} <= set(x)}
 
+@METRICS.timed('MemberTearDown')
+def tear_down_member_region(region_name, account_id, role_arn,
+                            local_account_id):
+    """Disassociate and delete the detectors of a member account in a region
+    and delete its invitations from the master
 
-def tear_down_members(account_ids):
+    :param region_name: AWS region name
+    :param account_id: AWS account ID of the member
+    :param role_arn: ARN of the IAM Role to assume in the member account
+    :param local_account_id: AWS account ID of the GuardDuty master
+    :return: List of the actions taken
+    """
+    member_boto_session = get_member_session(role_arn)
+    member_client = get_client(member_boto_session, 'guardduty', region_name)
+    taken = []
+    for member_detector_id in get_all_detectors(
+            member_boto_session, region_name)['DetectorIds']:
+        try:
+            member_client.disassociate_from_master_account(
+                DetectorId=member_detector_id)
+            taken.append('disassociated')
+            logger.info(
+                '{} : {} : Disassociated member detector id {} from '
+                'master'.format(region_name, account_id, member_detector_id))
+        except ClientError as e:
+            # The detector may not be associated with a master
+            logger.info(
+                '{} : {} : Didn\'t disassociate member detector id {} : '
+                '{}'.format(region_name, account_id, member_detector_id, e))
+        member_client.delete_detector(DetectorId=member_detector_id)
+        taken.append('deleted_detector')
+        logger.info('{} : {} : Deleted member detector id {}'.format(
+            region_name, account_id, member_detector_id))
+    member_client.delete_invitations(AccountIds=[local_account_id])
+    taken.append('deleted_invitations')
+    logger.info('{} : {} : Deleted invitations from master {}'.format(
+        region_name, account_id, local_account_id))
+    return taken
+
+
+def tear_down_members(account_ids, job_id=None):
+    """Remove accounts from GuardDuty in every region
+
+    In each region the accounts are deleted from the members of the master
+    detector in batches, then in each member account the detectors are
+    disassociated and deleted and the master's invitations are deleted. The
+    regions, and then the (region, account) pairs, are processed
+    concurrently with a single cached session per member account.
+
+    If STATE_TABLE_NAME is set, a report of the result of every region and
+    every pair is written to the teardown/<job_id> state key as the work
+    progresses. Calling tear_down_members again with the same job_id skips
+    the regions and pairs which already succeeded, so a teardown which
+    failed or timed out can be resumed.
+
+    :param account_ids: List of AWS account IDs to remove
+    :param job_id: Identifier of the teardown. Defaults to a hash of the
+                   account IDs
+    :return: dict report with masters and pairs keys
+    """
+    account_ids = sorted(set(account_ids))
+    job_id = job_id or hashlib.sha256(
+        ' '.join(account_ids).encode('utf-8')).hexdigest()[:16]
     local_boto_session = get_session(os.environ.get('MANAGER_IAM_ROLE_ARN'))
-    local_account_id = boto3.client('sts').get_caller_identity()["Account"]
-    guardduty_regions = local_boto_session.get_available_regions('guardduty')
+    local_account_id = get_client(
+        None, 'sts').get_caller_identity()["Account"]
     account_id_role_arn_map = get_account_role_map(
         local_boto_session, 'us-west-2')
-    for region_name in guardduty_regions:
-        detector_id = get_all_detectors(
-            local_boto_session, region_name)['DetectorIds'][0]
-        client = local_boto_session.client(
-            'guardduty', region_name=region_name)
-        client.delete_members(
-            AccountIds=account_ids,
-            DetectorId=detector_id
-        )
-        logger.info('{}: Deleted member {} from master detector {}'.format(
-            region_name, account_ids, detector_id))
-
-        for account_id in account_ids:
-            member_boto_session = get_session(
-                account_id_role_arn_map[account_id])
-            member_client = member_boto_session.client(
-                'guardduty', region_name=region_name)
-            for member_detector_id in get_all_detectors(
-                    member_boto_session, region_name)['DetectorIds']:
-                try:
-                    member_client.disassociate_from_master_account(
-                        DetectorId=member_detector_id)
-                    logger.info(
-                        '{}: {} : Dissasociated member dector id {} from '
-                        'master'.format(
-                            region_name, account_id, member_detector_id))
-                except:
-                    pass
+
+    state_store = None
+    report = None
+    if STATE_TABLE_NAME:
+        state_store = StateStore(
+            local_boto_session, STATE_TABLE_NAME, 'us-west-2')
+        report = state_store.get('teardown/{}'.format(job_id))
+    guardduty_regions = get_enabled_regions(
+        local_boto_session, local_account_id, 'us-west-2', state_store)
+    report = report or {'account_ids': account_ids, 'masters': {},
+                        'pairs': {}}
+    report_lock = threading.Lock()
+
+    def save_report():
+        if state_store is not None:
+            with report_lock:
+                state_store.put('teardown/{}'.format(job_id), report)
+
+    def succeeded(results, key):
+        return results.get(key, {}).get('status') == 'succeeded'
+
+    # Delete the members from the master detector in each region
+    regions = [x for x in guardduty_regions
+               if not succeeded(report['masters'], x)]
+    results = run_concurrently(
+        lambda region_name: tear_down_master_region(
+            local_boto_session, region_name, account_ids),
+        regions, MAX_REGION_WORKERS)
+    for region_name, (result, error) in results.items():
+        if error is not None:
+            logger.error('{} : Failed to delete members : {}'.format(
+                region_name, error))
+            report['masters'][region_name] = {
+                'status': 'failed', 'error': repr(error)}
+        else:
+            report['masters'][region_name] = dict(
+                result, status='failed' if result['unprocessed']
+                else 'succeeded')
+    save_report()
+
+    # Clean up the detectors and invitations in each member account
+    pairs = []
+    for account_id in account_ids:
+        if account_id not in account_id_role_arn_map:
+            logger.error('{} : No IAM Role to tear down member'.format(
+                account_id))
+        for region_name in guardduty_regions:
+            key = '{}/{}'.format(region_name, account_id)
+            if succeeded(report['pairs'], key):
+                continue
+            if account_id in account_id_role_arn_map:
+                pairs.append((region_name, account_id))
+            else:
+                report['pairs'][key] = {
+                    'status': 'failed', 'error': 'No IAM Role for account'}
+    finished = 0
+    if pairs:
+        with ThreadPoolExecutor(max_workers=max(
+                1, min(MAX_ACCOUNT_WORKERS, len(pairs)))) as executor:
+            futures = {
+                executor.submit(
+                    tear_down_member_region, region_name, account_id,
+                    account_id_role_arn_map[account_id], local_account_id):
+                (region_name, account_id)
+                for region_name, account_id in pairs}
+            for future in as_completed(futures):
+                region_name, account_id = futures[future]
                 try:
-                    member_client.delete_detector(
-                        DetectorId=member_detector_id)
-                    logger.info(
-                        '{}: {} : Deleted member detector id {}'.format(
-                            region_name, account_id, member_detector_id))
-                except:
-                    pass
-            member_client.delete_invitations(AccountIds=[local_account_id])
-            logger.info(
-                '{}: {} : Invitation from {} deleted'.format(
-                    region_name, account_id, local_account_id))
+                    result = {'status': 'succeeded',
+                              'actions': future.result()}
+                except Exception as e:
+                    logger.error('{} : {} : Failed to tear down member : '
+                                 '{}'.format(region_name, account_id, e))
+                    result = {'status': 'failed', 'error': repr(e)}
+                with report_lock:
+                    report['pairs'][
+                        '{}/{}'.format(region_name, account_id)] = result
+                finished += 1
+                if finished % TEARDOWN_CHECKPOINT_INTERVAL == 0:
+                    save_report()
+    save_report()
+
+    failed = (
+        [x for x, y in report['masters'].items() if y['status'] != 'succeeded']
+        + [x for x, y in report['pairs'].items() if y['status'] != 'succeeded'])
+    logger.info('Teardown {} : {} regions and {} pairs : {} failed'.format(
+        job_id, len(report['masters']), len(report['pairs']), len(failed)))
+    return report
+
+
+def get_changed_account_ids(snapshot, organizations_account_id_map,
+                            account_id_role_arn_map):
+    """Compare the account maps to those in a previous run's snapshot
+
+    :param snapshot: dict with account_emails and account_roles keys from a
+                     previous run or None
+    :param organizations_account_id_map: dict of account IDs and emails
+    :param account_id_role_arn_map: dict of account IDs and IAM Role ARNs
+    :return: Set of account IDs which were added, removed or changed since
+             the snapshot, or None if there is no snapshot to compare to
+    """
+    if snapshot is None:
+        return None
+    changed = set()
+    for previous, current in (
+            (snapshot['account_emails'], organizations_account_id_map),
+            (snapshot['account_roles'], account_id_role_arn_map)):
+        changed.update(
+            k for k in set(previous) | set(current)
+            if previous.get(k) != current.get(k))
+    return changed
+
+
+def region_has_pending_members(members, account_ids):
+    """Determine if any of the accounts still need work in a region
+
+    :param members: dict of member account IDs and RelationshipStatus values
+    :param account_ids: Account IDs which should be ENABLED members
+    :return: True if any of the accounts is missing or not ENABLED
+    """
+    return any(members.get(x, '').lower() != 'enabled' for x in account_ids)
+
+
+def get_delta_account_ids(previous, account_ids, changed_account_ids):
+    """Return the accounts a delta run needs to reconcile in a region
+
+    A region without recorded member statuses, or where an account which
+    hasn't changed since the snapshot still needs work, has changed and all
+    of its accounts are reconciled. In any other region only the changed
+    accounts are.
+
+    :param previous: dict with the members recorded for the region or None
+    :param account_ids: Set of the account IDs which should be members
+    :param changed_account_ids: Set of the account IDs which changed since
+                                the snapshot
+    :return: Set of account IDs or None if the region can be skipped
+    """
+    if previous is None or region_has_pending_members(
+            previous['members'], account_ids - changed_account_ids):
+        return account_ids
+    return (account_ids & changed_account_ids) or None
+
+
+@METRICS.timed('MemberReconcile')
+def reconcile_member(region_name, account_id, actions, role_arn,
+                     local_account_id, status=None):
+    """Move a single member account towards a functioning member master
+    relationship from within the member account
+
+    :param region_name: AWS region name
+    :param account_id: Member AWS account ID
+    :param actions: List of actions planned for the member by MemberPlan
+    :param role_arn: ARN of the IAM Role to assume in the member account
+    :param local_account_id: AWS account ID of the GuardDuty master
+    :param status: RelationshipStatus of the member reported by the master
+    :return: List of the actions taken in the member account
+    """
+    taken = []
+    boto_session = get_member_session(role_arn)
+    member_client = get_client(boto_session, 'guardduty', region_name)
+    # Get or create a detector in the member account
+    detector_id = find_or_create_detector(
+        boto_session, region_name, account_id)
+    if 're_enable' in actions:
+        # For DISABLED members
+        # Update member account detector to enabled
+        member_client.update_detector(
+            DetectorId=detector_id,
+            Enable=True)
+        taken.append('re_enabled')
+        logger.info(
+            '{} : {} : Member updated to re-enable detector'.format(
+                region_name, account_id))
+    if 'accept' in actions:
+        # For members with a pending invitation
+        # Accept the invitation in the member account
+        response = member_client.list_invitations()
+        invitation_id = next((
+            x['InvitationId'] for x in response['Invitations']
+            if x['AccountId'] == local_account_id), None)
+        if invitation_id is not None:
+            member_client.accept_invitation(
+                DetectorId=detector_id,
+                InvitationId=invitation_id,
+                MasterId=local_account_id)
+            taken.append('accepted')
+            logger.info('{} : {} : Accepted member invite on their'
+                        ' behalf'.format(region_name, account_id))
+        else:
+            logger.error(
+                '{} : {} : GuardDuty parent reports member '
+                'RelationshipStatus of {} however member reports '
+                'pending invitations of {}'.format(
+                    region_name, account_id, status,
+                    response['Invitations']))
+    return taken
+
+
+@METRICS.timed('MemberListing')
+def get_region_members(client, detector_id):
+    """Fetch the GuardDuty members of a master detector
+
+    :param client: GuardDuty boto client for the master's region
+    :param detector_id: Master detector ID
+    :return: dict of member account IDs and RelationshipStatus values
+    """
+    return {
+        member['AccountId']: member['RelationshipStatus']
+        for page in client.get_paginator('list_members').paginate(
+            DetectorId=detector_id, OnlyAssociated="FALSE")
+        for member in page['Members']}
+
+
+def call_in_batches(method, items, items_argument, **kwargs):
+    """Call a GuardDuty member management method for items in batches which
+    fit the API limit
+
+    :param method: Boto client method (e.g. client.invite_members)
+    :param items: List of account IDs or account details
+    :param items_argument: Name of the argument to pass the items in
+    :param kwargs: Additional arguments to pass to method
+    :return: List of UnprocessedAccounts from all of the calls
+    """
+    unprocessed = []
+    for batch in chunks(items):
+        kwargs[items_argument] = batch
+        unprocessed.extend(method(**kwargs).get('UnprocessedAccounts', []))
+    return unprocessed
+
+
+def log_unprocessed(region_name, action, unprocessed):
+    for account in unprocessed:
+        logger.error('{} : {} : Failed to {} member : {}'.format(
+            region_name, account['AccountId'], action, account['Result']))
+
+
+@METRICS.timed('RegionReconcile')
+def reconcile_region(local_boto_session, region_name, local_account_id,
+                     organizations_account_id_map, account_id_role_arn_map,
+                     state_store=None, delta=False, region_wide=True,
+                     changed_account_ids=()):
+    """Move all accounts towards a functioning member master relationship in
+    a single region
+
+    Member accounts are processed concurrently, bounded by
+    MAX_ACCOUNT_WORKERS, and a failure in one member account is recorded in
+    the summary without affecting the other member accounts. Only accounts
+    whose member status calls for it are acted on in the member account.
+
+    If a state_store is passed, the member statuses are recorded in it after
+    the region is reconciled. If delta is True only the accounts returned by
+    get_delta_account_ids are reconciled, and if there are none the region
+    is skipped without any API calls.
+
+    :param local_boto_session: Boto session for the GuardDuty master
+    :param region_name: AWS region name
+    :param local_account_id: AWS account ID of the GuardDuty master
+    :param organizations_account_id_map: dict of account IDs and emails
+    :param account_id_role_arn_map: dict of account IDs and IAM Role ARNs
+    :param state_store: StateStore to record member statuses in or None
+    :param delta: Whether to only reconcile the accounts which changed since
+                  the recorded member statuses
+    :param region_wide: Whether to delete and invite members of the region
+                        outside of the passed accounts, see MemberPlan
+    :param changed_account_ids: Account IDs which changed since the previous
+                                run, see get_changed_account_ids
+    :return: dict summarizing the actions taken in the region
+    """
+    start = time.time()
+    summary = {'created': [], 'deleted': [], 'invited': [],
+               're_enabled': [], 'accepted': [], 'failed': {}}
+    account_ids = (set(organizations_account_id_map.keys())
+                   & set(account_id_role_arn_map.keys()))
+    state_key = 'members/{}'.format(region_name)
+
+    if delta and state_store is not None:
+        previous = state_store.get(state_key)
+        delta_account_ids = get_delta_account_ids(
+            previous, account_ids, set(changed_account_ids))
+        if delta_account_ids is None:
+            logger.debug('{} : Skipping region with no changes since '
+                         '{}'.format(region_name, previous['updated']))
+            return {'skipped': True,
+                    'duration': round(time.time() - start, 3)}
+        if delta_account_ids != account_ids:
+            logger.debug('{} : Reconciling only the changed accounts '
+                         '{}'.format(region_name, sorted(delta_account_ids)))
+            account_ids = delta_account_ids
+            summary['changed_accounts'] = sorted(account_ids)
+
+    # Ensure that a GuardDuty master detector is created
+    local_detector_id = find_or_create_detector(
+        local_boto_session, region_name, local_account_id)
+
+    # Fetch the GuardDuty members list
+    client = get_client(local_boto_session, 'guardduty', region_name)
+    members = get_region_members(client, local_detector_id)
+    logger.debug('{} : Member dict : {}'.format(region_name, members))
+
+    plan = MemberPlan(members, account_ids, organizations_account_id_map,
+                      region_wide)
+
+    # Create members for accounts that haven't been created yet
+    if plan.create:
+        unprocessed = call_in_batches(
+            client.create_members, plan.create, 'AccountDetails',
+            DetectorId=local_detector_id)
+        summary['created'] = [x['AccountId'] for x in plan.create]
+        logger.info(
+            '{} : Members created : {}'.format(
+                region_name, plan.create))
+        log_unprocessed(region_name, 'create', unprocessed)
+
+    # Delete members that got stuck at email verification
+    if plan.delete:
+        unprocessed = call_in_batches(
+            client.delete_members, plan.delete, 'AccountIds',
+            DetectorId=local_detector_id)
+        summary['deleted'] = plan.delete
+        logger.info('{} : Member deleted due to email verification failure'
+                    ' : {}'.format(region_name, plan.delete))
+        log_unprocessed(region_name, 'delete', unprocessed)
+
+    # Invite members that have been created
+    if plan.invite:
+        unprocessed = call_in_batches(
+            client.invite_members, plan.invite, 'AccountIds',
+            DetectorId=local_detector_id,
+            DisableEmailNotification=True)
+        summary['invited'] = plan.invite
+        logger.info(
+            '{} : Member invited : {}'.format(
+                region_name, plan.invite))
+        log_unprocessed(region_name, 'invite', unprocessed)
+
+    # Act within the member accounts which need it
+    member_actions = plan.member_actions()
+    results = run_concurrently(
+        lambda account_id: reconcile_member(
+            region_name, account_id, member_actions[account_id],
+            account_id_role_arn_map[account_id], local_account_id,
+            members.get(account_id)),
+        member_actions,
+        MAX_ACCOUNT_WORKERS)
+    for account_id, (actions, error) in results.items():
+        if error is not None:
+            summary['failed'][account_id] = repr(error)
+            logger.error('{} : {} : Failed to reconcile member : {}'.format(
+                region_name, account_id, error))
+            continue
+        for action in actions:
+            summary[action].append(account_id)
+
+    if state_store is not None:
+        state_store.put(state_key, {'members': members,
+                                    'updated': int(time.time())})
+
+    summary['duration'] = round(time.time() - start, 3)
+    return summary
+
+
+def plan_shards(job_id, regions, local_account_id,
+                organizations_account_id_map, account_id_role_arn_map):
+    """Split the work of a run into shards of up to SHARD_SIZE accounts in
+    a region
+
+    The first shard of each region is region wide, see MemberPlan.
+
+    :param job_id: Identifier of the run
+    :param regions: List of AWS region names
+    :param local_account_id: AWS account ID of the GuardDuty master
+    :param organizations_account_id_map: dict of account IDs and emails
+    :param account_id_role_arn_map: dict of account IDs and IAM Role ARNs
+    :return: List of JSON serializable shard dicts
+    """
+    account_ids = sorted(set(organizations_account_id_map)
+                         & set(account_id_role_arn_map))
+    account_chunks = list(chunks(account_ids, SHARD_SIZE)) or [[]]
+    return [
+        {'job_id': job_id,
+         'region_name': region_name,
+         'index': index,
+         'count': len(account_chunks),
+         'local_account_id': local_account_id,
+         'accounts': {x: [organizations_account_id_map[x],
+                          account_id_role_arn_map[x]]
+                      for x in account_chunk}}
+        for region_name in regions
+        for index, account_chunk in enumerate(account_chunks)]
+
+
+def shard_id(shard):
+    return '{}/{}/{}'.format(
+        shard['job_id'], shard['region_name'], shard['index'])
+
+
+def message_batches(messages, max_entries=SQS_MAX_BATCH_ENTRIES,
+                    max_bytes=SQS_MAX_BATCH_BYTES):
+    """Group messages into batches within the SendMessageBatch limits
+
+    :param messages: Iterable of (item, message body) tuples, each body no
+                     larger than max_bytes
+    :param max_entries: Maximum number of messages in a batch
+    :param max_bytes: Maximum combined size of the bodies of a batch
+    :return: Generator of lists of (item, message body) tuples
+    """
+    batch = []
+    batch_bytes = 0
+    for item, body in messages:
+        size = len(body.encode('utf-8'))
+        if batch and (len(batch) == max_entries
+                      or batch_bytes + size > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append((item, body))
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def reconcile_shard(shard):
+    """Reconcile the accounts of a shard in its region and record the
+    result in the shards/<job_id>/<region>/<index> state key
+
+    :param shard: Shard dict from plan_shards
+    :return: dict summarizing the actions taken in the shard
+    """
+    local_boto_session = get_session(os.environ.get('MANAGER_IAM_ROLE_ARN'))
+    region_name = shard['region_name']
+    region_wide = shard['index'] == 0
+    state_store = (
+        StateStore(local_boto_session, STATE_TABLE_NAME, 'us-west-2')
+        if STATE_TABLE_NAME else None)
+    logger.info('{} : Reconciling shard {} of {} with {} accounts'.format(
+        region_name, shard['index'] + 1, shard['count'],
+        len(shard['accounts'])))
+    try:
+        # Only the region wide shard sees all of the region's members so
+        # it alone records them
+        summary = reconcile_region(
+            local_boto_session, region_name, shard['local_account_id'],
+            {k: v[0] for k, v in shard['accounts'].items()},
+            {k: v[1] for k, v in shard['accounts'].items()},
+            state_store if region_wide else None, False, region_wide)
+    except Exception as e:
+        logger.error('{} : Failed to reconcile shard {} : {}'.format(
+            region_name, shard_id(shard), e))
+        if state_store is not None:
+            # Ensure the region isn't skipped by the next delta run
+            state_store.delete('members/{}'.format(region_name))
+            state_store.put('shards/{}'.format(shard_id(shard)),
+                            {'error': repr(e)})
+        raise
+    if state_store is not None:
+        state_store.put('shards/{}'.format(shard_id(shard)), summary)
+    return summary
+
+
+@METRICS.timed('ShardDispatch')
+def dispatch_shards(shards):
+    """Hand the shards to workers as configured in SHARD_DISPATCH
+
+    With lambda and sqs dispatch the shards run in other invocations of
+    this function, which record their results in the state table. With
+    local dispatch the shards run concurrently in this invocation. Shards
+    are sent to SQS in batches within the SendMessageBatch size limits and
+    a shard too large for a single message fails.
+
+    :param shards: List of shard dicts
+    :return: dict with shard ID keys and (result, exception) tuple values,
+             where the result of a shard dispatched to another invocation
+             is None
+    """
+    if SHARD_DISPATCH in ('local', 'lambda'):
+        if SHARD_DISPATCH == 'local':
+            worker = reconcile_shard
+        else:
+            client = get_client(None, 'lambda')
+
+            def worker(shard):
+                client.invoke(
+                    FunctionName=os.environ['AWS_LAMBDA_FUNCTION_NAME'],
+                    InvocationType='Event',
+                    Payload=json.dumps({'shard': shard}))
+        results = run_concurrently(
+            lambda x: worker(shards[x]), range(len(shards)),
+            MAX_REGION_WORKERS)
+        return {shard_id(shards[k]): v for k, v in results.items()}
+    elif SHARD_DISPATCH == 'sqs':
+        client = get_client(None, 'sqs')
+        results = {}
+        messages = []
+        for shard in shards:
+            body = json.dumps(shard)
+            if len(body.encode('utf-8')) > SQS_MAX_BATCH_BYTES:
+                results[shard_id(shard)] = (None, ValueError(
+                    'Shard of {} accounts is larger than an SQS message, '
+                    'lower SHARD_SIZE'.format(len(shard['accounts']))))
+            else:
+                messages.append((shard, body))
+        for batch in message_batches(messages):
+            response = client.send_message_batch(
+                QueueUrl=SHARD_QUEUE_URL,
+                Entries=[{'Id': str(i), 'MessageBody': body}
+                         for i, (shard, body) in enumerate(batch)])
+            failed = {int(x['Id']): x for x in response.get('Failed', [])}
+            for i, (shard, body) in enumerate(batch):
+                results[shard_id(shard)] = (
+                    (None, RuntimeError(failed[i].get('Message')))
+                    if i in failed else (None, None))
+        return results
+    raise ValueError('Unknown SHARD_DISPATCH {}'.format(SHARD_DISPATCH))
+
+
+def reconcile_sharded(local_boto_session, regions, local_account_id,
+                      organizations_account_id_map, account_id_role_arn_map,
+                      state_store=None, delta=False, changed_account_ids=()):
+    """Split the regions into shards and dispatch them to workers
 
+    When delta is True regions are skipped, or only their changed accounts
+    are sharded, as in reconcile_region.
 
+    :param local_boto_session: Boto session for the GuardDuty master
+    :param regions: List of AWS region names
+    :param local_account_id: AWS account ID of the GuardDuty master
+    :param organizations_account_id_map: dict of account IDs and emails
+    :param account_id_role_arn_map: dict of account IDs and IAM Role ARNs
+    :param state_store: StateStore with the recorded member statuses or None
+    :param delta: Whether to only reconcile the accounts which changed
+                  since the recorded member statuses
+    :param changed_account_ids: Account IDs which changed since the previous
+                                run, see get_changed_account_ids
+    :return: dict with region name keys and (summary, exception) tuple
+             values like run_concurrently
+    """
+    account_ids = (set(organizations_account_id_map)
+                   & set(account_id_role_arn_map))
+    results = {}
+    pending_regions = []
+    changed_regions = []
+    for region_name in regions:
+        delta_account_ids = account_ids
+        if delta and state_store is not None:
+            delta_account_ids = get_delta_account_ids(
+                state_store.get('members/{}'.format(region_name)),
+                account_ids, set(changed_account_ids))
+        if delta_account_ids is None:
+            results[region_name] = ({'skipped': True}, None)
+        elif delta_account_ids != account_ids:
+            changed_regions.append(region_name)
+        else:
+            pending_regions.append(region_name)
+
+    job_id = uuid.uuid4().hex
+    shards = plan_shards(
+        job_id, pending_regions, local_account_id,
+        organizations_account_id_map, account_id_role_arn_map)
+    if changed_regions:
+        changed = account_ids & set(changed_account_ids)
+        shards.extend(plan_shards(
+            job_id, changed_regions, local_account_id,
+            {k: v for k, v in organizations_account_id_map.items()
+             if k in changed},
+            {k: v for k, v in account_id_role_arn_map.items()
+             if k in changed}))
+    pending_regions.extend(changed_regions)
+    logger.info('Dispatching {} shards of {} regions with {}'.format(
+        len(shards), len(pending_regions), SHARD_DISPATCH))
+    shard_results = dispatch_shards(shards)
+    for region_name in pending_regions:
+        region_shards = [x for x in shards if x['region_name'] == region_name]
+        summary = {'shards': [shard_id(x) for x in region_shards]}
+        errors = []
+        for shard in region_shards:
+            result, error = shard_results[shard_id(shard)]
+            if error is not None:
+                errors.append(error)
+            for key, value in (result or {}).items():
+                if isinstance(value, list):
+                    summary.setdefault(key, []).extend(value)
+                elif isinstance(value, dict):
+                    summary.setdefault(key, {}).update(value)
+        results[region_name] = (
+            (None, errors[0]) if errors else (summary, None))
+    return results
+
+
+def handle_shard_messages(records):
+    """Reconcile the shards in SQS messages
+
+    :param records: SQS event records
+    :return: dict with the batchItemFailures of the shards which failed
+    """
+    failures = []
+    for record in records:
+        try:
+            reconcile_shard(json.loads(record['body']))
+        except Exception:
+            failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
+
+
+def get_joined_account_id(event):
+    """Return the ID of the account which joined the AWS Organization in a
+    CreateAccountResult or invitation AcceptHandshake CloudTrail event or
+    None for other events
+
+    :param event: EventBridge event
+    :return: AWS account ID or None
+    """
+    detail = event.get('detail', {})
+    if detail.get('eventName') == 'CreateAccountResult':
+        status = detail.get('serviceEventDetails', {}).get(
+            'createAccountStatus', {})
+        return status.get('accountId') if status.get('state') in (
+            None, 'SUCCEEDED') else None
+    if detail.get('eventName') == 'AcceptHandshake':
+        handshake = (detail.get('responseElements') or {}).get(
+            'handshake', {})
+        if (handshake.get('action') != 'INVITE'
+                or handshake.get('state') != 'ACCEPTED'):
+            return None
+        return next((
+            x['id'] for x in handshake.get('parties', [])
+            if x.get('type') == 'ACCOUNT'),
+            detail.get('userIdentity', {}).get('accountId'))
+    return None
+
+
+def get_stream_member_roles(records):
+    """Return the member roles added or changed by DynamoDB stream records of
+    the cross account outputs table
+
+    :param records: DynamoDB stream event records
+    :return: dict with account ID keys and IAM Role ARN values
+    """
+    from boto3.dynamodb.types import TypeDeserializer
+    deserializer = TypeDeserializer()
+    account_id_role_arn_map = {}
+    for record in records:
+        if record.get('eventName') not in ('INSERT', 'MODIFY'):
+            continue
+        item = {k: deserializer.deserialize(v) for k, v in record[
+            'dynamodb'].get('NewImage', {}).items()}
+        if (item.get('category') == DB_CATEGORY
+                and {'aws-account-id', 'GuardDutyMemberAccountIAMRoleArn'}
+                <= set(item)):
+            account_id_role_arn_map[item['aws-account-id']] = item[
+                'GuardDutyMemberAccountIAMRoleArn']
+    return account_id_role_arn_map
+
+
+@METRICS.timed('MemberOnboard')
+def onboard_member(local_boto_session, region_name, local_account_id,
+                   account_id, email, role_arn):
+    """Take a single account all the way to a functioning member master
+    relationship in a region
+
+    Unlike reconcile_region, which moves each account one step per run, the
+    account is created, invited and accepted in one pass.
+
+    :param local_boto_session: Boto session for the GuardDuty master
+    :param region_name: AWS region name
+    :param local_account_id: AWS account ID of the GuardDuty master
+    :param account_id: Member AWS account ID
+    :param email: Email address of the member account
+    :param role_arn: ARN of the IAM Role to assume in the member account
+    :return: List of the actions taken
+    """
+    local_detector_id = find_or_create_detector(
+        local_boto_session, region_name, local_account_id)
+    client = get_client(local_boto_session, 'guardduty', region_name)
+    status = next((
+        x['RelationshipStatus'].upper() for x in client.get_members(
+            DetectorId=local_detector_id, AccountIds=[account_id])['Members']
+        if x['AccountId'] == account_id), None)
+    taken = []
+    if status == 'EMAILVERIFICATIONFAILED':
+        log_unprocessed(region_name, 'delete', client.delete_members(
+            DetectorId=local_detector_id,
+            AccountIds=[account_id]).get('UnprocessedAccounts', []))
+        taken.append('deleted')
+        status = None
+    if status in (None, 'REMOVED'):
+        unprocessed = client.create_members(
+            DetectorId=local_detector_id,
+            AccountDetails=[{'AccountId': account_id, 'Email': email}]).get(
+            'UnprocessedAccounts', [])
+        if unprocessed:
+            log_unprocessed(region_name, 'create', unprocessed)
+            return taken
+        taken.append('created')
+        status = 'CREATED'
+    if status in ('CREATED', 'RESIGNED'):
+        unprocessed = client.invite_members(
+            DetectorId=local_detector_id, AccountIds=[account_id],
+            DisableEmailNotification=True).get('UnprocessedAccounts', [])
+        if unprocessed:
+            log_unprocessed(region_name, 'invite', unprocessed)
+            return taken
+        taken.append('invited')
+        status = 'INVITED'
+    actions = MemberPlan(
+        {account_id: status}, [account_id],
+        {account_id: email}).member_actions().get(account_id, [])
+    if actions:
+        # Members which are already enabled need no calls in their account
+        taken.extend(reconcile_member(
+            region_name, account_id, actions, role_arn, local_account_id,
+            status))
+    logger.info('{} : {} : Onboarded member : {}'.format(
+        region_name, account_id, taken))
+    return taken
+
+
+def onboard_accounts(account_id_role_arn_map, state_store=None):
+    """Reconcile only the passed accounts, in every region concurrently
+
+    Accounts which aren't in the AWS Organization account maps (after
+    ACCOUNT_FILTER_LIST is applied) are ignored. An account without an IAM
+    Role ARN is looked up in the cross account outputs table.
+
+    :param account_id_role_arn_map: dict with account ID keys and IAM Role
+                                    ARN (or None) values
+    :param state_store: StateStore with the cached account maps or None
+    :return: dict with account ID keys and dicts of per region results
+    """
+    start = time.time()
+    if not account_id_role_arn_map:
+        return {'accounts': {}, 'failed': [], 'duration': 0}
+    local_boto_session = get_session(os.environ.get('MANAGER_IAM_ROLE_ARN'))
+    local_account_id = get_client(
+        None, 'sts').get_caller_identity()["Account"]
+    guardduty_regions = get_enabled_regions(
+        local_boto_session, local_account_id, 'us-west-2', state_store)
+    org_arn_list = (
+        [x.strip() for x in ORGANIZATION_IAM_ROLE_ARNS.split(',')]
+        if ORGANIZATION_IAM_ROLE_ARNS is not None else [None])
+    organizations_account_id_map = get_organizations_account_id_map(
+        org_arn_list, 'us-west-2', state_store)
+    if (state_store is not None
+            and set(account_id_role_arn_map) - set(
+                organizations_account_id_map)):
+        # The cached maps may predate the accounts
+        for org_arn in org_arn_list:
+            state_store.delete(organization_cache_key(org_arn))
+        organizations_account_id_map = get_organizations_account_id_map(
+            org_arn_list, 'us-west-2', state_store)
+    if None in account_id_role_arn_map.values():
+        role_map = get_account_role_map(local_boto_session, 'us-west-2')
+        account_id_role_arn_map = {
+            k: v if v is not None else role_map.get(k)
+            for k, v in account_id_role_arn_map.items()}
+    accounts = {
+        k: (organizations_account_id_map[k], account_id_role_arn_map[k])
+        for k in account_id_role_arn_map
+        if k in organizations_account_id_map
+        and account_id_role_arn_map[k] is not None
+        and (not ACCOUNT_FILTER_LIST or k in ACCOUNT_FILTER_LIST.split())}
+    logger.info('Onboarding accounts {}'.format(sorted(accounts)))
+
+    results = run_concurrently(
+        lambda x: onboard_member(
+            local_boto_session, x[1], local_account_id, x[0],
+            accounts[x[0]][0], accounts[x[0]][1]),
+        [(x, y) for x in accounts for y in guardduty_regions],
+        MAX_REGION_WORKERS * MAX_ACCOUNT_WORKERS)
+    summary = {'accounts': {x: {} for x in accounts}, 'failed': []}
+    for (account_id, region_name), (taken, error) in results.items():
+        if error is not None:
+            summary['failed'].append('{}/{}'.format(region_name, account_id))
+            summary['accounts'][account_id][region_name] = {
+                'error': repr(error)}
+            logger.error('{} : {} : Failed to onboard member : {}'.format(
+                region_name, account_id, error))
+        else:
+            summary['accounts'][account_id][region_name] = taken
+    summary['duration'] = round(time.time() - start, 3)
+    return summary
+
+
+class CoverageMatrix:
+    """The GuardDuty coverage of every account in every region, as seen from
+    the master account
+
+    Each (account, region) cell is a single byte of a bytearray holding the
+    index of the member's RelationshipStatus in STATUSES, with the DETECTOR
+    bit set when the member has a detector in the region. Whether each
+    account has a member role in the cross account outputs table is a byte
+    per account. A matrix of thousands of accounts in every region takes
+    tens of kilobytes.
+    """
+
+    # Relationship statuses, with NotMember for accounts which aren't
+    # members of the master in a region
+    STATUSES = ('NotMember', 'Created', 'Invited', 'Enabled', 'Disabled',
+                'Removed', 'Resigned', 'EmailVerificationInProgress',
+                'EmailVerificationFailed', 'Unknown')
+    # RelationshipStatus values are matched case insensitively, as in
+    # MemberPlan
+    STATUS_INDEX = {x.upper(): i for i, x in enumerate(STATUSES)}
+    # One character per status for the compact JSON rows
+    CODES = '-CIEDRSPVU'
+    DETECTOR = 0x80
+
+    def __init__(self, account_ids, regions):
+        self.account_ids = list(account_ids)
+        self.regions = list(regions)
+        self.account_index = {x: i for i, x in enumerate(self.account_ids)}
+        self.region_index = {x: i for i, x in enumerate(self.regions)}
+        self.cells = bytearray(len(self.account_ids) * len(self.regions))
+        self.roles = bytearray(len(self.account_ids))
+        # Regions which couldn't be audited, with the reason
+        self.region_errors = {}
+
+    def set_status(self, account_id, region_name, status, has_detector):
+        """Record a member's relationship status in a region
+
+        :param account_id: AWS account ID
+        :param region_name: Region name
+        :param status: RelationshipStatus of the member
+        :param has_detector: Whether the member has a detector in the region
+        """
+        cell = self.STATUS_INDEX.get(
+            (status or '').upper(), self.STATUS_INDEX['UNKNOWN'])
+        self.cells[
+            self.account_index[account_id] * len(self.regions)
+            + self.region_index[region_name]] = (
+            cell | (self.DETECTOR if has_detector else 0))
+
+    def set_role(self, account_id, available):
+        self.roles[self.account_index[account_id]] = bool(available)
+
+    def get(self, account_id, region_name):
+        """Return the relationship status of an account in a region and
+        whether it has a detector there
+
+        :param account_id: AWS account ID
+        :param region_name: Region name
+        :return: tuple of status and bool
+        """
+        cell = self.cells[self.account_index[account_id] * len(self.regions)
+                          + self.region_index[region_name]]
+        return self.STATUSES[cell & ~self.DETECTOR], bool(
+            cell & self.DETECTOR)
+
+    def row(self, account_id):
+        """Return the status codes of an account in every region, one CODES
+        character per region
+
+        :param account_id: AWS account ID
+        :return: tuple of the status code str and a str of 1 and 0 for the
+                 member detector in each region
+        """
+        start = self.account_index[account_id] * len(self.regions)
+        cells = self.cells[start:start + len(self.regions)]
+        return (
+            ''.join(self.CODES[x & ~self.DETECTOR] for x in cells),
+            ''.join('1' if x & self.DETECTOR else '0' for x in cells))
+
+    def summary(self):
+        """Return the number of accounts in each status in each region, and
+        the accounts which aren't Enabled in every audited region
+
+        :return: dict with regions, region_errors, uncovered_accounts and
+                 accounts_without_role keys
+        """
+        regions = {}
+        enabled = self.STATUSES.index('Enabled')
+        uncovered = set()
+        for j, region_name in enumerate(self.regions):
+            if region_name in self.region_errors:
+                continue
+            counts = [0] * len(self.STATUSES)
+            for i, cell in enumerate(
+                    self.cells[j::len(self.regions)]):
+                status = cell & ~self.DETECTOR
+                counts[status] += 1
+                if status != enabled:
+                    uncovered.add(self.account_ids[i])
+            regions[region_name] = {
+                self.STATUSES[x]: counts[x]
+                for x in range(len(counts)) if counts[x]}
+        return {
+            'accounts': len(self.account_ids),
+            'regions': regions,
+            'region_errors': self.region_errors,
+            'uncovered_accounts': sorted(uncovered),
+            'accounts_without_role': [
+                x for i, x in enumerate(self.account_ids)
+                if not self.roles[i]]}
+
+    def to_json(self):
+        """Return the matrix as a JSON serializable dict with a row of status
+        codes and a row of member detector flags per account
+
+        :return: dict
+        """
+        accounts = {}
+        for account_id in self.account_ids:
+            statuses, detectors = self.row(account_id)
+            accounts[account_id] = {
+                'role': bool(self.roles[self.account_index[account_id]]),
+                'statuses': statuses,
+                'detectors': detectors}
+        return {
+            'regions': self.regions,
+            'codes': dict(zip(self.CODES, self.STATUSES)),
+            'region_errors': self.region_errors,
+            'accounts': accounts}
+
+    def to_csv(self):
+        """Return the matrix as CSV with a row per account and region
+
+        :return: str
+        """
+        import csv
+        import io
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow([
+            'account_id', 'region', 'relationship_status', 'member_detector',
+            'role_available'])
+        for account_id in self.account_ids:
+            role = bool(self.roles[self.account_index[account_id]])
+            for region_name in self.regions:
+                if region_name in self.region_errors:
+                    status, has_detector = 'Unknown', False
+                else:
+                    status, has_detector = self.get(account_id, region_name)
+                writer.writerow([account_id, region_name, status,
+                                 has_detector, role])
+        return output.getvalue()
+
+
+def list_region_coverage(local_boto_session, region_name, account_ids=None):
+    """Read the relationship status of the master's members in a region,
+    without any calls to the member accounts or any changes
+
+    The whole member list is read with ListMembers or, when only some
+    accounts are audited, just those accounts are read with GetMembers in
+    batches of GUARDDUTY_MEMBER_BATCH_SIZE.
+
+    :param local_boto_session: boto session of the master account
+    :param region_name: Region name
+    :param account_ids: List of the account IDs to read or None for every
+                        member
+    :return: dict with account ID keys and tuples of RelationshipStatus and
+             whether the member has a detector values, or None if there is
+             no master detector in the region
+    """
+    client = get_client(local_boto_session, 'guardduty', region_name)
+    detector_ids = client.list_detectors()['DetectorIds']
+    if not detector_ids:
+        return None
+    if account_ids is not None:
+        members = (
+            member for batch in chunks(account_ids)
+            for member in client.get_members(
+                DetectorId=detector_ids[0], AccountIds=batch)['Members'])
+    else:
+        members = (
+            member for page in client.get_paginator('list_members').paginate(
+                DetectorId=detector_ids[0], OnlyAssociated='FALSE')
+            for member in page['Members'])
+    return {
+        member['AccountId']: (
+            member['RelationshipStatus'], bool(member.get('DetectorId')))
+        for member in members}
+
+
+@METRICS.timed('Audit')
+def audit_coverage(options=None):
+    """Build the CoverageMatrix of every account in the AWS Organizations in
+    every enabled region, read only and from the master account alone
+
+    The members of every region are read concurrently, each region with its
+    own client and retry rate limit, while the account maps are fetched.
+
+    Options
+      * accounts : List of account IDs to audit instead of every account.
+        These accounts are read with GetMembers
+      * regions : List of regions to audit instead of every enabled region
+      * format : json (the default) or csv
+
+    If STATE_TABLE_NAME is set the JSON export is also saved to the
+    audit/latest state key.
+
+    :param options: dict of options or None
+    :return: dict with summary, duration and json or csv keys
+    """
+    start = time.time()
+    options = options or {}
+    local_boto_session = get_session(os.environ.get('MANAGER_IAM_ROLE_ARN'))
+    local_account_id = get_client(
+        None, 'sts').get_caller_identity()["Account"]
+    state_store = None
+    if STATE_TABLE_NAME:
+        state_store = StateStore(
+            local_boto_session, STATE_TABLE_NAME, 'us-west-2')
+    org_arn_list = (
+        [x.strip() for x in ORGANIZATION_IAM_ROLE_ARNS.split(',')]
+        if ORGANIZATION_IAM_ROLE_ARNS is not None else [None])
+    regions = options.get('regions') or get_enabled_regions(
+        local_boto_session, local_account_id, 'us-west-2', state_store)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        organizations_future = executor.submit(
+            get_organizations_account_id_map, org_arn_list, 'us-west-2',
+            state_store)
+        roles_future = executor.submit(
+            get_account_role_map, local_boto_session, 'us-west-2')
+        results = run_concurrently(
+            lambda region_name: list_region_coverage(
+                local_boto_session, region_name, options.get('accounts')),
+            regions, MAX_REGION_WORKERS)
+        account_ids = set(organizations_future.result())
+        account_id_role_arn_map = roles_future.result()
+    if ACCOUNT_FILTER_LIST:
+        account_ids &= set(ACCOUNT_FILTER_LIST.split())
+    if options.get('accounts'):
+        account_ids &= set(options['accounts'])
+
+    matrix = CoverageMatrix(sorted(account_ids), regions)
+    for account_id in matrix.account_ids:
+        matrix.set_role(account_id, account_id in account_id_role_arn_map)
+    for region_name, (members, error) in results.items():
+        if error is not None:
+            matrix.region_errors[region_name] = repr(error)
+            logger.error('{} : Failed to audit region : {}'.format(
+                region_name, error))
+        elif members is None:
+            matrix.region_errors[region_name] = 'NoMasterDetector'
+        else:
+            for account_id, (status, has_detector) in members.items():
+                if account_id in matrix.account_index:
+                    matrix.set_status(
+                        account_id, region_name, status, has_detector)
+
+    summary = matrix.summary()
+    report = {'summary': summary}
+    if options.get('format') == 'csv':
+        report['csv'] = matrix.to_csv()
+    else:
+        report['json'] = matrix.to_json()
+    if state_store is not None:
+        state_store.put('audit/latest', dict(
+            matrix.to_json(), audited=int(start)))
+    report['duration'] = round(time.time() - start, 3)
+    logger.info('Audit : {} accounts in {} regions in {}s : {} accounts not '
+                'enabled everywhere : {} region errors'.format(
+                    len(matrix.account_ids), len(regions),
+                    report['duration'], len(summary['uncovered_accounts']),
+                    len(matrix.region_errors)))
+    return report
+
+
+@emit_metrics
 def handle(event, context):
     """Move all AWS accounts in an AWS Organization which have delegated
     permissions to this account towards a functioning member master
     GuardDuty relationship.
 
-    * Fetch the accounts list from AWS Organizations
+    * Fetch the accounts list from AWS Organizations, or from the cache
     * Get IAM Role ARNs for each account
-    * For each region
+    * For each region, concurrently
       * Ensure that a GuardDuty master detector is created
       * Fetch the GuardDuty members list
       * Create members for accounts that haven't been created yet
       * Invite members that have been created
-      * For each account
+      * For each account, concurrently
         * Update member account detector to enabled if DISABLED
         * Get or create a detector in the member account
         * For members with a pending invitation, accept the invitation in the
           member account
 
+    A failure in one region or one member account is logged and recorded in
+    the returned summary without stopping the work in the others.
+
+    If STATE_TABLE_NAME is set, a snapshot of the account maps and of the
+    member statuses in each region is kept between runs. Between full sweeps
+    only the accounts which changed since the snapshot are reconciled in
+    every region, along with all of the accounts of the regions where an
+    unchanged account isn't ENABLED yet (see get_delta_account_ids), and
+    the other regions are skipped. A full sweep of every region is done
+    when the last one is older than FULL_SWEEP_INTERVAL, unless the run was
+    triggered by an AWS Organizations event, or the event contains
+    {"full_sweep": true}.
+
+    When triggered by DynamoDB stream records of new or changed member roles
+    in the cross account outputs table, or by the AWS Organizations event of
+    an account joining (see get_joined_account_id), only those accounts are
+    reconciled (see onboard_accounts).
+
+    Only the GuardDuty regions enabled in this account are reconciled (see
+    get_enabled_regions), starting with the regions which took the longest
+    in previous runs (see schedule_regions).
+
+    The account map of each AWS Organization is also cached in the state
+    table for ORGANIZATION_CACHE_TTL seconds. When the function is triggered
+    by an AWS Organizations CloudTrail event that adds or removes accounts,
+    the cached map is dropped before the run. The run after an account is
+    removed is a delta run of the changed accounts.
+
+    An event with an audit key only reads the GuardDuty coverage of every
+    account and region, see audit_coverage.
+
+    If SHARD_DISPATCH is set this invocation coordinates the run instead.
+    The regions to reconcile are split into shards of up to SHARD_SIZE
+    accounts, which are dispatched to workers (see dispatch_shards). A
+    worker is an invocation of this function with a {"shard": ...} event or
+    with SQS records of shards.
+
     Set environment variables
       * ORGANIZATION_IAM_ROLE_ARN_LIST : Comma delimited list of IAM Role ARNs
         to assume to reach AWS Organization parent accounts
       * ACCOUNT_FILTER_LIST : Space delimited list of account IDs to include.
         If this is provided, only these accounts will be included. If it's not
         provided, all accounts will be included.
+      * MAX_REGION_WORKERS : Number of regions to process concurrently.
+        Defaults to 8
+      * MAX_ACCOUNT_WORKERS : Number of member accounts to process
+        concurrently within each region. Defaults to 8
+      * MEMBER_SESSION_CACHE_SIZE : Number of assumed member role sessions
+        kept between uses. Defaults to 64
+      * MEMBER_CLIENT_CACHE_SIZE : Number of clients of member role sessions
+        kept between uses. Defaults to 64
+      * STATE_TABLE_NAME : Name of the DynamoDB table to store the snapshot
+        in. If it's not provided every run is a full sweep
+      * FULL_SWEEP_INTERVAL : Maximum number of seconds between full sweeps.
+        Defaults to 86400
+      * ORGANIZATION_CACHE_TTL : Number of seconds to cache the AWS
+        Organization account maps for. Defaults to 3600
+      * API_MAX_ATTEMPTS : Maximum attempts of each API call. Defaults to 10
+      * SHARD_DISPATCH : lambda, sqs or local to shard the run. If it's not
+        provided the run isn't sharded
+      * SHARD_SIZE : Maximum number of accounts in a shard. Defaults to 500
+      * SHARD_QUEUE_URL : URL of the SQS queue to send shards to
+      * REGION_CACHE_TTL : Number of seconds to cache the regions enabled in
+        this account for. Defaults to 86400
+      * REGION_ALLOW_LIST : Space delimited list of regions to reconcile
+        even if they aren't found to be enabled
+      * REGION_DENY_LIST : Space delimited list of regions to never
+        reconcile
+      * METRICS_NAMESPACE : CloudWatch namespace of the metrics emitted at
+        the end of each invocation, see Metrics. Defaults to
+        GuardDutyMultiAccountManager, set it to an empty string to not emit
+        metrics
+      * METRICS_TOP_ACCOUNTS : Number of accounts with the most API time
+        listed in the emitted metrics. Defaults to 20
+      * PREWARM_CLIENTS : true to create the clients every invocation needs
+        during the Lambda init phase. Defaults to true
 
     :param event: Lambda event object
     :param context: Lambda context object
+    :return: dict summarizing the run with per region results
     """
+    event = event or {}
+    if 'audit' in event:
+        return audit_coverage(event['audit'])
+    if 'shard' in event:
+        return reconcile_shard(event['shard'])
+    if event.get('Records'):
+        if event['Records'][0].get('eventSource') == 'aws:dynamodb':
+            return onboard_accounts(
+                get_stream_member_roles(event['Records']),
+                StateStore(get_session(os.environ.get(
+                    'MANAGER_IAM_ROLE_ARN')), STATE_TABLE_NAME, 'us-west-2')
+                if STATE_TABLE_NAME else None)
+        return handle_shard_messages(event['Records'])
+
+    start = time.time()
+    SESSION_CACHE.reset_stats()
+    MEMBER_SESSION_CACHE.reset_stats()
     local_boto_session = get_session(os.environ.get('MANAGER_IAM_ROLE_ARN'))
-    local_account_id = boto3.client('sts').get_caller_identity()["Account"]
-    guardduty_regions = local_boto_session.get_available_regions('guardduty')
+    local_account_id = get_client(
+        None, 'sts').get_caller_identity()["Account"]
     default_region = 'us-west-2'
-    organizations_account_id_map = {}
     org_arn_list = (
         [x.strip() for x in ORGANIZATION_IAM_ROLE_ARNS.split(',')]
         if ORGANIZATION_IAM_ROLE_ARNS is not None else [None])
-    for org_arn in org_arn_list:
-        org_boto_session = get_session(org_arn)
+    state_store = None
+    if STATE_TABLE_NAME:
+        state_store = StateStore(
+            local_boto_session, STATE_TABLE_NAME, default_region)
+        if event.get('source') == 'aws.organizations':
+            invalidate_organization_cache(event, org_arn_list, state_store)
+    if get_joined_account_id(event) is not None:
+        return onboard_accounts(
+            {get_joined_account_id(event): None}, state_store)
 
-        # Fetch the accounts list from AWS Organizations
-        organizations_account_id_map.update(
-            get_account_id_email_map_from_organizations(
-                org_boto_session, region_name=default_region))
+    # Only reconcile the regions enabled in this account, slowest first
+    region_health = load_region_health(state_store)
+    guardduty_regions = schedule_regions(get_enabled_regions(
+        local_boto_session, local_account_id, default_region, state_store),
+        region_health)
+
+    # Fetch the accounts list from AWS Organizations
+    organizations_account_id_map = get_organizations_account_id_map(
+        org_arn_list, default_region, state_store)
 
     logger.debug(
         'Organization account ID map: {}'.format(organizations_account_id_map))
@@ -267,104 +2495,67 @@ def handle(event, context):
     logger.debug(
         'Account ID IAM Role map: {}'.format(account_id_role_arn_map))
 
-    for region_name in guardduty_regions:
-        # Ensure that a GuardDuty master detector is created
-        local_detector_id = find_or_create_detector(
-            local_boto_session, region_name, local_account_id)
-
-        # Fetch the GuardDuty members list
-        client = local_boto_session.client(
-            'guardduty', region_name=region_name)
-        list_of_members = [
-            y for sublist in [
-                x['Members'] for x in client.get_paginator(
-                    'list_members').paginate(
-                    DetectorId=local_detector_id, OnlyAssociated="FALSE")]
-            for y in sublist]
-        members = {x['AccountId']: x['RelationshipStatus']
-                   for x in list_of_members}
-        logger.debug('{} : Member dict : {}'.format(region_name, members))
-
-        # Create a get_members function to work with the members list
-        get_members = GetMembers(members)
-
-        # Create members for accounts that haven't been created yet
-        account_details = [
-            {'AccountId': account_id, 'Email': email}
-            for account_id, email in organizations_account_id_map.items()
-            if account_id in account_id_role_arn_map.keys() and
-            (account_id not in members
-             or account_id in get_members('REMOVED'))]
-        if account_details:
-            client.create_members(
-                AccountDetails=account_details,
-                DetectorId=local_detector_id)
-            logger.info(
-                '{} : Members created : {}'.format(
-                    region_name, account_details))
-
-        # Delete members that got stuck at email verification
-        account_ids_to_delete = get_members('EMAILVERIFICATIONFAILED')
-        if account_ids_to_delete:
-            client.delete_members(
-                AccountIds=account_ids_to_delete,
-                DetectorId=local_detector_id)
-            logger.info('{} : Member deleted due to email verification failure'
-                        ' : {}'.format(region_name, account_ids_to_delete))
-
-        # Invite members that have been created
-        account_ids_to_invite = get_members('CREATED', 'RESIGNED')
-        if account_ids_to_invite:
-            client.invite_members(
-                AccountIds=account_ids_to_invite,
-                DetectorId=local_detector_id,
-                DisableEmailNotification=True)
-            logger.info(
-                '{} : Member invited : {}'.format(
-                    region_name, account_ids_to_invite))
-
-        for account_id in (set(organizations_account_id_map.keys())
-                           & set(account_id_role_arn_map.keys())):
-            boto_session = get_session(account_id_role_arn_map[account_id])
-            member_client = boto_session.client(
-                'guardduty', region_name=region_name)
-            if account_id in get_members('DISABLED'):
-                # For DISABLED members
-                # Update member account detector to enabled
-
-                detector_id = find_or_create_detector(
-                    boto_session, region_name, account_id)
-                member_client.update_detector(
-                    DetectorId=detector_id,
-                    Enable=True)
-                logger.info(
-                    '{} : {} : Member updated to re-enable detector'.format(
-                        region_name, account_id))
-            if account_id in get_members(
-                    'RESIGNED', 'REMOVED', 'INVITED',
-                    'EMAILVERIFICATIONINPROGRESS'):
-                # Get or create a detector in the member account
-                detector_id = find_or_create_detector(
-                    boto_session, region_name, account_id)
-                if account_id in get_members(
-                        'RESIGNED', 'INVITED', 'EMAILVERIFICATIONINPROGRESS'):
-                    # For members with a pending invitation
-                    # Accept the invitation in the member account
-                    response = member_client.list_invitations()
-                    invitation_id = next((
-                        x['InvitationId'] for x in response['Invitations']
-                        if x['AccountId'] == local_account_id), None)
-                    if invitation_id is not None:
-                        member_client.accept_invitation(
-                            DetectorId=detector_id,
-                            InvitationId=invitation_id,
-                            MasterId=local_account_id)
-                        logger.info('{} : {} : Accepted member invite on their'
-                                    ' behalf'.format(region_name, account_id))
-                    else:
-                        logger.error(
-                            '{} : {} : GuardDuty parent reports member '
-                            'RelationshipStatus of {} however member reports '
-                            'pending invitations of {}'.format(
-                                region_name, account_id, members[account_id],
-                                response['Invitations']))
+    # Compare the account maps to the snapshot from the previous run
+    snapshot = None
+    if state_store is not None:
+        snapshot = state_store.get('accounts')
+    changed_account_ids = get_changed_account_ids(
+        snapshot, organizations_account_id_map, account_id_role_arn_map)
+    full_sweep = (
+        snapshot is None
+        or bool((event or {}).get('full_sweep'))
+        or (snapshot['last_full_sweep'] + FULL_SWEEP_INTERVAL < time.time()
+            and event.get('source') != 'aws.organizations'))
+    delta = not full_sweep
+    logger.info('Starting run : full sweep {} : delta {} : changed accounts '
+                '{}'.format(full_sweep, delta, changed_account_ids))
+
+    if SHARD_DISPATCH:
+        results = reconcile_sharded(
+            local_boto_session, guardduty_regions, local_account_id,
+            organizations_account_id_map, account_id_role_arn_map,
+            state_store, delta, changed_account_ids or ())
+    else:
+        results = run_concurrently(
+            lambda region_name: reconcile_region(
+                local_boto_session, region_name, local_account_id,
+                organizations_account_id_map, account_id_role_arn_map,
+                state_store, delta, True, changed_account_ids or ()),
+            guardduty_regions,
+            MAX_REGION_WORKERS)
+
+    if not SHARD_DISPATCH:
+        update_region_health(region_health, results, state_store)
+
+    summary = {'regions': {}, 'failed_regions': [], 'delta': delta}
+    for region_name in sorted(guardduty_regions):
+        region_summary, error = results[region_name]
+        if error is not None:
+            summary['failed_regions'].append(region_name)
+            summary['regions'][region_name] = {'error': repr(error)}
+            logger.error('{} : Failed to reconcile region : {}'.format(
+                region_name, error))
+            if state_store is not None:
+                # Ensure the region isn't skipped by the next delta run
+                state_store.delete('members/{}'.format(region_name))
+        else:
+            summary['regions'][region_name] = region_summary
+
+    if state_store is not None:
+        state_store.put('accounts', {
+            'account_emails': organizations_account_id_map,
+            'account_roles': account_id_role_arn_map,
+            'last_full_sweep': (
+                int(start) if full_sweep and not summary['failed_regions']
+                else snapshot['last_full_sweep'] if snapshot is not None
+                else 0)})
+
+    summary['region_health'] = {
+        x: region_health[x] for x in guardduty_regions if x in region_health}
+    summary['session_cache'] = SESSION_CACHE.stats()
+    summary['member_session_cache'] = MEMBER_SESSION_CACHE.stats()
+    summary['duration'] = round(time.time() - start, 3)
+    logger.info('Run summary : {} of {} regions reconciled in {}s : {}'.format(
+        len(guardduty_regions) - len(summary['failed_regions']),
+        len(guardduty_regions), summary['duration'], summary['regions']))
+    return summary
@@ -1,70 +1,1531 @@
 import boto3
+import gzip
 import json
 import logging
+import os
+import threading
+import time
+import uuid
 
-from datetime import datetime
+from botocore.config import Config
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from os import getenv
 
 
 logger = logging.getLogger(__name__)
 SNS_OUTPUT_TOPIC_ARN = getenv('SNS_OUTPUT_TOPIC_ARN')
+SQS_OUTPUT_QUEUE_URL = getenv('SQS_OUTPUT_QUEUE_URL')
+# Outputs each record was delivered to, keyed by record ID, for up to
+# DELIVERED_OUTPUTS_SIZE records, see send_to_outputs
+DELIVERED_OUTPUTS = OrderedDict()
+DELIVERED_OUTPUTS_SIZE = 10000
+# auto uses orjson when it's installed, json always uses the standard library
+JSON_BACKEND = getenv('JSON_BACKEND', 'auto')
+
+try:
+    if JSON_BACKEND == 'json':
+        raise ImportError('JSON_BACKEND is json')
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    json_loads = json.loads
+    # everything serialized is a tree of parsed or newly built objects so the
+    # encoder needn't check for cycles, which takes a fifth of its time
+    json_dumps = json.JSONEncoder(check_circular=False).encode
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Schema of the normalized events, one of the keys of SCHEMAS
+OUTPUT_SCHEMA = getenv('OUTPUT_SCHEMA', 'mozdef')
+
+# PublishBatch and SendMessageBatch accept up to 10 messages with a combined
+# size of up to 256 KiB
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 262144
+
+# Updates of a finding received within DEDUP_WINDOW seconds of the last one
+# forwarded are suppressed, 0 forwards every update. The latest update
+# suppressed is forwarded once the window closes, by the first invocation of
+# the container which suppressed it after then. Findings are remembered in
+# memory by each container, up to DEDUP_CACHE_SIZE of them, or in the
+# DEDUP_TABLE_NAME DynamoDB table shared by every container when it's set.
+DEDUP_WINDOW = int(getenv('DEDUP_WINDOW', 0))
+DEDUP_CACHE_SIZE = int(getenv('DEDUP_CACHE_SIZE', 10000))
+DEDUP_TABLE_NAME = getenv('DEDUP_TABLE_NAME')
+# Seconds a finding is remembered after it was last forwarded
+DEDUP_RETENTION = int(getenv('DEDUP_RETENTION', 86400))
+DEDUP_CACHE = None
+
+# Normalized findings are also archived as compressed NDJSON objects
+# partitioned by date, account and region when ARCHIVE_BACKEND is s3, to the
+# ARCHIVE_BUCKET bucket, or local, to the ARCHIVE_PATH directory. Findings are
+# buffered across invocations until the container holds ARCHIVE_MAX_BYTES of
+# them or the oldest is ARCHIVE_MAX_AGE seconds old, so that an SNS topology
+# delivering one finding per invocation doesn't write an object per finding.
+# Findings still buffered when a container is shut down are delivered to the
+# output but missing from the archive, an ARCHIVE_MAX_AGE of 0 writes the
+# findings of every invocation before it returns.
+ARCHIVE_BACKEND = getenv('ARCHIVE_BACKEND', '')
+ARCHIVE_BUCKET = getenv('ARCHIVE_BUCKET')
+ARCHIVE_PATH = getenv('ARCHIVE_PATH', 'archive')
+ARCHIVE_PREFIX = getenv('ARCHIVE_PREFIX', 'guardduty/')
+# gzip, or zstd when the zstandard package is installed
+ARCHIVE_COMPRESSION = getenv('ARCHIVE_COMPRESSION', 'gzip')
+ARCHIVE_MAX_BYTES = int(getenv('ARCHIVE_MAX_BYTES', 8388608))
+ARCHIVE_MAX_AGE = int(getenv('ARCHIVE_MAX_AGE', 300))
+ARCHIVE = None
+
+# CloudWatch namespace of the metrics emitted after each batch, empty to not
+# emit them
+METRICS_NAMESPACE = getenv('METRICS_NAMESPACE', 'GuardDutyMultiAccountManager')
+
+# Create the clients during the Lambda init phase, which runs before the
+# first invocation is billed, rather than in the first invocation
+PREWARM_CLIENTS = (getenv('PREWARM_CLIENTS', 'true') == 'true'
+                   and getenv('AWS_LAMBDA_FUNCTION_NAME') is not None)
+# Clients shared by every invocation of the container keyed by service and
+# region
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+# Backfills read the findings of up to BACKFILL_MAX_WORKERS regions at once,
+# sending up to BACKFILL_RATE_LIMIT GuardDuty requests, retries included, per
+# second to each, and send up to BACKFILL_SEND_WORKERS batches at once. A
+# backfill run by the Lambda function stops BACKFILL_TIME_MARGIN seconds
+# before its timeout and returns the checkpoint to resume from.
+BACKFILL_MAX_WORKERS = int(getenv('BACKFILL_MAX_WORKERS', 8))
+BACKFILL_RATE_LIMIT = float(getenv('BACKFILL_RATE_LIMIT', 10))
+BACKFILL_SEND_WORKERS = int(getenv('BACKFILL_SEND_WORKERS', 10))
+BACKFILL_TIME_MARGIN = int(getenv('BACKFILL_TIME_MARGIN', 30))
+BACKFILL_REPORT_INTERVAL = int(getenv('BACKFILL_REPORT_INTERVAL', 10))
+# ListFindings pages and GetFindings batches hold up to 50 findings
+GUARDDUTY_FINDINGS_BATCH_SIZE = 50
+# botocore's adaptive retry mode rate limits each client, counting retries, once it's throttled
+API_MAX_ATTEMPTS = int(getenv('API_MAX_ATTEMPTS', 10))
+BOTO_CONFIG = Config(
+    retries={'max_attempts': API_MAX_ATTEMPTS, 'mode': 'adaptive'})
+
+
+def _parse_iso_8601(iso_8601):
+    """Parse a Zulu ISO 8601 timestamp, e.g. an SNS notification's 2018-04-06T15:57:25.123Z or an EventBridge event's 2018-04-06T15:57:25Z, into a naive datetime."""
+    if iso_8601[-1] != 'Z':
+        raise ValueError('Timestamp {} is not in UTC'.format(iso_8601))
+    # SNS and EventBridge timestamps have fixed offsets so slicing them is
+    # several times faster than strptime, which is left to parse (or reject)
+    # anything else
+    if (len(iso_8601) >= 20 and iso_8601[4] == '-' and iso_8601[7] == '-'
+            and iso_8601[10] == 'T' and iso_8601[13] == ':'
+            and iso_8601[16] == ':' and (len(iso_8601) == 20 or (
+                iso_8601[19] == '.' and 22 <= len(iso_8601) <= 27))):
+        year, month, day = iso_8601[0:4], iso_8601[5:7], iso_8601[8:10]
+        hour, minute, second = iso_8601[11:13], iso_8601[14:16], iso_8601[17:19]
+        fraction = iso_8601[20:-1]
+        if (year + month + day + hour + minute + second + fraction).isdigit():
+            return datetime(
+                int(year), int(month), int(day), int(hour), int(minute),
+                int(second), int(fraction.ljust(6, '0')) if fraction else 0)
+    iso_8601 = iso_8601[:-1]
+    return datetime.strptime(
+        iso_8601, '%Y-%m-%dT%H:%M:%S.%f' if '.' in iso_8601 else '%Y-%m-%dT%H:%M:%S')
 
 def convert_my_iso_8601(iso_8601):
-    assert iso_8601[-1] == 'Z'
-    iso_8601 = iso_8601[:-1] + '000'
-    iso_8601_dt = datetime.strptime(iso_8601, '%Y-%m-%dT%H:%M:%S.%f')
-    return str(iso_8601_dt)
+    """Convert a Zulu ISO 8601 timestamp to the str() of a naive datetime."""
+    return str(_parse_iso_8601(iso_8601))
 
 def send_to_sns(event, sns_client):
     """Send the transformed message to the SNS topic that outputs to another SQS queue."""
     return sns_client.publish(
         TopicArn=SNS_OUTPUT_TOPIC_ARN,
-        Message=json.dumps(event)
+        Message=json_dumps(event)
     )
 
-def _get_resource_info(guardduty_event):
-    resource = guardduty_event['detail'].get('resource', {})
-    instance_detail = resource.get('instanceDetails', None)
-    if instance_detail is not None:
-        return instance_detail.get('instanceId')
+def _batches(entries, max_entries=MAX_BATCH_ENTRIES,
+             max_bytes=MAX_BATCH_BYTES):
+    """Group (record_id, message) entries into batches within the SNS and SQS batch limits."""
+    batch = []
+    batch_bytes = 0
+    for record_id, message in entries:
+        size = len(message.encode('utf-8'))
+        if batch and (len(batch) == max_entries or batch_bytes + size > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append((record_id, message))
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def _send_batch(send, batch):
+    """Send a batch with send and return the record ids of the entries which failed."""
+    try:
+        response = send([
+            {'Id': str(i), 'Message': message}
+            for i, (record_id, message) in enumerate(batch)])
+    except Exception as e:
+        logger.error('Failed to send batch of {} events: {}'.format(len(batch), e))
+        return [record_id for record_id, message in batch]
+    for failure in response.get('Failed', []):
+        logger.error('Failed to send event for record {}: {}'.format(
+            batch[int(failure['Id'])][0], failure.get('Message')))
+    return [batch[int(failure['Id'])][0] for failure in response.get('Failed', [])]
+
+
+def _send_batches(send, entries, executor=None):
+    """Send entries in batches with send, concurrently when given an executor, and return the record ids which failed."""
+    if executor is None:
+        results = [_send_batch(send, batch) for batch in _batches(entries)]
     else:
-        return 'guardduty-{account_id}'.format(account_id=guardduty_event.get('account'))
-
-def transform_event(event):
-    """Take guardDuty SNS notification and turn it into a standard MozDef event."""
-    guardduty_event = json.loads(event['Sns']['Message'])
-
-    mozdef_event = {
-        'timestamp': convert_my_iso_8601(event['Sns'].get('Timestamp')),
-        'hostname': _get_resource_info(guardduty_event),
-        'processname': 'guardduty',
-        'processid': 1337,
-        'severity': 'INFO',
-        'summary': guardduty_event['detail']['description'],
-        'category': guardduty_event['detail']['type'],
-        'source': 'guardduty',
-        'tags': [
-            guardduty_event['detail']['service']['action']['actionType']
-        ],
-        'details': guardduty_event.get('detail')
-    }
+        results = [x.result() for x in [
+            executor.submit(_send_batch, send, batch) for batch in _batches(entries)]]
+    return [record_id for failed in results for record_id in failed]
+
+
+def publish_batch_to_sns(entries, sns_client, executor=None):
+    """Publish (record_id, message) entries to the output SNS topic in batches and return the record ids which failed."""
+    def send(batch_entries):
+        return sns_client.publish_batch(
+            TopicArn=SNS_OUTPUT_TOPIC_ARN,
+            PublishBatchRequestEntries=batch_entries
+        )
+    return _send_batches(send, entries, executor)
+
+
+def send_batch_to_sqs(entries, sqs_client, executor=None):
+    """Send (record_id, message) entries to the output SQS queue in batches and return the record ids which failed."""
+    def send(batch_entries):
+        return sqs_client.send_message_batch(
+            QueueUrl=SQS_OUTPUT_QUEUE_URL,
+            Entries=[{'Id': x['Id'], 'MessageBody': x['Message']} for x in batch_entries]
+        )
+    return _send_batches(send, entries, executor)
+
+
+def _get_outputs():
+    """Return the (name, send) outputs configured, where send sends (record_id, message) entries and returns the record ids which failed."""
+    outputs = []
+    if SNS_OUTPUT_TOPIC_ARN:
+        outputs.append(('sns', lambda entries: publish_batch_to_sns(entries, get_client('sns'))))
+    if SQS_OUTPUT_QUEUE_URL:
+        outputs.append(('sqs', lambda entries: send_batch_to_sqs(entries, get_client('sqs'))))
+    return outputs
+
+
+def send_to_outputs(entries, tracked_ids=()):
+    """Send (record_id, message) entries to every output and return the record ids which failed in any of them.
+
+    With more than one output, or an archive, the outputs each record of
+    tracked_ids was delivered to are remembered in DELIVERED_OUTPUTS so that
+    the retry of a record which failed in one output, or to be archived, is
+    only sent to the outputs it's missing from.
+    """
+    outputs = _get_outputs()
+    failed = []
+    for name, send in outputs:
+        pending = [x for x in entries if name not in DELIVERED_OUTPUTS.get(x[0], ())]
+        if not pending:
+            continue
+        output_failed = send(pending)
+        failed.extend(output_failed)
+        if len(outputs) < 2 and not ARCHIVE_BACKEND:
+            # A record delivered to a single output can still fail in the archive
+            continue
+        output_failed = set(output_failed)
+        for record_id, _ in pending:
+            if record_id in tracked_ids and record_id not in output_failed:
+                DELIVERED_OUTPUTS.setdefault(record_id, set()).add(name)
+                DELIVERED_OUTPUTS.move_to_end(record_id)
+        while len(DELIVERED_OUTPUTS) > DELIVERED_OUTPUTS_SIZE:
+            DELIVERED_OUTPUTS.popitem(last=False)
+    return list(dict.fromkeys(failed))
+
+
+def _get_record_id(record):
+    """Return the identifier Lambda uses to report a record as failed."""
+    if 'Sns' in record:
+        return record['Sns']['MessageId']
+    if 'messageId' in record:
+        return record['messageId']
+    # An EventBridge event invoking the function directly
+    return record['id']
+
+
+def _get_notification_and_event(record):
+    """Return the SNS notification, or the equivalent of one, and the parsed GuardDuty event of a record.
+
+    Records are SNS records, SQS records of a queue subscribed to SNS, SQS
+    records of the fan-in queue whose bodies are EventBridge events or
+    EventBridge events invoking the function directly. EventBridge events
+    are timestamped with their time.
+    """
+    if 'Sns' in record:
+        notification = record['Sns']
+    elif 'body' in record:
+        body = json_loads(record['body'])
+        if 'detail-type' in body:
+            return {'MessageId': record['messageId'], 'Timestamp': body['time']}, body
+        notification = body
+    else:
+        return {'MessageId': record['id'], 'Timestamp': record['time']}, record
+    return notification, json_loads(notification['Message'])
+
+
+# Paths, from the finding detail, of the identifier used as the hostname of
+# each resource type. The first path present is used and findings without
+# one get a hostname of guardduty-<account>.
+RESOURCE_HOSTNAME_PATHS = {
+    'Instance': ['resource.instanceDetails.instanceId'],
+    'S3Bucket': ['resource.s3BucketDetails.0.name'],
+    'EKSCluster': ['resource.eksClusterDetails.name'],
+    'Lambda': ['resource.lambdaDetails.functionName'],
+    'RDSDBInstance': ['resource.rdsDbInstanceDetails.dbInstanceIdentifier'],
+    'ECSCluster': ['resource.ecsClusterDetails.name'],
+    'Container': ['resource.containerDetails.name'],
+}
+
+# Output schemas. Dotted keys are nested objects and values are mapping specs:
+#   'a.b'                 the value at a path from the finding detail
+#   ('const', value)      a constant
+#   ('list', spec)        a list of the value of another spec
+#   {key: spec}           an object of the values of other specs
+#   ('timestamp', format) the SNS timestamp as mozdef, iso or epoch_ms
+#   ('hostname',)         the identifier of the resource
+#   ('severity', labels)  the finding severity mapped to a label
+#   ('detail',)           the whole finding detail
+SCHEMAS = {
+    'mozdef': {
+        'timestamp': ('timestamp', 'mozdef'),
+        'hostname': ('hostname',),
+        'processname': ('const', 'guardduty'),
+        'processid': ('const', 1337),
+        'severity': ('const', 'INFO'),
+        'summary': 'description',
+        'category': 'type',
+        'source': ('const', 'guardduty'),
+        'tags': ('list', 'finding.action.actionType'),
+        'details': ('detail',),
+    },
+    'ecs': {
+        '@timestamp': ('timestamp', 'iso'),
+        'message': 'description',
+        'event.kind': ('const', 'alert'),
+        'event.module': ('const', 'aws'),
+        'event.dataset': ('const', 'aws.guardduty'),
+        'event.provider': ('const', 'guardduty'),
+        'event.id': 'id',
+        'event.created': 'createdAt',
+        'event.severity': 'severity',
+        'event.action': 'finding.action.actionType',
+        'rule.name': 'type',
+        'rule.description': 'title',
+        'cloud.provider': ('const', 'aws'),
+        'cloud.account.id': 'accountId',
+        'cloud.region': 'region',
+        'host.name': ('hostname',),
+        'aws.guardduty': ('detail',),
+    },
+    'ocsf': {
+        'class_uid': ('const', 2004),
+        'category_uid': ('const', 2),
+        'activity_id': ('const', 1),
+        'type_uid': ('const', 200401),
+        'time': ('timestamp', 'epoch_ms'),
+        'severity_id': ('severity', (2, 3, 4, 5)),
+        'severity': ('severity', ('Low', 'Medium', 'High', 'Critical')),
+        'message': 'description',
+        'finding_info.uid': 'id',
+        'finding_info.title': 'title',
+        'finding_info.desc': 'description',
+        'finding_info.types': ('list', 'type'),
+        'cloud.provider': ('const', 'AWS'),
+        'cloud.region': 'region',
+        'cloud.account.uid': 'accountId',
+        'resources': ('list', {'type': 'resource.resourceType',
+                               'uid': ('hostname',)}),
+        'metadata.version': ('const', '1.1.0'),
+        'metadata.product.name': ('const', 'GuardDuty'),
+        'metadata.product.vendor_name': ('const', 'AWS'),
+        'unmapped': ('detail',),
+    },
+}
+
+
+def _path_getter(path):
+    """Return a function of the finding detail which returns the value at a dotted path or None."""
+    keys = tuple(int(x) if x.isdigit() else x for x in path.split('.'))
+
+    if any(isinstance(key, int) for key in keys):
+        def getter(detail):
+            value = detail
+            for key in keys:
+                if isinstance(key, int):
+                    value = _item(value, key)
+                elif isinstance(value, dict):
+                    value = value.get(key)
+                else:
+                    return None
+            return value
+        return getter
+
+    def getter(detail):
+        # a missing key, or a key into a list or scalar, returns None
+        value = detail
+        try:
+            for key in keys:
+                value = value[key]
+        except (KeyError, TypeError):
+            return None
+        return value
+    return getter
+
+
+def _item(sequence, index):
+    if isinstance(sequence, list) and len(sequence) > index:
+        return sequence[index]
+    return None
+
+
+def _severity_label(severity, labels):
+    # GuardDuty severities are Low 1-3.9, Medium 4-6.9, High 7-8.9 and
+    # Critical 9 and up
+    severity = severity or 0
+    return labels[
+        0 if severity < 4 else 1 if severity < 7 else 2 if severity < 9 else 3]
+
+
+# Parsed timestamps are naive UTC datetimes
+EPOCH = datetime(1970, 1, 1)
+MILLISECOND = timedelta(milliseconds=1)
+
+
+def _timestamp_to_epoch_ms(iso_8601):
+    return (_parse_iso_8601(iso_8601) - EPOCH) // MILLISECOND
+
+
+TIMESTAMP_CONVERTERS = {
+    'mozdef': convert_my_iso_8601,
+    'iso': lambda iso_8601: iso_8601,
+    'epoch_ms': _timestamp_to_epoch_ms,
+}
+
+
+def _spec_getter(spec, resource_type):
+    """Return a function of (notification, guardduty_event, detail) which returns the value of a mapping spec."""
+    if isinstance(spec, str):
+        if '.' not in spec:
+            return lambda notification, guardduty_event, detail: detail.get(spec)
+        path = _path_getter(spec)
+        return lambda notification, guardduty_event, detail: path(detail)
+    if isinstance(spec, dict):
+        return _object_getter(spec, resource_type)
+    kind = spec[0]
+    if kind == 'const':
+        value = spec[1]
+        return lambda notification, guardduty_event, detail: value
+    if kind == 'list':
+        item = _spec_getter(spec[1], resource_type)
+        return lambda notification, guardduty_event, detail: [
+            item(notification, guardduty_event, detail)]
+    if kind == 'timestamp':
+        convert = TIMESTAMP_CONVERTERS[spec[1]]
+        return lambda notification, guardduty_event, detail: convert(
+            notification.get('Timestamp'))
+    if kind == 'hostname':
+        paths = [_path_getter(x) for x in RESOURCE_HOSTNAME_PATHS.get(resource_type, [])]
+
+        def hostname(notification, guardduty_event, detail):
+            for path in paths:
+                value = path(detail)
+                if value:
+                    return value
+            return 'guardduty-{}'.format(guardduty_event.get('account'))
+        return hostname
+    if kind == 'severity':
+        labels = spec[1]
+        return lambda notification, guardduty_event, detail: _severity_label(
+            detail.get('severity'), labels)
+    if kind == 'detail':
+        return lambda notification, guardduty_event, detail: detail
+    raise ValueError('Unknown mapping spec {}'.format(spec))
+
+
+def _object_getter(fields, resource_type):
+    """Return a function which builds an object from a dict of dotted output keys and specs."""
+    tree = {}
+    for key, spec in fields.items():
+        node = tree
+        parts = key.split('.')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = spec
+
+    def getter(node):
+        # constants are set in a template, in order with the other keys, which
+        # each object starts as a copy of
+        template = {}
+        getters = []
+        for key, value in node.items():
+            if isinstance(value, tuple) and value[0] == 'const':
+                template[key] = value[1]
+            else:
+                template[key] = None
+                getters.append((key, getter(value) if isinstance(value, dict)
+                                else _spec_getter(value, resource_type)))
+
+        def build(notification, guardduty_event, detail):
+            obj = template.copy()
+            for key, value in getters:
+                obj[key] = value(notification, guardduty_event, detail)
+            return obj
+        return build
+    return getter(tree)
+
+
+@lru_cache(maxsize=None)
+def get_transform(schema, resource_type):
+    """Return the transform of a schema for a resource type.
+
+    The schema's specs are resolved into a tree of small functions, with the
+    paths split and the hostname paths of the resource type looked up, once
+    per resource type and reused for every finding of that type handled by
+    the Lambda container.
+    """
+    return _object_getter(SCHEMAS[schema], resource_type)
+
+
+def transform_event(event, schema=None):
+    """Take guardDuty SNS notification and turn it into a normalized event, MozDef by default."""
+    notification, guardduty_event = _get_notification_and_event(event)
+    return transform_guardduty_event(notification, guardduty_event, schema)
+
+
+def transform_guardduty_event(notification, guardduty_event, schema=None):
+    """Turn a parsed GuardDuty event from an SNS notification into a normalized event."""
+    # details references the parsed detail tree rather than copying it
+    detail = guardduty_event['detail']
 
     # there is only one 'service', guard duty
     # rename details.service to details.finding
     # to make it more descriptive and match aws docs
     # and avoid schema collisions
-    mozdef_event['details']['finding']=mozdef_event['details'].pop('service')
+    detail['finding'] = detail.pop('service')
+
+    return get_transform(
+        schema or OUTPUT_SCHEMA,
+        detail.get('resource', {}).get('resourceType'))(
+        notification, guardduty_event, detail)
+
+
+class FindingDedupCache:
+    """A bounded LRU of the last forwarded update of each finding.
+
+    Updates are only recorded with commit once they've been delivered. The
+    latest update of each finding suppressed within the window is kept with
+    defer until due returns it after the window closes, and it's dropped then
+    if a later update was forwarded in the meantime.
+    """
+
+    def __init__(self, window, max_size, retention):
+        self.window = window
+        self.max_size = max_size
+        self.retention = retention
+        self.entries = OrderedDict()
+        self.deferred = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'forwarded': 0, 'suppressed': 0, 'trailing': 0}
+
+    def _last_forwarded(self, finding_id, now):
+        with self.lock:
+            previous = self.entries.get(finding_id)
+            if previous is not None:
+                self.entries.move_to_end(finding_id)
+        return previous
+
+    def check(self, finding_id, count, now=None):
+        """Return whether to forward an update, the count since the last update forwarded and when that was."""
+        now = time.time() if now is None else now
+        previous = self._last_forwarded(finding_id, now)
+        if previous is not None and now - previous[0] >= self.retention:
+            previous = None
+        if previous is not None and now - previous[0] < self.window:
+            with self.lock:
+                self.stats['suppressed'] += 1
+            return False, 0, previous[0]
+        with self.lock:
+            self.stats['forwarded'] += 1
+        return True, _count_delta(count, previous and previous[1]), previous and previous[0]
+
+    def commit(self, finding_id, count, now=None):
+        """Record an update which was delivered."""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.entries[finding_id] = (now, count)
+            self.entries.move_to_end(finding_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def defer(self, finding_id, forwarded, count, update):
+        """Keep the latest update suppressed in the window which started at forwarded, replacing any earlier one."""
+        with self.lock:
+            self.deferred.pop(finding_id, None)
+            self.deferred[finding_id] = (forwarded, count, update)
+            while len(self.deferred) > self.max_size:
+                self.deferred.popitem(last=False)
+
+    def due(self, now=None):
+        """Remove and return the (finding_id, forwarded, count, update) deferred updates whose window has closed."""
+        now = time.time() if now is None else now
+        with self.lock:
+            due = [(finding_id, forwarded, count, update)
+                   for finding_id, (forwarded, count, update) in self.deferred.items()
+                   if now - forwarded >= self.window]
+            for finding_id, forwarded, count, update in due:
+                del self.deferred[finding_id]
+            self.stats['trailing'] += len(due)
+        return due
+
+
+class DynamoDBFindingDedupCache(FindingDedupCache):
+    """The last forwarded update of each finding in a DynamoDB table, shared by every container.
+
+    Deliveries are recorded with a conditional write so that when containers
+    race to forward the same finding, the first one recorded starts the
+    window. Deferred updates are kept by the container which suppressed them.
+    """
+
+    def __init__(self, window, table_name, retention, client, max_size):
+        super().__init__(window, max_size, retention)
+        self.table_name = table_name
+        self.client = client
+
+    def _last_forwarded(self, finding_id, now):
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={'finding-id': {'S': finding_id}},
+            ConsistentRead=True).get('Item')
+        if item is None or int(item['expires']['N']) <= now:
+            return None
+        return int(item['forwarded']['N']), int(item['finding_count']['N'])
+
+    def commit(self, finding_id, count, now=None):
+        """Record an update which was delivered unless another container recorded one within the window."""
+        now = int(time.time() if now is None else now)
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'finding-id': {'S': finding_id}},
+                UpdateExpression='SET forwarded = :now, finding_count = :count, expires = :expires',
+                ConditionExpression='attribute_not_exists(forwarded) OR forwarded < :window_start',
+                ExpressionAttributeValues={
+                    ':now': {'N': str(now)},
+                    ':count': {'N': str(count)},
+                    ':expires': {'N': str(now + self.retention)},
+                    ':window_start': {'N': str(now - self.window)}})
+        except self.client.exceptions.ConditionalCheckFailedException:
+            logger.info('Finding {} was forwarded concurrently by another container'.format(finding_id))
+
+
+def _count_delta(count, previous_count):
+    if previous_count is None or count < previous_count:
+        return count
+    return count - previous_count
+
+
+def get_dedup_cache():
+    """Return the finding dedup cache of this container or None when dedup is disabled."""
+    global DEDUP_CACHE
+    if DEDUP_WINDOW <= 0:
+        return None
+    if DEDUP_CACHE is None:
+        if DEDUP_TABLE_NAME:
+            DEDUP_CACHE = DynamoDBFindingDedupCache(
+                DEDUP_WINDOW, DEDUP_TABLE_NAME, DEDUP_RETENTION,
+                get_client('dynamodb'), DEDUP_CACHE_SIZE)
+        else:
+            DEDUP_CACHE = FindingDedupCache(
+                DEDUP_WINDOW, DEDUP_CACHE_SIZE, DEDUP_RETENTION)
+    return DEDUP_CACHE
+
+
+def deduplicate(detail, dedup_cache, now=None):
+    """Check a transformed finding against the dedup cache.
+
+    Forwarded findings get a finding.countDelta of the occurrences since the
+    last update forwarded. Returns whether to forward the finding and when
+    the last update was forwarded.
+    """
+    finding = detail['finding']
+    count = finding.get('count', 1)
+    try:
+        forward, count_delta, forwarded = dedup_cache.check(detail['id'], count, now)
+    except Exception as e:
+        # Forwarding a duplicate is better than dropping a finding
+        logger.error('Failed to deduplicate finding {}: {}'.format(
+            detail.get('id'), e))
+        return True, None
+    if forward:
+        finding['countDelta'] = count_delta
+    return forward, forwarded
+
+
+# Archive compressions keyed by name, with their file extension and content
+# type
+COMPRESSIONS = {
+    'gzip': ('gz', 'application/gzip', lambda data: gzip.compress(data, 6)),
+}
+if zstandard is not None:
+    COMPRESSIONS['zstd'] = (
+        'zst', 'application/zstd',
+        lambda data: zstandard.ZstdCompressor(level=3).compress(data))
+
+
+def archive_partition(guardduty_event):
+    """Return the (date, account, region) archive partition of a GuardDuty event."""
+    return ((guardduty_event.get('time') or time.strftime('%Y-%m-%d', time.gmtime()))[:10],
+            guardduty_event.get('account'), guardduty_event.get('region'))
+
+
+class FindingArchive:
+    """Normalized findings buffered by partition and written as compressed NDJSON objects.
+
+    Each partition's findings are written as an object keyed
+    <prefix>date=<date>/account=<account>/region=<region>/<time>-<uuid>.ndjson.<extension>.
+    When a write fails, the findings of the records being handled are dropped
+    so that the records are retried, while findings of earlier invocations
+    stay buffered for the next flush, up to four times max_bytes.
+    """
+
+    def __init__(self, write, compression, max_bytes, max_age, prefix=''):
+        self.write = write
+        self.extension, self.content_type, self.compress = COMPRESSIONS[compression]
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.prefix = prefix
+        self.partitions = {}
+        self.size = 0
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.stats = {'findings': 0, 'objects': 0, 'bytes': 0,
+                      'compressed_bytes': 0, 'dropped': 0}
+
+    def add(self, partition, message, now=None, record_id=None):
+        line = message.encode('utf-8') + b'\n'
+        with self.lock:
+            self.partitions.setdefault(partition, []).append((record_id, line))
+            self.size += len(line)
+            if self.oldest is None:
+                self.oldest = time.time() if now is None else now
+
+    def due(self, now=None):
+        """Return whether the buffered findings have reached the size or age bound."""
+        now = time.time() if now is None else now
+        return self.oldest is not None and (
+            self.size >= self.max_bytes or now - self.oldest >= self.max_age)
 
-    return mozdef_event
+    def _key(self, partition):
+        """Return a new object key of a partition."""
+        date, account, region = partition
+        return '{}date={}/account={}/region={}/{}-{}.ndjson.{}'.format(
+            self.prefix, date, account, region,
+            time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), uuid.uuid4().hex,
+            self.extension)
+
+    def flush(self, force=False, now=None, record_ids=()):
+        """Write the buffered findings if a bound is reached, or if forced, and return the ids of record_ids whose findings failed to be written."""
+        with self.lock:
+            if not self.partitions or not (force or self.due(now)):
+                return []
+            partitions, oldest = self.partitions, self.oldest
+            self.partitions, self.size, self.oldest = {}, 0, None
+            failed = []
+            for partition, lines in partitions.items():
+                body = b''.join(line for _, line in lines)
+                try:
+                    compressed = self.compress(body)
+                    self.write([(self._key(partition), compressed)], self.content_type)
+                except Exception as e:
+                    logger.error('Failed to archive {} findings of {}: {}'.format(
+                        len(lines), '/'.join(str(x) for x in partition), e))
+                    failed.extend(x for x, _ in lines if x in record_ids)
+                    lines = [x for x in lines if x[0] not in record_ids]
+                    if lines:
+                        self.partitions.setdefault(partition, [])[:0] = lines
+                        self.size += sum(len(line) for _, line in lines)
+                        self.oldest = oldest
+                    continue
+                self.stats['findings'] += len(lines)
+                self.stats['objects'] += 1
+                self.stats['bytes'] += len(body)
+                self.stats['compressed_bytes'] += len(compressed)
+            if self.size > 4 * self.max_bytes:
+                dropped = sum(len(x) for x in self.partitions.values())
+                logger.error('Dropped {} findings which could not be archived'.format(dropped))
+                self.stats['dropped'] += dropped
+                self.partitions, self.size, self.oldest = {}, 0, None
+        return list(dict.fromkeys(failed))
+
+
+def write_to_s3(objects, content_type):
+    client = get_client('s3')
+    for key, body in objects:
+        client.put_object(Bucket=ARCHIVE_BUCKET, Key=key, Body=body,
+                          ContentType=content_type)
+
+
+def write_to_local(objects, content_type):
+    for key, body in objects:
+        path = os.path.join(ARCHIVE_PATH, *key.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(path + '.tmp', path)
+
+
+ARCHIVE_WRITERS = {
+    's3': write_to_s3,
+    'local': write_to_local,
+}
+
+
+def get_archive():
+    """Return the finding archive of this container or None when archiving is disabled."""
+    global ARCHIVE
+    if not ARCHIVE_BACKEND:
+        return None
+    if ARCHIVE is None:
+        compression = ARCHIVE_COMPRESSION
+        if compression not in COMPRESSIONS:
+            logger.warning('{} compression is not available, archiving with gzip'.format(compression))
+            compression = 'gzip'
+        ARCHIVE = FindingArchive(
+            ARCHIVE_WRITERS[ARCHIVE_BACKEND], compression, ARCHIVE_MAX_BYTES,
+            ARCHIVE_MAX_AGE, ARCHIVE_PREFIX)
+    return ARCHIVE
+
+
+class Metrics:
+    """Timings of the phases of a batch and of its API calls by operation.
+
+    Phases are timed once per batch rather than per record so that the
+    transform loop isn't slowed down. The wait of an API call is the time it
+    was blocked by a rate limiter or backing off between retries rather than
+    sending requests. emit prints them as a single CloudWatch Embedded Metric
+    Format document.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        # The wait of the call in progress on each thread, as the before-send and needs-retry events aren't
+        # given its context
+        self.waits = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.calls = {}
+
+    def record(self, counters, key, seconds, retries=0, error=False, wait=0.0):
+        with self.lock:
+            counter = counters.setdefault(key, {
+                'count': 0, 'time': 0.0, 'retries': 0, 'errors': 0, 'wait': 0.0})
+            counter['count'] += 1
+            counter['time'] += seconds
+            counter['retries'] += retries
+            counter['errors'] += error
+            counter['wait'] += wait
+
+    def attach(self, client):
+        """Time every call made by a client through its event hooks."""
+        service_name = client.meta.service_model.service_name
+        waits = self.waits
+
+        def before_call(context=None, **kwargs):
+            if context is not None:
+                context['metrics_start'] = time.perf_counter()
+            waits.wait = 0.0
+            waits.sending = waits.retrying = None
+
+        def before_send(**kwargs):
+            # Runs before any rate limiter's before-send handler, and ends the backoff of a retry
+            now = time.perf_counter()
+            if getattr(waits, 'retrying', None) is not None:
+                waits.wait += now - waits.retrying
+            waits.sending = now
+            waits.retrying = None
+
+        def sending(**kwargs):
+            # Runs after every other before-send handler
+            if getattr(waits, 'sending', None) is not None:
+                waits.wait += time.perf_counter() - waits.sending
+                waits.sending = None
+
+        def needs_retry(**kwargs):
+            waits.retrying = time.perf_counter()
+
+        def after_call(event_name, context=None, parsed=None, **kwargs):
+            if context is None or 'metrics_start' not in context:
+                return
+            parsed = parsed or {}
+            self.record(
+                self.calls,
+                '{}.{}'.format(service_name, event_name.rsplit('.', 1)[-1]),
+                time.perf_counter() - context.pop('metrics_start'),
+                parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                'Error' in parsed, getattr(waits, 'wait', 0.0))
+
+        def after_call_error(event_name, context=None, **kwargs):
+            after_call(event_name, context, {'Error': {}})
+
+        client.meta.events.register('before-call', before_call)
+        client.meta.events.register_first('before-send', before_send)
+        client.meta.events.register_last('before-send', sending)
+        client.meta.events.register_last('needs-retry', needs_retry)
+        client.meta.events.register('after-call', after_call)
+        client.meta.events.register('after-call-error', after_call_error)
+        return client
+
+    def emit(self, counts, **properties):
+        """Print the timings and counts as an Embedded Metric Format document and return it."""
+        metrics = {
+            'Duration': round((time.perf_counter() - self.start) * 1000, 1),
+            'ApiCalls': sum(x['count'] for x in self.calls.values()),
+            'ApiTime': round(sum(x['time'] for x in self.calls.values()) * 1000, 1),
+            'ApiRetries': sum(x['retries'] for x in self.calls.values()),
+            'ApiErrors': sum(x['errors'] for x in self.calls.values()),
+            'ApiWaitTime': round(sum(x['wait'] for x in self.calls.values()) * 1000, 1),
+        }
+        for name, phase in self.phases.items():
+            metrics['{}Time'.format(name)] = round(phase['time'] * 1000, 1)
+        metrics.update(counts)
+        document = dict(properties, api={
+            key: dict(x, time=round(x['time'] * 1000, 1), wait=round(x['wait'] * 1000, 1))
+            for key, x in self.calls.items()}, **metrics)
+        document['Function'] = getenv('AWS_LAMBDA_FUNCTION_NAME', 'normalization')
+        document['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [['Function']],
+                'Metrics': [
+                    {'Name': name, 'Unit': 'Milliseconds' if name == 'Duration' or name.endswith('Time')
+                     else 'Count'}
+                    for name in metrics]}]}
+        if self.namespace:
+            print(json_dumps(document), flush=True)
+        return document
+
+
+METRICS = Metrics(METRICS_NAMESPACE)
+
+
+class RateLimiter:
+    """Token bucket rate limiter with a bucket per (service, region).
+
+    Every attempt of a call, retries included, takes a token when its request
+    is sent. It caps the rate of calls while the adaptive retry mode of
+    BOTO_CONFIG slows a client down further once it's throttled.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.waits = 0
+        self.waited = 0.0
+
+    def acquire(self, key):
+        """Take a token from the key's bucket, waiting for one if needed."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = {
+                        'tokens': max(self.rate, 1.0), 'updated': time.monotonic()}
+                now = time.monotonic()
+                bucket['tokens'] = min(
+                    max(self.rate, 1.0),
+                    bucket['tokens'] + (now - bucket['updated']) * self.rate)
+                bucket['updated'] = now
+                if bucket['tokens'] >= 1:
+                    bucket['tokens'] -= 1
+                    self.calls += 1
+                    if waited:
+                        self.waits += 1
+                        self.waited += waited
+                    return waited
+                delay = (1 - bucket['tokens']) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def attach(self, client):
+        """Rate limit every request sent by a client through its event hooks."""
+        key = (client.meta.service_model.service_name, client.meta.region_name)
+
+        def before_send(**kwargs):
+            self.acquire(key)
+
+        client.meta.events.register('before-send', before_send)
+        return client
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'waits': self.waits,
+                    'waited': round(self.waited, 3)}
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = 0
+            self.waits = 0
+            self.waited = 0.0
+
+
+# Only the GuardDuty calls of backfills are rate limited
+RATE_LIMITER = RateLimiter(BACKFILL_RATE_LIMIT)
+
+
+def get_client(service_name, region_name=None):
+    """Return the client of a service shared by every invocation of the container.
+
+    Clients are created under a lock as the default boto3 session isn't
+    thread safe. GuardDuty clients retry in BOTO_CONFIG's adaptive mode and
+    every request they send is rate limited by RATE_LIMITER.
+    """
+    key = (service_name, region_name)
+    client = CLIENTS.get(key)
+    if client is None:
+        with CLIENTS_LOCK:
+            client = CLIENTS.get(key)
+            if client is None:
+                if service_name == 'guardduty':
+                    client = RATE_LIMITER.attach(boto3.client(
+                        service_name, region_name=region_name, config=BOTO_CONFIG))
+                else:
+                    client = boto3.client(service_name, region_name=region_name)
+                client = CLIENTS[key] = METRICS.attach(client)
+    return client
+
+
+def _camel_case_keys(value):
+    """Return a GetFindings value with the camelCase keys EventBridge delivers findings with."""
+    if isinstance(value, dict):
+        return {key[:1].lower() + key[1:]: _camel_case_keys(item)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [_camel_case_keys(item) for item in value]
+    return value
+
+
+def finding_to_event(finding, region_name):
+    """Wrap a GetFindings finding in the EventBridge event GuardDuty delivers for it."""
+    return {
+        'version': '0',
+        'id': finding['Id'],
+        'detail-type': 'GuardDuty Finding',
+        'source': 'aws.guardduty',
+        'account': finding['AccountId'],
+        'time': finding['UpdatedAt'][:19] + 'Z',
+        'region': region_name,
+        'resources': [],
+        'detail': _camel_case_keys(finding),
+    }
+
+
+def iter_backfill_events(findings, region_name, schema=None):
+    """Transform GetFindings findings one at a time, yielding (finding_id, message) entries.
+
+    Findings are transformed as if their last update had been delivered
+    through SNS at the time it was made. Findings which fail to transform are
+    logged and skipped.
+    """
+    for finding in findings:
+        try:
+            notification = {'MessageId': 'backfill-{}'.format(finding['Id']),
+                            'Timestamp': finding['UpdatedAt']}
+            yield finding['Id'], json_dumps(transform_guardduty_event(
+                notification, finding_to_event(finding, region_name), schema))
+        except Exception as e:
+            logger.error('Failed to transform finding {}: {}'.format(
+                finding.get('Id'), e))
+
+
+def _criteria_since(criteria, updated_at):
+    """Return FindingCriteria restricted to findings updated at or after updated_at, in epoch milliseconds."""
+    criterion = dict((criteria or {}).get('Criterion', {}))
+    criterion['updatedAt'] = dict(
+        criterion.get('updatedAt', {}), GreaterThanOrEqual=int(updated_at))
+    return dict(criteria or {}, Criterion=criterion)
+
+
+def iter_finding_pages(client, detector_id, criteria, state, deadline=None):
+    """Yield the findings of a detector a page at a time, oldest update first, with the state to resume after the page.
+
+    Reading resumes from the NextToken saved in state or, when it's no
+    longer accepted, from the last update time saved in state. The listing
+    is then restricted to findings updated since that time, which is saved
+    in state as since so that later tokens are used with the same criteria.
+    No page is started after the deadline, a time.monotonic() value.
+    """
+    sort_criteria = {'AttributeName': 'updatedAt', 'OrderBy': 'ASC'}
+    kwargs = {'DetectorId': detector_id, 'SortCriteria': sort_criteria,
+              'MaxResults': GUARDDUTY_FINDINGS_BATCH_SIZE}
+    next_token = state.get('next_token')
+    while deadline is None or time.monotonic() < deadline:
+        kwargs['FindingCriteria'] = (
+            criteria if state.get('since') is None
+            else _criteria_since(criteria, state['since']))
+        try:
+            response = client.list_findings(
+                **dict(kwargs, NextToken=next_token) if next_token else kwargs)
+        except client.exceptions.BadRequestException as e:
+            if not next_token:
+                raise
+            logger.warning('{} : Resuming from the last update time as the saved token was rejected: {}'.format(
+                client.meta.region_name, e))
+            state = dict(state, since=state.get('updated_at'))
+            next_token = None
+            continue
+        finding_ids = response['FindingIds']
+        findings = client.get_findings(
+            DetectorId=detector_id, FindingIds=finding_ids,
+            SortCriteria=sort_criteria)['Findings'] if finding_ids else []
+        next_token = response.get('NextToken')
+        updated_at = max(
+            [_timestamp_to_epoch_ms(x['UpdatedAt']) for x in findings]
+            + [state.get('updated_at') or 0])
+        state = dict(state, next_token=next_token, updated_at=updated_at,
+                     done=not next_token)
+        yield findings, state
+        if not next_token:
+            return
+
+
+def _prefetched(iterator, executor):
+    """Yield the items of an iterator, getting the next item in executor while the current one is used."""
+    future = executor.submit(next, iterator, None)
+    while True:
+        item = future.result()
+        if item is None:
+            return
+        future = executor.submit(next, iterator, None)
+        yield item
+
+
+class BackfillOutput:
+    """Where backfilled events go: the output SNS topic or SQS queue, in
+    batches sent concurrently, or a newline delimited JSON file."""
+
+    def __init__(self, output=None, path=None, max_workers=BACKFILL_SEND_WORKERS):
+        self.output = output or ('sns' if SNS_OUTPUT_TOPIC_ARN else 'sqs')
+        self.lock = threading.Lock()
+        self.executor = None
+        self.file = None
+        if self.output == 'ndjson':
+            if not path:
+                raise ValueError('A path is needed for ndjson output')
+            self.file = open(path, 'a', encoding='utf-8')
+        elif self.output == 'sns' and SNS_OUTPUT_TOPIC_ARN or self.output == 'sqs' and SQS_OUTPUT_QUEUE_URL:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        else:
+            raise ValueError('Output {} is not configured'.format(self.output))
+
+    def send(self, entries):
+        """Send (finding_id, message) entries and return the finding ids which failed."""
+        if self.output == 'sns':
+            return publish_batch_to_sns(entries, get_client('sns'), self.executor)
+        if self.output == 'sqs':
+            return send_batch_to_sqs(entries, get_client('sqs'), self.executor)
+        lines = ''.join('{}\n'.format(message) for _, message in entries)
+        with self.lock:
+            self.file.write(lines)
+            self.file.flush()
+        return []
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.file is not None:
+            self.file.close()
+
+
+class BackfillProgress:
+    """The checkpoint of a backfill and the findings it has sent per region.
+
+    The checkpoint holds the state to resume each region from and is saved
+    to checkpoint_path after every page when it's set. Throughput is logged
+    every BACKFILL_REPORT_INTERVAL seconds.
+    """
+
+    def __init__(self, checkpoint=None, checkpoint_path=None):
+        self.checkpoint = {'regions': dict((checkpoint or {}).get('regions', {}))}
+        self.checkpoint_path = checkpoint_path
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.reported = self.start
+        self.findings = {}
+
+    def state(self, region_name):
+        with self.lock:
+            return dict(self.checkpoint['regions'].get(region_name, {}))
+
+    def update(self, region_name, state, findings=0):
+        """Record the findings of a page as sent and the state to resume the region after it."""
+        with self.lock:
+            self.checkpoint['regions'][region_name] = dict(
+                state, findings=self.checkpoint['regions'].get(
+                    region_name, {}).get('findings', 0) + findings)
+            self.findings[region_name] = self.findings.get(region_name, 0) + findings
+            if self.checkpoint_path:
+                _save_checkpoint(self.checkpoint_path, self.checkpoint)
+            now = time.monotonic()
+            if now - self.reported < BACKFILL_REPORT_INTERVAL:
+                return
+            self.reported = now
+            total = sum(self.findings.values())
+        logger.info('Backfill : {} findings in {:.1f}s : {:.1f} findings/s'.format(
+            total, now - self.start, total / (now - self.start)))
+
+    def failed(self, region_name, error):
+        with self.lock:
+            self.checkpoint['regions'][region_name] = dict(
+                self.checkpoint['regions'].get(region_name, {}), error=repr(error))
+            if self.checkpoint_path:
+                _save_checkpoint(self.checkpoint_path, self.checkpoint)
+
+    def summary(self):
+        with self.lock:
+            duration = max(time.monotonic() - self.start, 1e-9)
+            total = sum(self.findings.values())
+            return {
+                'findings': total,
+                'duration': round(duration, 3),
+                'findings_per_second': round(total / duration, 1),
+                'regions': {
+                    region_name: {
+                        'findings': self.findings.get(region_name, 0),
+                        'findings_per_second': round(
+                            self.findings.get(region_name, 0) / duration, 1),
+                        'done': bool(state.get('done')),
+                        'error': state.get('error')}
+                    for region_name, state in sorted(self.checkpoint['regions'].items())},
+                'complete': all(
+                    x.get('done') for x in self.checkpoint['regions'].values()),
+                'checkpoint': json_loads(json_dumps(self.checkpoint)),
+            }
+
+
+def _save_checkpoint(path, checkpoint):
+    """Replace the checkpoint file so that it's never left half written."""
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(json_dumps(checkpoint))
+    os.replace(path + '.tmp', path)
+
+
+def _load_checkpoint(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json_loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def get_backfill_regions():
+    """Return the GuardDuty regions enabled in the account, or every GuardDuty region if they can't be listed."""
+    regions = boto3.session.Session().get_available_regions('guardduty')
+    try:
+        enabled = {x['RegionName'] for x in get_client('ec2').describe_regions()['Regions']}
+    except Exception as e:
+        logger.warning('Failed to list the enabled regions, using every GuardDuty region: {}'.format(e))
+        return regions
+    return [x for x in regions if x in enabled]
+
+
+def backfill_region(region_name, criteria, schema, output, progress, executor, deadline=None):
+    """Send the findings of the master detector of a region from its checkpoint until done or the deadline."""
+    state = progress.state(region_name)
+    state.pop('error', None)
+    if state.get('done'):
+        return
+    client = get_client('guardduty', region_name)
+    detector_ids = client.list_detectors()['DetectorIds']
+    if not detector_ids:
+        progress.update(region_name, dict(state, done=True))
+        return
+    pages = iter_finding_pages(client, detector_ids[0], criteria, state, deadline)
+    for findings, next_state in _prefetched(pages, executor):
+        # Findings which fail to transform are skipped, so only the entries are counted as sent
+        entries = list(iter_backfill_events(findings, region_name, schema))
+        failed = output.send(entries)
+        if failed:
+            raise RuntimeError('Failed to send {} findings'.format(len(failed)))
+        progress.update(region_name, next_state, len(entries))
+
+
+def backfill(options=None, context=None):
+    """Replay the findings of the master detectors through the transform to the output.
+
+    The findings of every region are read concurrently and streamed through
+    the transform and out a page at a time, one page being read ahead while
+    the last is sent, so memory doesn't grow with the number of findings.
+    Repeat updates aren't suppressed.
+
+    Options
+      * regions : List of regions, every enabled GuardDuty region by default
+      * since : Only findings updated since, an ISO 8601 time or epoch ms
+      * criteria : GuardDuty FindingCriteria to filter the findings with
+      * schema : Output schema, OUTPUT_SCHEMA by default
+      * output : sns, sqs or ndjson, the output topic or else queue by default
+      * path : File ndjson output is appended to
+      * checkpoint : Checkpoint returned by a backfill to resume from
+      * checkpoint_path : File the checkpoint is saved to after every page
+        and resumed from
+
+    In the Lambda function the backfill stops BACKFILL_TIME_MARGIN seconds
+    before the timeout. The summary returned says whether it's complete and
+    has the checkpoint to resume it with.
+    """
+    METRICS.reset()
+    options = options or {}
+    schema = options.get('schema') or OUTPUT_SCHEMA
+    if schema not in SCHEMAS:
+        raise ValueError('Unknown schema {}'.format(schema))
+    criteria = options.get('criteria') or {}
+    since = options.get('since')
+    if since is not None:
+        if isinstance(since, str):
+            since = datetime.fromisoformat(since.replace('Z', '+00:00'))
+            if since.tzinfo is None:
+                # Times without an offset are UTC, like every GuardDuty time
+                since = since.replace(tzinfo=timezone.utc)
+            since = since.timestamp() * 1000
+        criteria = _criteria_since(criteria, since)
+    deadline = None
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        deadline = (time.monotonic() + context.get_remaining_time_in_millis() / 1000
+                    - BACKFILL_TIME_MARGIN)
+    checkpoint_path = options.get('checkpoint_path')
+    checkpoint = options.get('checkpoint') or (
+        _load_checkpoint(checkpoint_path) if checkpoint_path else None)
+    regions = options.get('regions') or get_backfill_regions()
+    progress = BackfillProgress(checkpoint, checkpoint_path)
+    output = BackfillOutput(options.get('output'), options.get('path'))
+    try:
+        workers = max(1, min(BACKFILL_MAX_WORKERS, len(regions)))
+        with ThreadPoolExecutor(max_workers=workers) as region_executor, \
+                ThreadPoolExecutor(max_workers=workers) as read_ahead_executor:
+            futures = {
+                region_name: region_executor.submit(
+                    backfill_region, region_name, criteria, schema, output,
+                    progress, read_ahead_executor, deadline)
+                for region_name in regions}
+            for region_name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error('{} : Backfill failed : {}'.format(region_name, e))
+                    progress.failed(region_name, e)
+    finally:
+        output.close()
+    summary = progress.summary()
+    summary['complete'] = summary['complete'] and all(
+        region_name in summary['regions'] for region_name in regions)
+    summary['rate_limiter'] = RATE_LIMITER.stats()
+    logger.info('Backfill : {} findings in {}s : {} findings/s : {}'.format(
+        summary['findings'], summary['duration'], summary['findings_per_second'],
+        'complete' if summary['complete'] else 'incomplete'))
+    try:
+        METRICS.emit(
+            {'Backfilled': summary['findings'],
+             'FailedRegions': len([x for x in summary['regions'].values() if x['error']])},
+            RequestId=getattr(context, 'aws_request_id', None))
+    except Exception as e:
+        logger.error('Failed to emit metrics: {}'.format(e))
+    return summary
+
+
+# Build the transforms of the known resource types at cold start
+for _resource_type in RESOURCE_HOSTNAME_PATHS:
+    get_transform(OUTPUT_SCHEMA, _resource_type)
+
+if PREWARM_CLIENTS:
+    try:
+        if SNS_OUTPUT_TOPIC_ARN:
+            get_client('sns')
+        if SQS_OUTPUT_QUEUE_URL:
+            get_client('sqs')
+        get_dedup_cache()
+        if ARCHIVE_BACKEND == 's3':
+            get_client('s3')
+    except Exception as e:
+        logger.warning('Failed to create clients at init: {}'.format(e))
+
+if not (SNS_OUTPUT_TOPIC_ARN or SQS_OUTPUT_QUEUE_URL):
+    logger.error('Neither SNS_OUTPUT_TOPIC_ARN nor SQS_OUTPUT_QUEUE_URL is set, findings can only be backfilled to a file')
 
 def handle(event, context):
-    """Basic lambda handler."""
-    sns_client = boto3.client('sns')
-    for record in event.get('Records', []):
+    """Transform a batch of SNS or SQS records, or an EventBridge event, and send them on in batches.
+
+    Records which fail to transform or send are reported in batchItemFailures
+    so that an SQS event source only retries those records. SNS deliveries
+    and EventBridge events can't be partially retried so any failure among
+    them is raised. A retried record is only sent to the outputs it failed
+    in, see send_to_outputs.
+
+    Findings sent are also buffered in the archive when ARCHIVE_BACKEND is
+    set, see FindingArchive, and records whose findings fail to be archived
+    are retried like those which fail to send. An event with a backfill key
+    replays past findings instead, see backfill.
+    """
+    if 'backfill' in event:
+        return backfill(event['backfill'], context)
+    if not (SNS_OUTPUT_TOPIC_ARN or SQS_OUTPUT_QUEUE_URL):
+        # Rather than dropping the findings, fail so that they're retried
+        raise ValueError('Neither SNS_OUTPUT_TOPIC_ARN nor SQS_OUTPUT_QUEUE_URL is set')
+    METRICS.reset()
+    # An EventBridge rule invokes the function with a single event
+    records = [event] if 'detail-type' in event else event.get('Records', [])
+    dedup_cache = get_dedup_cache()
+    archive = get_archive()
+    now = time.time()
+    entries = []
+    failed = []
+    # The finding ID and count of the forwarded updates to commit to the
+    # dedup cache once delivered, and the deferred updates forwarded now
+    forwarded = {}
+    forwarded_ids = set()
+    trailing = {}
+    partitions = {}
+    suppressed = 0
+    if dedup_cache is not None:
+        for finding_id, last_forwarded, count, update in dedup_cache.due(now):
+            normalized_event, detail, partition = update
+            try:
+                forward, count_delta, latest = dedup_cache.check(finding_id, count, now)
+            except Exception as e:
+                logger.error('Failed to deduplicate finding {}: {}'.format(finding_id, e))
+                forward, count_delta, latest = True, count, None
+            if not forward or (latest is not None and latest > last_forwarded):
+                # A later update was forwarded since this one was suppressed
+                continue
+            detail['finding']['countDelta'] = count_delta
+            record_id = ('trailing', finding_id)
+            trailing[record_id] = (finding_id, last_forwarded, count, update)
+            forwarded[record_id] = (finding_id, count)
+            forwarded_ids.add(finding_id)
+            entries.append((record_id, json_dumps(normalized_event)))
+            partitions[record_id] = partition
+    for record in records:
+        record_id = _get_record_id(record)
         try:
-            mozdef_event = transform_event(record)
-            res = send_to_sns(mozdef_event, sns_client)
+            notification, guardduty_event = _get_notification_and_event(record)
+            normalized_event = transform_guardduty_event(
+                notification, guardduty_event)
+            partition = archive_partition(guardduty_event)
+            if dedup_cache is not None:
+                # The normalized event references the detail so the count
+                # delta added to it is part of the event
+                detail = guardduty_event['detail']
+                if detail['id'] in forwarded_ids:
+                    # An earlier update of the batch is forwarded now
+                    forward, last_forwarded = False, now
+                else:
+                    forward, last_forwarded = deduplicate(detail, dedup_cache, now)
+                if not forward:
+                    suppressed += 1
+                    dedup_cache.defer(
+                        detail['id'], last_forwarded, detail['finding'].get('count', 1),
+                        (normalized_event, detail, partition))
+                    continue
+                forwarded[record_id] = (detail['id'], detail['finding'].get('count', 1))
+                forwarded_ids.add(detail['id'])
+            entries.append((record_id, json_dumps(normalized_event)))
+            partitions[record_id] = partition
         except Exception as e:
             logger.error('Received exception "{}" for event {}'.format(e, record))
-            raise
-    return mozdef_event
+            failed.append(record_id)
+    METRICS.record(METRICS.phases, 'Transform', time.perf_counter() - METRICS.start)
+
+    publish_start = time.perf_counter()
+    if entries:
+        failed.extend(send_to_outputs(
+            entries, {x for x, _ in entries if x not in trailing}))
+    METRICS.record(METRICS.phases, 'Publish', time.perf_counter() - publish_start)
+
+    failed = list(dict.fromkeys(failed))
+    failed_ids = set(failed)
+    archived = 0
+    if archive is not None:
+        archive_start = time.perf_counter()
+        objects = archive.stats['objects']
+        for record_id, message in entries:
+            if record_id not in failed_ids:
+                archive.add(partitions[record_id], message, record_id=record_id)
+        # Records whose findings failed to be archived are retried, and only
+        # archived then as they were delivered to every output
+        archive_failed = archive.flush(record_ids={
+            x for x, _ in entries if x not in trailing and x not in failed_ids})
+        failed.extend(archive_failed)
+        failed_ids.update(archive_failed)
+        archived = archive.stats['objects'] - objects
+        METRICS.record(METRICS.phases, 'Archive', time.perf_counter() - archive_start)
+    for record_id, (finding_id, count) in forwarded.items():
+        if record_id in failed_ids:
+            if record_id in trailing:
+                # Retried by the next invocation
+                dedup_cache.defer(*trailing[record_id])
+            continue
+        try:
+            dedup_cache.commit(finding_id, count, now)
+        except Exception as e:
+            logger.error('Failed to record forwarded finding {}: {}'.format(finding_id, e))
+    failed = [x for x in failed if x not in trailing]
+    if dedup_cache is not None:
+        logger.info(
+            'Forwarded {} findings, {} of them trailing updates, and suppressed {} repeat updates, '
+            '{}, {} and {} since cold start'.format(
+                len(entries), len(trailing), suppressed, dedup_cache.stats['forwarded'],
+                dedup_cache.stats['trailing'], dedup_cache.stats['suppressed']))
+    try:
+        METRICS.emit(
+            {'Records': len(records),
+             'Forwarded': len([x for x, _ in entries if x not in failed_ids]),
+             'Suppressed': suppressed, 'Failed': len(failed),
+             'ArchiveObjects': archived},
+            RequestId=getattr(context, 'aws_request_id', None))
+    except Exception as e:
+        logger.error('Failed to emit metrics: {}'.format(e))
+    if failed and any('Sns' in record or 'messageId' not in record for record in records):
+        raise RuntimeError('Failed to process records {}'.format(failed))
+    return {'batchItemFailures': [{'itemIdentifier': x} for x in failed]}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Replay the GuardDuty findings of the master detectors through the normalizer.')
+    parser.add_argument('--regions', nargs='+', help='Regions, every enabled GuardDuty region by default')
+    parser.add_argument('--since', help='Only findings updated since this ISO 8601 time')
+    parser.add_argument('--criteria', type=json_loads, help='GuardDuty FindingCriteria as JSON')
+    parser.add_argument('--schema', choices=sorted(SCHEMAS))
+    parser.add_argument('--output', choices=['sns', 'sqs', 'ndjson'])
+    parser.add_argument('--path', help='File ndjson output is appended to')
+    parser.add_argument('--checkpoint-path', help='File to save the checkpoint to and resume from')
+    args = parser.parse_args()
+    result = backfill({key: value for key, value in vars(args).items() if value is not None})
+    result.pop('checkpoint')
+    print(json_dumps(result))
@@ -2,10 +2,19 @@
 Ensure continued publishing to
 """
 import boto3
+import contextlib
+import functools
 import json
 import os
+import threading
+import time
+import weakref
 
+import botocore.loaders
+import botocore.session
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
 from logging import basicConfig
 from logging import getLogger
@@ -35,117 +44,304 @@ NORMALIZER_LAMBDA_FUNCTION = os.getenv(
     'arn:aws:lambda:us-east-1:371522382791:function:findingsToMozDef-1O04GFRLK0EJQ'
 )
 
-
-def get_topics(boto_session):
-    """Return the list of SNS topics in a given region."""
-    client = boto_session.client('sns')
-    response = client.list_topics()
-    if len(response['Topics']) == 0:
-        return []
-    else:
-        return response['Topics']
+RULE_NAME = 'mozilla-gd-plumbing'
+TOPIC_NAME = 'mozilla-gd-plumbing'
+RULE_DESCRIPTION = 'Send all guardDuty findings to SNS for SIEM normalization.'
+TARGET_ID = 'normalizationSNS'
+# sns sends each region's findings to a topic in the region which invokes the normalization function once per
+# finding. fan-in sends every region's findings to the FAN_IN_QUEUE_ARN SQS queue the normalization function
+# consumes in batches, through the default event bus of the queue's region using the FAN_IN_ROLE_ARN role.
+PLUMBING_TOPOLOGY = os.getenv('PLUMBING_TOPOLOGY', 'sns')
+FAN_IN_QUEUE_ARN = os.getenv('FAN_IN_QUEUE_ARN')
+FAN_IN_ROLE_ARN = os.getenv('FAN_IN_ROLE_ARN')
+FAN_IN_TARGET_ID = 'normalizationFanIn'
+MAX_REGION_WORKERS = int(os.getenv('MAX_REGION_WORKERS', 8))
+# botocore's adaptive retry mode rate limits each client, counting retries, once it's throttled
+API_MAX_ATTEMPTS = int(os.getenv('API_MAX_ATTEMPTS', 10))
+BOTO_CONFIG = Config(
+    retries={'max_attempts': API_MAX_ATTEMPTS, 'mode': 'adaptive'})
+# Seconds to cache the regions enabled in the account for, and space delimited lists of regions to use even if
+# they aren't found to be enabled and to never use
+REGION_CACHE_TTL = int(os.getenv('REGION_CACHE_TTL', 86400))
+REGION_ALLOW_LIST = os.getenv('REGION_ALLOW_LIST', '')
+REGION_DENY_LIST = os.getenv('REGION_DENY_LIST', '')
+# CloudWatch namespace of the metrics emitted after each run, empty to not emit them
+METRICS_NAMESPACE = os.getenv(
+    'METRICS_NAMESPACE', 'GuardDutyMultiAccountManager')
+# Create the clients every run needs during the Lambda init phase, which runs before the first invocation is billed
+PREWARM_CLIENTS = (os.getenv('PREWARM_CLIENTS', 'true') == 'true'
+                   and os.getenv('AWS_LAMBDA_FUNCTION_NAME') is not None)
+
+CLIENTS = weakref.WeakKeyDictionary()
+SESSIONS = {}
+REGISTRY_LOCK = threading.Lock()
+# Topic arns resolved in the current run keyed by region
+TOPIC_ARNS = {}
+TOPIC_ARNS_LOCK = threading.Lock()
+# Regions enabled in the account with the time they were fetched
+ENABLED_REGIONS = {}
+# Duration in seconds of the last successful run of each region and its consecutive failures
+REGION_HEALTH = {}
+# Updates to a Lambda function's policy conflict when made concurrently
+LAMBDA_POLICY_LOCK = threading.Lock()
+
+
+class Metrics:
+    """Timings of the phases of a run and of its API calls by (service, operation, region).
+
+    The wait of an API call is the time it was blocked in botocore's adaptive
+    rate limiter or backing off between retries rather than sending requests.
+
+    emit prints them as a single CloudWatch Embedded Metric Format document
+    with the totals as metrics and the breakdowns as properties.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        # The wait of the call in progress on each thread, as the before-send and needs-retry events aren't
+        # given its context
+        self.waits = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.perf_counter()
+            self.phases = {}
+            self.calls = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as a run of a phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(self.phases, name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """Decorate a function to time each call as a run of a phase."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, counters, key, seconds, retries=0, error=False, wait=0.0):
+        with self.lock:
+            counter = counters.setdefault(key, {
+                'count': 0, 'time': 0.0, 'max': 0.0, 'retries': 0, 'errors': 0, 'wait': 0.0})
+            counter['count'] += 1
+            counter['time'] += seconds
+            counter['max'] = max(counter['max'], seconds)
+            counter['retries'] += retries
+            counter['errors'] += error
+            counter['wait'] += wait
+
+    def attach(self, client):
+        """Time every call made by a client through its event hooks."""
+        service_name = client.meta.service_model.service_name
+        region_name = client.meta.region_name
+
+        waits = self.waits
+
+        def before_call(context=None, **kwargs):
+            if context is not None:
+                context['metrics_start'] = time.perf_counter()
+            waits.wait = 0.0
+            waits.sending = waits.retrying = None
+
+        def before_send(**kwargs):
+            # Runs before the adaptive rate limiter's before-send handler, and ends the backoff of a retry
+            now = time.perf_counter()
+            if getattr(waits, 'retrying', None) is not None:
+                waits.wait += now - waits.retrying
+            waits.sending = now
+            waits.retrying = None
+
+        def sending(**kwargs):
+            # Runs after every other before-send handler
+            if getattr(waits, 'sending', None) is not None:
+                waits.wait += time.perf_counter() - waits.sending
+                waits.sending = None
+
+        def needs_retry(**kwargs):
+            waits.retrying = time.perf_counter()
+
+        def after_call(event_name, context=None, parsed=None, **kwargs):
+            if context is None or 'metrics_start' not in context:
+                return
+            parsed = parsed or {}
+            self.record(
+                self.calls,
+                '{}.{}.{}'.format(service_name, event_name.rsplit('.', 1)[-1], region_name),
+                time.perf_counter() - context.pop('metrics_start'),
+                parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                'Error' in parsed, getattr(waits, 'wait', 0.0))
+
+        def after_call_error(event_name, context=None, **kwargs):
+            after_call(event_name, context, {'Error': {}})
+
+        client.meta.events.register('before-call', before_call)
+        client.meta.events.register_first('before-send', before_send)
+        client.meta.events.register_last('before-send', sending)
+        client.meta.events.register_last('needs-retry', needs_retry)
+        client.meta.events.register('after-call', after_call)
+        client.meta.events.register('after-call-error', after_call_error)
+
+    def emit(self, **properties):
+        """Print the timings as an Embedded Metric Format document and return it."""
+        with self.lock:
+            duration = time.perf_counter() - self.start
+            phases = {
+                name: {'count': x['count'], 'time': round(x['time'] * 1000, 1),
+                       'max': round(x['max'] * 1000, 1)}
+                for name, x in self.phases.items()}
+            calls = {
+                key: dict(x, time=round(x['time'] * 1000, 1), max=round(x['max'] * 1000, 1),
+                          wait=round(x['wait'] * 1000, 1))
+                for key, x in self.calls.items()}
+        metrics = {
+            'Duration': round(duration * 1000, 1),
+            'ApiCalls': sum(x['count'] for x in calls.values()),
+            'ApiTime': round(sum(x['time'] for x in calls.values()), 1),
+            'ApiRetries': sum(x['retries'] for x in calls.values()),
+            'ApiErrors': sum(x['errors'] for x in calls.values()),
+            'ApiWaitTime': round(sum(x['wait'] for x in calls.values()), 1),
+        }
+        for name, phase in phases.items():
+            metrics['{}Time'.format(name)] = phase['time']
+        document = dict(properties, phases=phases, api=calls, **metrics)
+        document['Function'] = os.getenv('AWS_LAMBDA_FUNCTION_NAME', 'plumbing')
+        document['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [['Function']],
+                'Metrics': [
+                    {'Name': name, 'Unit': 'Count' if name in ('ApiCalls', 'ApiRetries', 'ApiErrors')
+                     else 'Milliseconds'}
+                    for name in metrics]}]}
+        if self.namespace:
+            print(json.dumps(document), flush=True)
+        return document
+
+
+METRICS = Metrics(METRICS_NAMESPACE)
+
+
+# botocore's loader of its data files and service models, shared by every
+# region's session so that they're only parsed once per container
+DATA_LOADER = botocore.loaders.create_loader(os.getenv('AWS_DATA_PATH'))
+
+
+def get_region_session(region_name=None):
+    """Return a shared boto session for a region."""
+    with REGISTRY_LOCK:
+        if region_name not in SESSIONS:
+            botocore_session = botocore.session.get_session()
+            botocore_session.register_component('data_loader', DATA_LOADER)
+            SESSIONS[region_name] = boto3.session.Session(
+                region_name=region_name, botocore_session=botocore_session)
+        return SESSIONS[region_name]
+
+
+def get_client(boto_session, service_name):
+    """Return a shared client for a service in the session's region.
+
+    Clients are keyed by (session, service, region) so that every function
+    working on a region reuses one client per service instead of loading the
+    service model again. Clients retry, and are rate limited once throttled, with BOTO_CONFIG's adaptive
+    mode, and their calls are timed by METRICS.
+    """
+    key = (service_name, boto_session.region_name)
+    with REGISTRY_LOCK:
+        clients = CLIENTS.setdefault(boto_session, {})
+        if key not in clients:
+            clients[key] = boto_session.client(service_name, config=BOTO_CONFIG)
+            METRICS.attach(clients[key])
+        return clients[key]
+
+
+def prewarm_clients():
+    """Create the client every run reads the normalization function's policy with."""
+    try:
+        get_client(get_region_session('us-east-1'), 'lambda')
+    except Exception as e:
+        logger.warning('Failed to create clients at init: {}'.format(e))
 
 
-def find_or_create_sns_topic(boto_session):
-    """Search for the mozilla-gd-plumbing topic and return the arn.  If the topic does not exist create it."""
-    client = boto_session.client('sns')
-    topics = get_topics(boto_session)
-    if len(topics) == 0:
-        response = client.create_topic(
-            Name='mozilla-gd-plumbing'
-        )
-    else:
-        for topic in get_topics(boto_session):
-            if topic['TopicArn'].endswith('mozilla-gd-plumbing') :
-                return topic['TopicArn']
+if PREWARM_CLIENTS:
+    prewarm_clients()
 
-            else:
-                response = client.create_topic(
-                    Name='mozilla-gd-plumbing'
-                )
 
-    return response['TopicArn']
+def get_topics(boto_session):
+    """Return the list of SNS topics in a given region."""
+    client = get_client(boto_session, 'sns')
+    return [
+        topic
+        for page in client.get_paginator('list_topics').paginate()
+        for topic in page['Topics']
+    ]
 
 
-def clean_subscription_list(boto_session):
-    """Search for the mozilla-gd-plumbing topic and return the arn.  If the topic does not exist create it."""
-    client = boto_session.client('sns')
-    response = client.list_subscriptions_by_topic(
-        TopicArn=find_or_create_sns_topic(boto_session)
-    )
-    if len(response['Subscriptions']) == 0:
-        pass
-    else:
-        for i in response['Subscriptions']:
-            if NORMALIZER_LAMBDA_FUNCTION != i.get('Endpoint', ''):
-                logger.info('Unsubcribing lambda from topic.  Perhaps you re-deployed?')
-                response = client.unsubscribe(
-                    SubscriptionArn=i['SubscriptionArn']
-                )
-
-def topic_is_subscribed(boto_session):
-    """Enumerate the list of subscriptions for a given topic arn and test to see if it contains the normalizer."""
-    client = boto_session.client('sns')
-    response = client.list_subscriptions_by_topic(
-        TopicArn=find_or_create_sns_topic(boto_session)
+@METRICS.timed('TopicLookup')
+def find_or_create_sns_topic(boto_session):
+    """Search for the mozilla-gd-plumbing topic and return the arn.  If the topic does not exist create it.
+
+    The arn is remembered for the region so the topics are only listed once per region per run.
+    """
+    region = boto_session.region_name
+    with TOPIC_ARNS_LOCK:
+        if region in TOPIC_ARNS:
+            return TOPIC_ARNS[region]
+    topic_arn = next(
+        (x['TopicArn'] for x in get_topics(boto_session)
+         if x['TopicArn'].split(':')[-1] == TOPIC_NAME),
+        None
     )
+    if topic_arn is None:
+        client = get_client(boto_session, 'sns')
+        topic_arn = client.create_topic(Name=TOPIC_NAME)['TopicArn']
+    with TOPIC_ARNS_LOCK:
+        TOPIC_ARNS[region] = topic_arn
+    return topic_arn
 
-    if len(response['Subscriptions']) == 0:
-        return False
-    else:
-        for i in response['Subscriptions']:
-            if NORMALIZER_LAMBDA_FUNCTION == i.get('Endpoint', ''):
-                return True
-    return False
 
-
-def subscribe_to_normalization_function(boto_session):
+def subscribe_to_normalization_function(boto_session, topic_arn=None):
     """Add a subscription to the current topic for the lambda function that does data transformation."""
-    client = boto_session.client('sns')
+    client = get_client(boto_session, 'sns')
     response = client.subscribe(
-        TopicArn=find_or_create_sns_topic(boto_session),
+        TopicArn=topic_arn or find_or_create_sns_topic(boto_session),
         Protocol='lambda',
         Endpoint=NORMALIZER_LAMBDA_FUNCTION,
     )
     return response
 
 
-def ensure_topic_subscriptions(boto_session):
-    """Ensure the sns topic is subscribed to the normalization lambda."""
-    if topic_is_subscribed(boto_session):
-        pass
-    else:
-        subscribe_to_normalization_function(boto_session)
-
-
-def get_all_rules(boto_session):
-    """Search for the mozilla-gd-plumbing rule only.  Returns a list of one."""
-    client = boto_session.client('events')
-    response = client.list_rules(NamePrefix='mozilla-gd-plumbing')
-    return response['Rules']
-
-
 def setup_guardduty_plumbing(boto_session):
     """Create the cloudwatch event rule."""
-    client = boto_session.client('events')
+    client = get_client(boto_session, 'events')
     response = client.put_rule(
-        Name='mozilla-gd-plumbing',
+        Name=RULE_NAME,
         EventPattern=json.dumps(EVENT_PATTERN),
         State='ENABLED',
-        Description='Send all guardDuty findings to SNS for SIEM normalization.',
+        Description=RULE_DESCRIPTION,
     )
     return response
 
 
-def setup_sns_publishing(boto_session):
+def setup_sns_publishing(boto_session, topic_arn=None):
     """Add teh sns topic in a given region to the cloudwatch event rule."""
-    client = boto_session.client('events')
+    client = get_client(boto_session, 'events')
     response = client.put_targets(
-        Rule='mozilla-gd-plumbing',
+        Rule=RULE_NAME,
         Targets=[
             {
-                'Arn': find_or_create_sns_topic(boto_session),
-                'Id': 'normalizationSNS',
+                'Arn': topic_arn or find_or_create_sns_topic(boto_session),
+                'Id': TARGET_ID,
             }
         ]
     )
@@ -153,19 +349,42 @@ def setup_sns_publishing(boto_session):
 
 
 def get_all_aws_regions(boto_session):
-    return boto_session.get_available_regions('guardduty')
-
-def add_lambda_permission(region_session, region_name):
-    boto_session = boto3.session.Session(region_name='us-east-1')
-    client = boto_session.client('lambda')
+    """Return the GuardDuty regions enabled in the account, slowest first.
+
+    The opt-in regions botocore lists can't be called until they're enabled, so the enabled regions are fetched
+    with EC2 DescribeRegions and cached for REGION_CACHE_TTL seconds, falling back to every GuardDuty region.
+    REGION_ALLOW_LIST and REGION_DENY_LIST override the enabled regions. Regions are ordered by the duration of
+    their last run so that the slowest start first.
+    """
+    available = boto_session.get_available_regions('guardduty')
+    if ENABLED_REGIONS.get('fetched', 0) + REGION_CACHE_TTL < time.time():
+        try:
+            ENABLED_REGIONS['regions'] = [
+                x['RegionName'] for x in get_client(boto_session, 'ec2').describe_regions()['Regions']]
+        except ClientError as e:
+            logger.warning('Could not fetch the enabled regions, using every GuardDuty region: {}'.format(e))
+            ENABLED_REGIONS['regions'] = None
+        else:
+            ENABLED_REGIONS['fetched'] = time.time()
+    enabled = ENABLED_REGIONS['regions']
+    allowed = set(REGION_ALLOW_LIST.split())
+    denied = set(REGION_DENY_LIST.split())
+    regions = [
+        x for x in available
+        if (enabled is None or x in enabled or x in allowed) and x not in denied]
+    return sorted(regions, key=lambda x: (x in REGION_HEALTH, -REGION_HEALTH.get(x, {}).get('duration', 0)))
+
+def add_lambda_permission(region_session, region_name, topic_arn=None):
+    client = get_client(get_region_session('us-east-1'), 'lambda')
     try:
-        response = client.add_permission(
-            Action='lambda:InvokeFunction',
-            FunctionName=NORMALIZER_LAMBDA_FUNCTION.split(':')[6],
-            Principal='sns.amazonaws.com',
-            SourceArn=find_or_create_sns_topic(region_session),
-            StatementId='{}-sns-invoke'.format(region_name)
-        )
+        with LAMBDA_POLICY_LOCK:
+            response = client.add_permission(
+                Action='lambda:InvokeFunction',
+                FunctionName=NORMALIZER_LAMBDA_FUNCTION.split(':')[6],
+                Principal='sns.amazonaws.com',
+                SourceArn=topic_arn or find_or_create_sns_topic(region_session),
+                StatementId='{}-sns-invoke'.format(region_name)
+            )
         return response
     except ClientError as e:
         logger.debug(
@@ -173,26 +392,249 @@ def add_lambda_permission(region_session, region_name):
         )
 
 
+def remove_lambda_permission(region_name):
+    """Remove a region's invoke permission from the normalization function."""
+    client = get_client(get_region_session('us-east-1'), 'lambda')
+    with LAMBDA_POLICY_LOCK:
+        return client.remove_permission(
+            FunctionName=NORMALIZER_LAMBDA_FUNCTION.split(':')[6],
+            StatementId='{}-sns-invoke'.format(region_name)
+        )
+
+
+def get_rule(boto_session):
+    """Return the mozilla-gd-plumbing rule or None if it does not exist."""
+    client = get_client(boto_session, 'events')
+    try:
+        return client.describe_rule(Name=RULE_NAME)
+    except client.exceptions.ResourceNotFoundException:
+        return None
 
-def handle(event=None, context=None):
-    logger.info('Activating guardDuty plumbing.')
-    boto_session = boto3.session.Session()
-    for region in get_all_aws_regions(boto_session):
-        logger.info('Attempting cross region setup for {}.'.format(region))
-        region_session = boto3.session.Session(region_name=region)
+
+def get_rule_targets(boto_session):
+    """Return the targets of the mozilla-gd-plumbing rule."""
+    client = get_client(boto_session, 'events')
+    return client.list_targets_by_rule(Rule=RULE_NAME)['Targets']
+
+
+def get_topic_subscriptions(boto_session, topic_arn):
+    """Return every subscription of a topic."""
+    client = get_client(boto_session, 'sns')
+    paginator = client.get_paginator('list_subscriptions_by_topic')
+    return [
+        subscription
+        for page in paginator.paginate(TopicArn=topic_arn)
+        for subscription in page['Subscriptions']
+    ]
+
+
+@METRICS.timed('PolicyRead')
+def get_lambda_policy_statements():
+    """Return the normalization function's policy statements keyed by Sid or None if they can't be read."""
+    client = get_client(get_region_session('us-east-1'), 'lambda')
+    try:
+        policy = client.get_policy(
+            FunctionName=NORMALIZER_LAMBDA_FUNCTION.split(':')[6]
+        )
+    except client.exceptions.ResourceNotFoundException:
+        return {}
+    except ClientError as e:
+        logger.warning('Could not read the normalization function policy: {}'.format(e))
+        return None
+    return {x.get('Sid'): x for x in json.loads(policy['Policy'])['Statement']}
+
+
+def rule_has_drifted(rule):
+    """Test if the rule is missing or differs from the desired rule."""
+    return (
+        rule is None
+        or rule.get('State') != 'ENABLED'
+        or rule.get('Description') != RULE_DESCRIPTION
+        or json.loads(rule.get('EventPattern') or 'null') != EVENT_PATTERN
+    )
+
+
+def permission_source_arn(statement):
+    """Return the source ARN condition of a Lambda policy statement."""
+    return statement.get('Condition', {}).get('ArnLike', {}).get('AWS:SourceArn')
+
+
+@METRICS.timed('RegionReconcile')
+def reconcile_region(region, policy_statements):
+    """Read the plumbing in a region and only change what has drifted from the desired state.
+
+    Returns the list of changes made.
+    """
+    region_session = get_region_session(region)
+    changes = []
+
+    rule = get_rule(region_session)
+    if rule_has_drifted(rule):
         logger.info('Ensuring guardduty cloudwatch event exists for {}.'.format(region))
         setup_guardduty_plumbing(region_session)
+        changes.append('put_rule')
+
+    topic_arn = find_or_create_sns_topic(region_session)
+
+    targets = get_rule_targets(region_session) if rule is not None else []
+    if not any(x['Id'] == TARGET_ID and x['Arn'] == topic_arn for x in targets):
         logger.info('Ensuring guardduty sns topic exists for {}.'.format(region))
-        setup_sns_publishing(region_session)
+        setup_sns_publishing(region_session, topic_arn)
+        changes.append('put_targets')
+    if any(x['Id'] == FAN_IN_TARGET_ID for x in targets):
+        logger.info('Removing the fan-in target of the guardduty cloudwatch event for {}.'.format(region))
+        remove_rule_targets(region_session, [FAN_IN_TARGET_ID])
+        changes.append('remove_targets')
+
+    subscriptions = get_topic_subscriptions(region_session, topic_arn)
+    if not any(x.get('Endpoint') == NORMALIZER_LAMBDA_FUNCTION for x in subscriptions):
         logger.info(
             'Ensuring guardduty sns topic is subscribed to the normalization function for {}.'.format(
                 region
             )
         )
-        ensure_topic_subscriptions(region_session)
-        clean_subscription_list(region_session)
-        add_lambda_permission(region_session, region)
-        logger.info('Run complete for region: {}'.format(region))
+        subscribe_to_normalization_function(region_session, topic_arn)
+        changes.append('subscribe')
+    client = get_client(region_session, 'sns')
+    for subscription in subscriptions:
+        if (subscription.get('Endpoint') != NORMALIZER_LAMBDA_FUNCTION
+                and subscription['SubscriptionArn'].startswith('arn:')):
+            logger.info('Unsubcribing lambda from topic.  Perhaps you re-deployed?')
+            client.unsubscribe(SubscriptionArn=subscription['SubscriptionArn'])
+            changes.append('unsubscribe')
+
+    statement = (policy_statements or {}).get('{}-sns-invoke'.format(region))
+    if statement is not None and permission_source_arn(statement) != topic_arn:
+        remove_lambda_permission(region)
+        changes.append('remove_permission')
+        statement = None
+    if statement is None:
+        add_lambda_permission(region_session, region, topic_arn)
+        changes.append('add_permission')
+
+    return changes
+
+
+def fan_in_target(region):
+    """Return the rule target sending a region's findings to the fan-in queue.
+
+    EventBridge rules can only target event buses in other regions, so the findings of every other region are
+    sent to the default event bus of the queue's region, where that region's own rule sends them on to the queue.
+    """
+    queue_region, account_id = FAN_IN_QUEUE_ARN.split(':')[3:5]
+    if region == queue_region:
+        return {'Id': FAN_IN_TARGET_ID, 'Arn': FAN_IN_QUEUE_ARN}
+    return {
+        'Id': FAN_IN_TARGET_ID,
+        'Arn': 'arn:aws:events:{}:{}:event-bus/default'.format(queue_region, account_id),
+        'RoleArn': FAN_IN_ROLE_ARN,
+    }
+
+
+def remove_rule_targets(boto_session, target_ids):
+    """Remove targets from the mozilla-gd-plumbing rule."""
+    client = get_client(boto_session, 'events')
+    return client.remove_targets(Rule=RULE_NAME, Ids=target_ids)
+
+
+@METRICS.timed('RegionReconcile')
+def reconcile_region_fan_in(region, policy_statements):
+    """Reconcile a region to the fan-in topology, where the plumbing is only the rule and its target.
+
+    The SNS target and the region's invoke permission on the normalization function are removed if they're left
+    from the sns topology. The region's topic is left in place. Returns the list of changes made.
+    """
+    region_session = get_region_session(region)
+    changes = []
+
+    rule = get_rule(region_session)
+    if rule_has_drifted(rule):
+        logger.info('Ensuring guardduty cloudwatch event exists for {}.'.format(region))
+        setup_guardduty_plumbing(region_session)
+        changes.append('put_rule')
+
+    target = fan_in_target(region)
+    targets = get_rule_targets(region_session) if rule is not None else []
+    if not any(x['Id'] == target['Id'] and x['Arn'] == target['Arn']
+               and x.get('RoleArn') == target.get('RoleArn') for x in targets):
+        logger.info('Ensuring guardduty findings are sent to the fan-in queue for {}.'.format(region))
+        get_client(region_session, 'events').put_targets(Rule=RULE_NAME, Targets=[target])
+        changes.append('put_targets')
+    if any(x['Id'] == TARGET_ID for x in targets):
+        logger.info('Removing the sns target of the guardduty cloudwatch event for {}.'.format(region))
+        remove_rule_targets(region_session, [TARGET_ID])
+        changes.append('remove_targets')
+
+    if (policy_statements or {}).get('{}-sns-invoke'.format(region)) is not None:
+        remove_lambda_permission(region)
+        changes.append('remove_permission')
+
+    return changes
+
+
+def timed_reconcile_region(region, policy_statements):
+    """Reconcile a region to the PLUMBING_TOPOLOGY and return its changes along with the seconds it took."""
+    start = time.time()
+    if PLUMBING_TOPOLOGY == 'fan-in':
+        return reconcile_region_fan_in(region, policy_statements), time.time() - start
+    return reconcile_region(region, policy_statements), time.time() - start
+
+
+def handle(event=None, context=None):
+    """Reconcile the GuardDuty plumbing in every region concurrently.
+
+    The plumbing of each region is a rule sending its findings to the
+    normalization function through a topic in the region or, with the fan-in
+    PLUMBING_TOPOLOGY, to the queue the function consumes in batches. The
+    current state of each region is read once and write calls are only
+    made for what has drifted. Only the regions enabled in the account are
+    reconciled, slowest first. A failure in one region is logged without
+    affecting the others. The run's phase and API call timings are printed
+    as CloudWatch Embedded Metric Format metrics in METRICS_NAMESPACE.
+    """
+    logger.info('Activating guardDuty plumbing.')
+    if PLUMBING_TOPOLOGY not in ('sns', 'fan-in'):
+        raise ValueError('Unknown plumbing topology {}'.format(PLUMBING_TOPOLOGY))
+    if PLUMBING_TOPOLOGY == 'fan-in' and not (FAN_IN_QUEUE_ARN and FAN_IN_ROLE_ARN):
+        raise ValueError('The fan-in topology needs FAN_IN_QUEUE_ARN and FAN_IN_ROLE_ARN')
+    start = time.time()
+    METRICS.reset()
+    boto_session = get_region_session()
+    regions = get_all_aws_regions(boto_session)
+    if PLUMBING_TOPOLOGY == 'fan-in' and FAN_IN_QUEUE_ARN.split(':')[3] not in regions:
+        # Every other region's findings reach the queue through its region's rule
+        regions.append(FAN_IN_QUEUE_ARN.split(':')[3])
+    with TOPIC_ARNS_LOCK:
+        TOPIC_ARNS.clear()
+    policy_statements = get_lambda_policy_statements()
+    summary = {'topology': PLUMBING_TOPOLOGY, 'regions': {}, 'failed_regions': []}
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_REGION_WORKERS, len(regions)))) as executor:
+        futures = {
+            region: executor.submit(timed_reconcile_region, region, policy_statements)
+            for region in regions
+        }
+        for region, future in futures.items():
+            try:
+                summary['regions'][region], duration = future.result()
+                REGION_HEALTH[region] = {'duration': round(duration, 3), 'failures': 0}
+                logger.info('Run complete for region: {} changes: {}'.format(
+                    region, summary['regions'][region]))
+            except Exception as e:
+                REGION_HEALTH[region] = dict(
+                    REGION_HEALTH.get(region, {}), failures=REGION_HEALTH.get(region, {}).get('failures', 0) + 1)
+                summary['failed_regions'].append(region)
+                summary['regions'][region] = {'error': repr(e)}
+                logger.error('Run failed for region: {} : {}'.format(region, e))
+    summary['region_health'] = {x: REGION_HEALTH[x] for x in regions if x in REGION_HEALTH}
+    summary['duration'] = round(time.time() - start, 3)
+    logger.info('Plumbing reconciled in {} regions, {} failed, in {}s.'.format(
+        len(regions), len(summary['failed_regions']), summary['duration']))
+    try:
+        METRICS.emit(RequestId=getattr(context, 'aws_request_id', None),
+                     FailedRegions=len(summary['failed_regions']))
+    except Exception as e:
+        logger.error('Failed to emit metrics: {}'.format(e))
+    return summary
 
 
 if __name__ == "__main__":
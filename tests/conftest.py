@@ -0,0 +1,44 @@
+import os
+import sys
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+# The Lambda functions read their configuration at import. Clients are
+# created with fake credentials and every call they make is answered by a
+# botocore Stubber.
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ['AWS_SESSION_TOKEN'] = 'testing'
+os.environ['METRICS_NAMESPACE'] = ''
+os.environ['PREWARM_CLIENTS'] = 'false'
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+@pytest.fixture
+def stub():
+    """Return a function which stubs a client, checking after the test that
+    every expected call was made"""
+    stubbers = []
+
+    def stub(client):
+        stubber = Stubber(client)
+        stubber.activate()
+        stubbers.append(stubber)
+        return stubber
+
+    yield stub
+    for stubber in stubbers:
+        stubber.deactivate()
+        stubber.assert_no_pending_responses()
+
+
+@pytest.fixture
+def client():
+    """Return a function which creates a client in us-west-2"""
+    def client(service_name):
+        return boto3.client(service_name, region_name='us-west-2')
+    return client
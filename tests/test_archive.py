@@ -0,0 +1,161 @@
+import gzip
+import json
+
+import pytest
+from botocore.stub import ANY
+
+from lambda_functions import normalization
+from lambda_functions.normalization import FindingArchive
+
+from test_dedup import Clock
+from test_normalization import sample
+
+PARTITION = ('2021-07-19', '123456789012', 'us-west-2')
+
+
+class Writer:
+    """Keep the objects written, failing the first fail_times writes"""
+
+    def __init__(self, fail_times=0):
+        self.objects = {}
+        self.fail_times = fail_times
+
+    def __call__(self, objects, content_type):
+        if self.fail_times:
+            self.fail_times -= 1
+            raise RuntimeError('Write failed')
+        for key, body in objects:
+            self.objects[key] = gzip.decompress(body).decode('utf-8')
+
+
+def test_findings_are_written_by_partition():
+    writer = Writer()
+    archive = FindingArchive(writer, 'gzip', 1024, 0, 'guardduty/')
+    archive.add(PARTITION, '{"a": 1}')
+    archive.add(PARTITION, '{"a": 2}')
+    archive.add(('2021-07-19', '210987654321', 'us-east-1'), '{"b": 1}')
+
+    assert archive.flush() == []
+
+    assert sorted(writer.objects.values()) == [
+        '{"a": 1}\n{"a": 2}\n', '{"b": 1}\n']
+    key = next(x for x, body in writer.objects.items() if '"a"' in body)
+    assert key.startswith(
+        'guardduty/date=2021-07-19/account=123456789012/region=us-west-2/')
+    assert key.endswith('.ndjson.gz')
+    assert archive.stats['findings'] == 3
+    assert archive.flush() == []
+    assert archive.stats['objects'] == 2
+
+
+def test_findings_are_buffered_until_a_bound_is_reached():
+    writer = Writer()
+    archive = FindingArchive(writer, 'gzip', 1024, 300)
+    archive.add(PARTITION, '{"a": 1}', now=1000)
+    assert not archive.due(now=1299)
+    archive.flush(now=1299)
+    assert writer.objects == {}
+    archive.flush(now=1300)
+    assert len(writer.objects) == 1
+    archive.add(PARTITION, 'x' * 1024, now=1400)
+    archive.flush(now=1400)
+    assert len(writer.objects) == 2
+
+
+def test_failed_writes_of_earlier_invocations_are_retried():
+    writer = Writer(fail_times=1)
+    archive = FindingArchive(writer, 'gzip', 1024, 0)
+    archive.add(PARTITION, '{"a": 1}')
+    assert archive.flush() == []
+    assert writer.objects == {}
+    archive.add(PARTITION, '{"a": 2}')
+    archive.flush()
+    assert list(writer.objects.values()) == ['{"a": 1}\n{"a": 2}\n']
+
+
+def test_failed_writes_of_the_records_handled_are_reported():
+    writer = Writer(fail_times=1)
+    archive = FindingArchive(writer, 'gzip', 1024, 0)
+    archive.add(PARTITION, '{"a": 1}')
+    archive.add(PARTITION, '{"a": 2}', record_id='2')
+    assert archive.flush(record_ids={'2'}) == ['2']
+    archive.flush()
+    assert list(writer.objects.values()) == ['{"a": 1}\n']
+
+
+def test_findings_which_cannot_be_archived_are_dropped():
+    archive = FindingArchive(Writer(fail_times=10), 'gzip', 10, 0)
+    archive.add(PARTITION, 'x' * 50)
+    archive.flush()
+    assert archive.stats['dropped'] == 1
+    assert archive.size == 0
+
+
+@pytest.fixture
+def archived(monkeypatch, stub, client):
+    """Archive to a stubbed bucket the findings sent to a stubbed queue,
+    returning the clock, the stubbers and the archived object keys"""
+    clock = Clock(1000)
+    monkeypatch.setattr(normalization, 'time', clock)
+    monkeypatch.setattr(normalization, 'SNS_OUTPUT_TOPIC_ARN', None)
+    monkeypatch.setattr(normalization, 'SQS_OUTPUT_QUEUE_URL',
+                        'https://sqs.us-west-2.amazonaws.com/123456789012/output')
+    monkeypatch.setattr(normalization, 'DEDUP_WINDOW', 0)
+    monkeypatch.setattr(normalization, 'ARCHIVE_BACKEND', 's3')
+    monkeypatch.setattr(normalization, 'ARCHIVE_BUCKET', 'archive')
+    monkeypatch.setattr(normalization, 'ARCHIVE', None)
+    monkeypatch.setattr(normalization, 'DELIVERED_OUTPUTS',
+                        normalization.OrderedDict())
+    s3 = client('s3')
+    monkeypatch.setitem(normalization.CLIENTS, ('s3', None), s3)
+    sqs = client('sqs')
+    monkeypatch.setitem(normalization.CLIENTS, ('sqs', None), sqs)
+    keys = []
+    s3.meta.events.register('provide-client-params.s3.PutObject',
+                            lambda params, **kwargs: keys.append(params['Key']))
+    return clock, stub(s3), stub(sqs), keys
+
+
+def sqs_event(message_id):
+    return {'Records': [{'messageId': message_id, 'eventSource': 'aws:sqs',
+                         'body': json.dumps(sample('Instance'))}]}
+
+
+def add_put_object(stubber):
+    stubber.add_response('put_object', {}, {
+        'Bucket': 'archive', 'Key': ANY, 'Body': ANY,
+        'ContentType': 'application/gzip'})
+
+
+def test_invocations_are_archived_together_by_default(archived):
+    clock, s3_stubber, sqs_stubber, keys = archived
+    for i in range(3):
+        sqs_stubber.add_response(
+            'send_message_batch', {'Successful': [], 'Failed': []})
+    add_put_object(s3_stubber)
+    normalization.handle(sqs_event('0'), None)
+    clock.now = 1100
+    normalization.handle(sqs_event('1'), None)
+    assert keys == []
+    clock.now = 1300
+    normalization.handle(sqs_event('2'), None)
+
+    assert len(keys) == 1
+    assert keys[0].startswith(
+        'guardduty/date=2021-07-19/account=123456789012/region=us-west-2/')
+
+
+def test_records_which_fail_to_be_archived_are_retried(monkeypatch, archived):
+    monkeypatch.setattr(normalization, 'ARCHIVE_MAX_AGE', 0)
+    clock, s3_stubber, sqs_stubber, keys = archived
+    sqs_stubber.add_response(
+        'send_message_batch', {'Successful': [], 'Failed': []})
+    s3_stubber.add_client_error('put_object', 'InternalError',
+                                http_status_code=500)
+    assert normalization.handle(sqs_event('0'), None) == {
+        'batchItemFailures': [{'itemIdentifier': '0'}]}
+    # The retry is only archived as it was already sent to the queue
+    add_put_object(s3_stubber)
+    assert normalization.handle(sqs_event('0'), None) == {
+        'batchItemFailures': []}
+    assert len(keys) == 2
@@ -0,0 +1,154 @@
+import json
+
+import pytest
+from botocore.stub import ANY
+
+from lambda_functions import normalization
+
+
+def finding(finding_id, updated_at):
+    return {
+        'AccountId': '123456789012',
+        'Arn': 'arn:aws:guardduty:us-east-1:123456789012:detector/master/'
+               'finding/{}'.format(finding_id),
+        'CreatedAt': '2024-01-01T00:00:00.000Z',
+        'Description': 'An API was used to access a bucket from an IP address',
+        'Id': finding_id,
+        'Region': 'us-east-1',
+        'Resource': {'ResourceType': 'AccessKey'},
+        'SchemaVersion': '2.0',
+        'Service': {'ServiceName': 'guardduty', 'Count': 1,
+                    'DetectorId': 'master'},
+        'Severity': 5.0,
+        'Title': 'Unusual API call',
+        'Type': 'Discovery:S3/MaliciousIPCaller',
+        'UpdatedAt': updated_at}
+
+
+@pytest.fixture
+def guardduty(monkeypatch, stub, client):
+    """Backfill us-east-1 from a stubbed GuardDuty client"""
+    guardduty = client('guardduty')
+    monkeypatch.setitem(
+        normalization.CLIENTS, ('guardduty', 'us-east-1'), guardduty)
+    return stub(guardduty)
+
+
+def add_page(stubber, findings, next_token=None, token=None, criteria=ANY):
+    expected = {'DetectorId': 'master', 'FindingCriteria': criteria,
+                'SortCriteria': {'AttributeName': 'updatedAt', 'OrderBy': 'ASC'},
+                'MaxResults': 50}
+    if token:
+        expected['NextToken'] = token
+    stubber.add_response(
+        'list_findings',
+        dict({'FindingIds': [x['Id'] for x in findings]},
+             **({'NextToken': next_token} if next_token else {})),
+        expected)
+    stubber.add_response('get_findings', {'Findings': findings})
+
+
+def backfill(tmp_path):
+    return normalization.backfill({
+        'regions': ['us-east-1'], 'output': 'ndjson',
+        'path': str(tmp_path / 'findings.ndjson'),
+        'checkpoint_path': str(tmp_path / 'checkpoint.json')})
+
+
+def backfilled_ids(tmp_path):
+    with open(tmp_path / 'findings.ndjson') as f:
+        return [json.loads(x)['details']['id'] for x in f]
+
+
+def test_backfill_resumes_from_the_checkpoint(guardduty, tmp_path):
+    guardduty.add_response('list_detectors', {'DetectorIds': ['master']})
+    add_page(guardduty, [finding('a', '2024-01-01T00:00:00.000Z')], 'page-2')
+    guardduty.add_client_error('list_findings', 'InternalServerErrorException')
+
+    summary = backfill(tmp_path)
+
+    assert not summary['complete']
+    assert summary['regions']['us-east-1']['error']
+    state = summary['checkpoint']['regions']['us-east-1']
+    assert (state['next_token'], state['updated_at'], state['findings']) == (
+        'page-2', 1704067200000, 1)
+
+    guardduty.add_response('list_detectors', {'DetectorIds': ['master']})
+    add_page(guardduty, [finding('b', '2024-01-02T00:00:00.000Z')],
+             token='page-2')
+
+    summary = backfill(tmp_path)
+
+    assert summary['complete']
+    assert summary['findings'] == 1
+    assert summary['checkpoint']['regions']['us-east-1']['findings'] == 2
+    assert backfilled_ids(tmp_path) == ['a', 'b']
+
+
+def test_rejected_token_resumes_from_the_last_update(guardduty, tmp_path):
+    with open(tmp_path / 'checkpoint.json', 'w') as f:
+        json.dump({'regions': {'us-east-1': {
+            'next_token': 'expired', 'updated_at': 1704067200000,
+            'findings': 1}}}, f)
+    guardduty.add_response('list_detectors', {'DetectorIds': ['master']})
+    guardduty.add_client_error(
+        'list_findings', 'BadRequestException', http_status_code=400)
+    add_page(guardduty, [finding('a', '2024-01-01T00:00:00.000Z'),
+                         finding('b', '2024-01-02T00:00:00.000Z')],
+             criteria={'Criterion': {'updatedAt': {
+                 'GreaterThanOrEqual': 1704067200000}}})
+
+    summary = backfill(tmp_path)
+
+    assert summary['complete']
+    state = summary['checkpoint']['regions']['us-east-1']
+    assert (state['since'], state['updated_at'], state['findings']) == (
+        1704067200000, 1704153600000, 3)
+    assert backfilled_ids(tmp_path) == ['a', 'b']
+
+
+def test_finished_region_is_not_read_again(guardduty, tmp_path):
+    with open(tmp_path / 'checkpoint.json', 'w') as f:
+        json.dump({'regions': {'us-east-1': {'done': True}}}, f)
+
+    summary = backfill(tmp_path)
+
+    assert summary['complete']
+    assert summary['findings'] == 0
+
+
+def test_findings_which_fail_to_transform_are_not_counted(
+        monkeypatch, guardduty, tmp_path):
+    transform = normalization.transform_guardduty_event
+
+    def transform_guardduty_event(notification, guardduty_event, schema=None):
+        if guardduty_event['id'] == 'b':
+            raise ValueError('Unexpected finding')
+        return transform(notification, guardduty_event, schema)
+
+    monkeypatch.setattr(normalization, 'transform_guardduty_event',
+                        transform_guardduty_event)
+    guardduty.add_response('list_detectors', {'DetectorIds': ['master']})
+    add_page(guardduty, [finding('a', '2024-01-01T00:00:00.000Z'),
+                         finding('b', '2024-01-01T00:00:00.000Z')])
+
+    summary = backfill(tmp_path)
+
+    assert summary['findings'] == 1
+    assert summary['checkpoint']['regions']['us-east-1']['findings'] == 1
+    assert backfilled_ids(tmp_path) == ['a']
+
+
+@pytest.mark.parametrize('since', [
+    '2024-01-01T00:00:00', '2024-01-01T00:00:00Z', '2024-01-01T01:00:00+01:00'])
+def test_since_without_an_offset_is_utc(guardduty, tmp_path, since):
+    guardduty.add_response('list_detectors', {'DetectorIds': ['master']})
+    add_page(guardduty, [finding('a', '2024-01-01T00:00:00.000Z')],
+             criteria={'Criterion': {'updatedAt': {
+                 'GreaterThanOrEqual': 1704067200000}}})
+
+    summary = normalization.backfill({
+        'regions': ['us-east-1'], 'output': 'ndjson', 'since': since,
+        'path': str(tmp_path / 'findings.ndjson')})
+
+    assert summary['complete']
@@ -0,0 +1,108 @@
+import csv
+import io
+
+import boto3
+
+from lambda_functions import invitation_manager
+from lambda_functions.invitation_manager import CoverageMatrix
+
+ACCOUNT_IDS = ['111111111111', '222222222222', '333333333333']
+REGIONS = ['us-east-1', 'us-west-2']
+
+
+def matrix():
+    coverage = CoverageMatrix(ACCOUNT_IDS, REGIONS)
+    for account_id in ACCOUNT_IDS:
+        coverage.set_role(account_id, account_id != '333333333333')
+        for region_name in REGIONS:
+            coverage.set_status(account_id, region_name, 'Enabled', True)
+    return coverage
+
+
+def test_statuses_are_matched_case_insensitively():
+    coverage = matrix()
+    coverage.set_status('111111111111', 'us-east-1', 'ENABLED', True)
+    coverage.set_status('222222222222', 'us-east-1', 'invited', False)
+    coverage.set_status(
+        '333333333333', 'us-east-1', 'EMAILVERIFICATIONINPROGRESS', False)
+    assert coverage.get('111111111111', 'us-east-1') == ('Enabled', True)
+    assert coverage.get('222222222222', 'us-east-1') == ('Invited', False)
+    assert coverage.get('333333333333', 'us-east-1') == (
+        'EmailVerificationInProgress', False)
+
+
+def test_unknown_and_missing_statuses():
+    coverage = matrix()
+    coverage.set_status('111111111111', 'us-east-1', 'Pending', False)
+    coverage.set_status('222222222222', 'us-east-1', None, False)
+    assert coverage.get('111111111111', 'us-east-1') == ('Unknown', False)
+    assert coverage.get('222222222222', 'us-east-1') == ('Unknown', False)
+
+
+def test_summary_lists_uncovered_accounts():
+    coverage = matrix()
+    coverage.set_status('222222222222', 'us-west-2', 'NotMember', False)
+    coverage.set_status('333333333333', 'us-east-1', 'Disabled', True)
+    summary = coverage.summary()
+    assert summary['regions'] == {
+        'us-east-1': {'Enabled': 2, 'Disabled': 1},
+        'us-west-2': {'Enabled': 2, 'NotMember': 1}}
+    assert summary['uncovered_accounts'] == ['222222222222', '333333333333']
+    assert summary['accounts_without_role'] == ['333333333333']
+
+
+def test_region_errors_are_left_out_of_the_summary():
+    coverage = matrix()
+    coverage.set_status('111111111111', 'us-west-2', 'Resigned', False)
+    coverage.region_errors['us-west-2'] = 'AccessDenied'
+    summary = coverage.summary()
+    assert list(summary['regions']) == ['us-east-1']
+    assert summary['uncovered_accounts'] == []
+
+
+def test_every_status_has_a_code():
+    assert len(CoverageMatrix.CODES) == len(CoverageMatrix.STATUSES)
+    assert len(set(CoverageMatrix.CODES)) == len(CoverageMatrix.CODES)
+
+
+def test_to_json_and_to_csv():
+    coverage = matrix()
+    coverage.set_status('111111111111', 'us-west-2', 'Created', False)
+    assert coverage.to_json()['accounts']['111111111111'] == {
+        'role': True, 'statuses': 'EC', 'detectors': '10'}
+    rows = list(csv.DictReader(io.StringIO(coverage.to_csv())))
+    assert len(rows) == len(ACCOUNT_IDS) * len(REGIONS)
+    assert rows[1] == {
+        'account_id': '111111111111', 'region': 'us-west-2',
+        'relationship_status': 'Created', 'member_detector': 'False',
+        'role_available': 'True'}
+
+
+def test_list_region_coverage_reads_the_audited_accounts(stub):
+    boto_session = boto3.session.Session()
+    stubber = stub(invitation_manager.get_client(
+        boto_session, 'guardduty', 'us-east-1'))
+    stubber.add_response('list_detectors', {'DetectorIds': ['master']})
+    stubber.add_response('get_members', {'Members': [
+        {'AccountId': '111111111111', 'MasterId': '123456789012',
+         'Email': 'a@example.com', 'RelationshipStatus': 'ENABLED',
+         'DetectorId': 'member', 'UpdatedAt': '2024-01-01T00:00:00Z'},
+        {'AccountId': '222222222222', 'MasterId': '123456789012',
+         'Email': 'b@example.com', 'RelationshipStatus': 'Invited',
+         'UpdatedAt': '2024-01-01T00:00:00Z'}],
+        'UnprocessedAccounts': []},
+        {'DetectorId': 'master', 'AccountIds': ACCOUNT_IDS[:2]})
+
+    assert invitation_manager.list_region_coverage(
+        boto_session, 'us-east-1', ACCOUNT_IDS[:2]) == {
+        '111111111111': ('ENABLED', True),
+        '222222222222': ('Invited', False)}
+
+
+def test_list_region_coverage_without_a_master_detector(stub):
+    boto_session = boto3.session.Session()
+    stubber = stub(invitation_manager.get_client(
+        boto_session, 'guardduty', 'us-east-1'))
+    stubber.add_response('list_detectors', {'DetectorIds': []})
+    assert invitation_manager.list_region_coverage(
+        boto_session, 'us-east-1') is None
@@ -0,0 +1,189 @@
+import json
+import time
+
+import boto3
+import pytest
+from botocore.stub import ANY
+
+from lambda_functions import normalization
+from lambda_functions.normalization import (
+    DynamoDBFindingDedupCache, FindingDedupCache)
+
+from test_normalization import sample
+
+TOPIC_ARN = 'arn:aws:sns:us-west-2:123456789012:output'
+
+
+class Clock:
+    """The time module with a time() which only moves when told to"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def time(self):
+        return self.now
+
+
+def test_updates_within_the_window_are_suppressed():
+    cache = FindingDedupCache(300, 100, 86400)
+    assert cache.check('a', 3, 1000) == (True, 3, None)
+    cache.commit('a', 3, 1000)
+    assert cache.check('a', 5, 1299) == (False, 0, 1000)
+    assert cache.check('a', 8, 1300) == (True, 5, 1000)
+
+
+def test_updates_are_only_recorded_once_delivered():
+    cache = FindingDedupCache(300, 100, 86400)
+    assert cache.check('a', 1, 1000)[0]
+    assert cache.check('a', 1, 1001)[0]
+
+
+def test_findings_are_forgotten_after_the_retention():
+    cache = FindingDedupCache(300, 100, 600)
+    cache.commit('a', 3, 1000)
+    assert cache.check('a', 1, 1600) == (True, 1, None)
+
+
+def test_latest_deferred_update_is_due_once_the_window_closes():
+    cache = FindingDedupCache(300, 100, 86400)
+    cache.defer('a', 1000, 5, 'first')
+    cache.defer('a', 1000, 7, 'latest')
+    assert cache.due(1299) == []
+    assert cache.due(1300) == [('a', 1000, 7, 'latest')]
+    assert cache.due(1301) == []
+
+
+def test_dynamodb_cache_reads_and_records_the_last_update(stub, client):
+    dynamodb = client('dynamodb')
+    stubber = stub(dynamodb)
+    cache = DynamoDBFindingDedupCache(300, 'dedup', 86400, dynamodb, 100)
+    key = {'finding-id': {'S': 'a'}}
+    stubber.add_response('get_item', {'Item': {
+        'finding-id': {'S': 'a'}, 'forwarded': {'N': '1000'},
+        'finding_count': {'N': '3'}, 'expires': {'N': '87400'}}},
+        {'TableName': 'dedup', 'Key': key, 'ConsistentRead': True})
+    stubber.add_response('get_item', {'Item': {
+        'finding-id': {'S': 'a'}, 'forwarded': {'N': '1000'},
+        'finding_count': {'N': '3'}, 'expires': {'N': '87400'}}})
+    stubber.add_response('update_item', {}, {
+        'TableName': 'dedup', 'Key': key,
+        'UpdateExpression': ANY, 'ConditionExpression': (
+            'attribute_not_exists(forwarded) OR forwarded < :window_start'),
+        'ExpressionAttributeValues': {
+            ':now': {'N': '1400'}, ':count': {'N': '10'},
+            ':expires': {'N': '87800'}, ':window_start': {'N': '1100'}}})
+
+    assert cache.check('a', 5, 1100) == (False, 0, 1000)
+    assert cache.check('a', 10, 1400) == (True, 7, 1000)
+    cache.commit('a', 10, 1400)
+
+
+def test_dynamodb_cache_keeps_a_concurrently_recorded_update(stub, client):
+    dynamodb = client('dynamodb')
+    stubber = stub(dynamodb)
+    cache = DynamoDBFindingDedupCache(300, 'dedup', 86400, dynamodb, 100)
+    stubber.add_response('get_item', {})
+    stubber.add_client_error(
+        'update_item', 'ConditionalCheckFailedException',
+        expected_params={'TableName': 'dedup', 'Key': {'finding-id': {'S': 'a'}},
+                         'UpdateExpression': ANY, 'ConditionExpression': ANY,
+                         'ExpressionAttributeValues': ANY})
+
+    assert cache.check('a', 5, 1000) == (True, 5, None)
+    # Another container recorded its delivery first, which starts the window
+    cache.commit('a', 5, 1000)
+
+
+@pytest.fixture
+def output(monkeypatch, stub, client):
+    """Deduplicate with a 300 second window and publish to a stubbed topic,
+    returning the clock, the stubber and the messages of each PublishBatch
+    call"""
+    clock = Clock(1000)
+    monkeypatch.setattr(normalization, 'time', clock)
+    monkeypatch.setattr(normalization, 'SNS_OUTPUT_TOPIC_ARN', TOPIC_ARN)
+    monkeypatch.setattr(normalization, 'SQS_OUTPUT_QUEUE_URL', None)
+    monkeypatch.setattr(normalization, 'ARCHIVE_BACKEND', '')
+    monkeypatch.setattr(normalization, 'DEDUP_WINDOW', 300)
+    monkeypatch.setattr(normalization, 'DEDUP_TABLE_NAME', None)
+    monkeypatch.setattr(normalization, 'DEDUP_CACHE', None)
+    sns = client('sns')
+    monkeypatch.setitem(normalization.CLIENTS, ('sns', None), sns)
+    published = []
+
+    def capture(params, **kwargs):
+        published.append([json.loads(x['Message'])
+                          for x in params['PublishBatchRequestEntries']])
+
+    sns.meta.events.register('provide-client-params.sns.PublishBatch', capture)
+    return clock, stub(sns), published
+
+
+def sqs_record(message_id, count):
+    guardduty_event = sample('Instance')
+    guardduty_event['detail']['service']['count'] = count
+    return {'messageId': message_id, 'eventSource': 'aws:sqs',
+            'body': json.dumps(guardduty_event)}
+
+
+def published_counts(batch):
+    return [(x['details']['finding']['count'],
+             x['details']['finding']['countDelta']) for x in batch]
+
+
+def test_suppressed_update_is_forwarded_after_the_window(output):
+    clock, stubber, published = output
+    stubber.add_response('publish_batch', {'Successful': [], 'Failed': []})
+    assert normalization.handle(
+        {'Records': [sqs_record('1', 10)]}, None) == {'batchItemFailures': []}
+    clock.now = 1100
+    normalization.handle({'Records': [sqs_record('2', 12)]}, None)
+    clock.now = 1200
+    normalization.handle({'Records': [sqs_record('3', 15),
+                                      sqs_record('4', 16)]}, None)
+    clock.now = 1300
+    stubber.add_response('publish_batch', {'Successful': [], 'Failed': []})
+    normalization.handle({'Records': []}, None)
+    clock.now = 1400
+    normalization.handle({'Records': []}, None)
+
+    # Only the latest suppressed update follows once the window closes
+    assert [published_counts(x) for x in published] == [
+        [(10, 10)], [(16, 6)]]
+
+
+def test_undelivered_update_is_not_recorded(output):
+    clock, stubber, published = output
+    stubber.add_response('publish_batch', {'Successful': [], 'Failed': [
+        {'Id': '0', 'Code': 'InternalError', 'SenderFault': False}]})
+    stubber.add_response('publish_batch', {'Successful': [], 'Failed': []})
+    assert normalization.handle({'Records': [sqs_record('1', 10)]}, None) == {
+        'batchItemFailures': [{'itemIdentifier': '1'}]}
+    clock.now = 1010
+    assert normalization.handle({'Records': [sqs_record('1', 10)]}, None) == {
+        'batchItemFailures': []}
+
+    assert [published_counts(x) for x in published] == [
+        [(10, 10)], [(10, 10)]]
+
+
+def test_undelivered_trailing_update_is_retried(output):
+    clock, stubber, published = output
+    stubber.add_response('publish_batch', {'Successful': [], 'Failed': []})
+    normalization.handle({'Records': [sqs_record('1', 10),
+                                      sqs_record('2', 11)]}, None)
+    clock.now = 1300
+    stubber.add_response('publish_batch', {'Successful': [], 'Failed': [
+        {'Id': '0', 'Code': 'InternalError', 'SenderFault': False}]})
+    # The trailing update isn't a record of the batch so it's not reported
+    assert normalization.handle({'Records': []}, None) == {
+        'batchItemFailures': []}
+    clock.now = 1301
+    stubber.add_response('publish_batch', {'Successful': [], 'Failed': []})
+    normalization.handle({'Records': []}, None)
+
+    assert [published_counts(x) for x in published] == [
+        [(10, 10)], [(11, 1)], [(11, 1)]]
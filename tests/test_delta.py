@@ -0,0 +1,100 @@
+import json
+import zlib
+
+import boto3
+
+from lambda_functions import invitation_manager
+from lambda_functions.invitation_manager import (
+    StateStore, get_changed_account_ids, get_delta_account_ids)
+
+ACCOUNT_IDS = {'111111111111', '222222222222', '333333333333'}
+ENABLED = {'members': {x: 'Enabled' for x in ACCOUNT_IDS}, 'updated': 0}
+
+
+def test_changed_account_ids():
+    snapshot = {'account_emails': {'111111111111': 'a', '222222222222': 'b'},
+                'account_roles': {'111111111111': 'r', '222222222222': 'r'}}
+    assert get_changed_account_ids(None, {}, {}) is None
+    assert get_changed_account_ids(
+        snapshot, {'111111111111': 'a', '333333333333': 'c'},
+        {'111111111111': 'x', '333333333333': 'r'}) == {
+        '111111111111', '222222222222', '333333333333'}
+
+
+def test_region_without_recorded_members_is_reconciled_in_full():
+    assert get_delta_account_ids(
+        None, ACCOUNT_IDS, {'111111111111'}) == ACCOUNT_IDS
+
+
+def test_unchanged_region_is_skipped():
+    assert get_delta_account_ids(ENABLED, ACCOUNT_IDS, set()) is None
+
+
+def test_only_the_changed_accounts_are_reconciled():
+    assert get_delta_account_ids(
+        ENABLED, ACCOUNT_IDS | {'444444444444'},
+        {'444444444444'}) == {'444444444444'}
+
+
+def test_removed_account_leaves_nothing_to_reconcile():
+    assert get_delta_account_ids(
+        ENABLED, ACCOUNT_IDS, {'999999999999'}) is None
+
+
+def test_pending_unchanged_account_reconciles_the_region():
+    previous = {'members': dict(ENABLED['members'], **{'333333333333': 'Invited'})}
+    assert get_delta_account_ids(
+        previous, ACCOUNT_IDS, {'111111111111'}) == ACCOUNT_IDS
+
+
+def state_item(value):
+    return {'state-key': {'S': 'members/us-east-1'},
+            'state': {'B': zlib.compress(json.dumps(value).encode('utf-8'))}}
+
+
+def test_delta_reconcile_region_only_creates_changed_accounts(stub):
+    boto_session = boto3.session.Session()
+    state_stubber = stub(invitation_manager.get_client(
+        boto_session, 'dynamodb', 'us-west-2'))
+    guardduty_stubber = stub(invitation_manager.get_client(
+        boto_session, 'guardduty', 'us-east-1'))
+    emails = {x: '{}@example.com'.format(x)
+              for x in ACCOUNT_IDS | {'444444444444'}}
+    roles = {x: 'arn:aws:iam::{}:role/member'.format(x) for x in emails}
+    state_stubber.add_response(
+        'get_item', {'Item': state_item(ENABLED)},
+        {'TableName': 'state', 'Key': {'state-key': {'S': 'members/us-east-1'}},
+         'ConsistentRead': True})
+    guardduty_stubber.add_response('list_detectors', {'DetectorIds': ['master']})
+    guardduty_stubber.add_response('list_members', {'Members': [
+        {'AccountId': x, 'MasterId': '123456789012', 'Email': emails[x],
+         'RelationshipStatus': 'Enabled', 'UpdatedAt': '2024-01-01T00:00:00Z'}
+        for x in sorted(ACCOUNT_IDS)]})
+    guardduty_stubber.add_response(
+        'create_members', {'UnprocessedAccounts': []},
+        {'DetectorId': 'master', 'AccountDetails': [
+            {'AccountId': '444444444444', 'Email': '444444444444@example.com'}]})
+    state_stubber.add_response('put_item', {})
+
+    summary = invitation_manager.reconcile_region(
+        boto_session, 'us-east-1', '123456789012', emails, roles,
+        StateStore(boto_session, 'state', 'us-west-2'), delta=True,
+        region_wide=False, changed_account_ids={'444444444444'})
+
+    assert summary['created'] == ['444444444444']
+    assert summary['changed_accounts'] == ['444444444444']
+
+
+def test_delta_reconcile_region_skips_unchanged_region(stub):
+    boto_session = boto3.session.Session()
+    state_stubber = stub(invitation_manager.get_client(
+        boto_session, 'dynamodb', 'us-west-2'))
+    emails = {x: '{}@example.com'.format(x) for x in ACCOUNT_IDS}
+    roles = {x: 'arn:aws:iam::{}:role/member'.format(x) for x in emails}
+    state_stubber.add_response('get_item', {'Item': state_item(ENABLED)})
+
+    summary = invitation_manager.reconcile_region(
+        boto_session, 'us-east-1', '123456789012', emails, roles,
+        StateStore(boto_session, 'state', 'us-west-2'), delta=True)
+
+    assert summary['skipped']
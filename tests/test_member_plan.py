@@ -0,0 +1,126 @@
+import boto3
+from botocore.stub import ANY
+
+from lambda_functions import invitation_manager
+from lambda_functions.invitation_manager import MemberPlan, chunks
+
+EMAILS = {str(x) * 12: '{}@example.com'.format(x) for x in range(1, 10)}
+
+
+def plan(members, account_ids=EMAILS, region_wide=True):
+    return MemberPlan(members, account_ids, EMAILS, region_wide)
+
+
+def test_accounts_which_are_not_members_are_created():
+    member_plan = plan({'111111111111': 'Enabled'})
+    assert sorted(x['AccountId'] for x in member_plan.create) == sorted(
+        set(EMAILS) - {'111111111111'})
+    assert {'AccountId': '222222222222',
+            'Email': '2@example.com'} in member_plan.create
+
+
+def test_removed_members_are_created_and_get_a_detector():
+    member_plan = plan({'111111111111': 'Removed'}, ['111111111111'])
+    assert member_plan.create == [
+        {'AccountId': '111111111111', 'Email': '1@example.com'}]
+    assert member_plan.ensure_detector == ['111111111111']
+
+
+def test_statuses_are_matched_case_insensitively():
+    member_plan = plan({'111111111111': 'DISABLED', '222222222222': 'invited',
+                        '333333333333': 'EmailVerificationInProgress'})
+    assert member_plan.re_enable == ['111111111111']
+    assert sorted(member_plan.accept) == ['222222222222', '333333333333']
+
+
+def test_region_wide_actions_cover_every_member():
+    members = {'111111111111': 'Created', '222222222222': 'Resigned',
+               '999999999999': 'EmailVerificationFailed',
+               '888888888888': 'Created'}
+    member_plan = plan(members, ['111111111111', '222222222222'])
+    assert sorted(member_plan.invite) == [
+        '111111111111', '222222222222', '888888888888']
+    assert member_plan.delete == ['999999999999']
+    # Only the accounts which should be members are accepted
+    assert member_plan.accept == ['222222222222']
+
+
+def test_sharded_plan_skips_region_wide_actions():
+    members = {'111111111111': 'Created', '999999999999': 'EmailVerificationFailed'}
+    member_plan = plan(members, ['111111111111'], region_wide=False)
+    assert member_plan.invite == []
+    assert member_plan.delete == []
+
+
+def test_enabled_members_need_no_action():
+    member_plan = plan({x: 'Enabled' for x in EMAILS})
+    assert member_plan.create == []
+    assert member_plan.member_actions() == {}
+
+
+def test_member_actions_are_grouped_by_account():
+    member_plan = plan({'111111111111': 'Removed', '222222222222': 'Disabled',
+                        '333333333333': 'Invited'},
+                       ['111111111111', '222222222222', '333333333333'])
+    assert member_plan.member_actions() == {
+        '111111111111': ['ensure_detector'],
+        '222222222222': ['re_enable'],
+        '333333333333': ['accept']}
+
+
+def test_chunks():
+    assert list(chunks(list(range(120)), 50)) == [
+        list(range(50)), list(range(50, 100)), list(range(100, 120))]
+    assert list(chunks([])) == []
+
+
+def test_reconcile_region_creates_and_invites_in_batches(stub):
+    boto_session = boto3.session.Session()
+    client = invitation_manager.get_client(boto_session, 'guardduty', 'us-east-1')
+    stubber = stub(client)
+    emails = {'{:012d}'.format(x): '{}@example.com'.format(x) for x in range(120)}
+    roles = {x: 'arn:aws:iam::{}:role/member'.format(x) for x in emails}
+    stubber.add_response('list_detectors', {'DetectorIds': ['master']})
+    stubber.add_response(
+        'list_members',
+        {'Members': [{'AccountId': '999999999999', 'MasterId': '123456789012',
+                      'Email': '9@example.com', 'RelationshipStatus': 'Created',
+                      'UpdatedAt': '2024-01-01T00:00:00Z'}]},
+        {'DetectorId': 'master', 'OnlyAssociated': 'FALSE'})
+    for _ in range(3):
+        stubber.add_response(
+            'create_members', {'UnprocessedAccounts': []},
+            {'DetectorId': 'master', 'AccountDetails': ANY})
+    stubber.add_response(
+        'invite_members', {'UnprocessedAccounts': []},
+        {'DetectorId': 'master', 'AccountIds': ['999999999999'],
+         'DisableEmailNotification': True})
+
+    summary = invitation_manager.reconcile_region(
+        boto_session, 'us-east-1', '123456789012', emails, roles)
+
+    assert sorted(summary['created']) == sorted(emails)
+    assert summary['invited'] == ['999999999999']
+    assert summary['failed'] == {}
+
+
+def test_onboarding_an_enabled_member_makes_no_member_calls(monkeypatch, stub):
+    boto_session = boto3.session.Session()
+    client = invitation_manager.get_client(boto_session, 'guardduty', 'us-east-1')
+    stubber = stub(client)
+    stubber.add_response('list_detectors', {'DetectorIds': ['master']})
+    stubber.add_response(
+        'get_members',
+        {'Members': [{'AccountId': '111111111111', 'MasterId': '123456789012',
+                      'Email': '1@example.com', 'RelationshipStatus': 'Enabled',
+                      'UpdatedAt': '2024-01-01T00:00:00Z'}],
+         'UnprocessedAccounts': []},
+        {'DetectorId': 'master', 'AccountIds': ['111111111111']})
+
+    def get_member_session(role_arn):
+        raise AssertionError('Assumed the role of {}'.format(role_arn))
+
+    monkeypatch.setattr(invitation_manager, 'get_member_session', get_member_session)
+    assert invitation_manager.onboard_member(
+        boto_session, 'us-east-1', '123456789012', '111111111111',
+        '1@example.com', 'arn:aws:iam::111111111111:role/member') == []
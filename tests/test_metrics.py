@@ -0,0 +1,33 @@
+import time
+
+from botocore.awsrequest import AWSResponse
+
+from lambda_functions import invitation_manager
+
+
+class Body:
+    def __init__(self, content):
+        self.content = content
+
+    def stream(self):
+        yield self.content
+
+
+def test_calls_blocked_before_sending_are_waits(client):
+    metrics = invitation_manager.Metrics('')
+    guardduty = client('guardduty')
+    metrics.attach(guardduty, '123456789012')
+
+    def rate_limit(**kwargs):
+        time.sleep(0.05)
+
+    def send(request, **kwargs):
+        return AWSResponse(request.url, 200, {}, Body(b'{"detectorIds": []}'))
+
+    guardduty.meta.events.register('before-send', rate_limit)
+    guardduty.meta.events.register('before-send', send)
+    assert guardduty.list_detectors()['DetectorIds'] == []
+    total = metrics.summary()['api']['total']
+    assert total['count'] == 1
+    assert 50 <= total['wait'] <= total['time']
+    assert metrics.emit()['ApiWaitTime'] == total['wait']
@@ -0,0 +1,122 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+from lambda_functions import normalization
+
+SAMPLES_PATH = os.path.join(
+    os.path.dirname(__file__), '..', 'benchmarks', 'samples',
+    'guardduty_findings.json')
+
+
+def sample(resource_type):
+    """Return a fresh copy of the sample finding of a resource type"""
+    with open(SAMPLES_PATH) as f:
+        return next(x for x in json.load(f)
+                    if x['detail']['resource']['resourceType'] == resource_type)
+
+
+def sns_record(guardduty_event, timestamp='2021-07-19T16:45:12.345Z'):
+    return {'Sns': {'MessageId': 'message', 'Timestamp': timestamp,
+                    'Message': json.dumps(guardduty_event)}}
+
+
+def test_convert_my_iso_8601():
+    assert normalization.convert_my_iso_8601(
+        '2018-04-06T15:57:25.123Z') == '2018-04-06 15:57:25.123000'
+    assert normalization.convert_my_iso_8601(
+        '2018-04-06T15:57:25Z') == '2018-04-06 15:57:25'
+
+
+@pytest.mark.parametrize('iso_8601', [
+    '2018-04-06T15:57:25.1Z', '2018-04-06T15:57:25.123456Z',
+    '2018-4-06T15:57:25Z', '2018-04-06T15:57:25.Z', '2018-04-06T15:57:+5Z',
+    '2018-02-30T15:57:25Z', '2018-04-06T15:57:25.1234567Z'])
+def test_parse_iso_8601_matches_strptime(iso_8601):
+    iso_format = '%Y-%m-%dT%H:%M:%S.%f' if '.' in iso_8601 else '%Y-%m-%dT%H:%M:%S'
+    try:
+        expected = datetime.strptime(iso_8601[:-1], iso_format)
+    except ValueError:
+        with pytest.raises(ValueError):
+            normalization._parse_iso_8601(iso_8601)
+    else:
+        assert normalization._parse_iso_8601(iso_8601) == expected
+
+
+def test_timestamp_to_epoch_ms():
+    assert normalization._timestamp_to_epoch_ms(
+        '2018-04-06T15:57:25.123Z') == 1523030245123
+    assert normalization._timestamp_to_epoch_ms(
+        '1970-01-01T00:00:00Z') == 0
+
+
+def test_timestamps_must_be_utc():
+    with pytest.raises(ValueError):
+        normalization.convert_my_iso_8601('2018-04-06T15:57:25.123+01:00')
+    with pytest.raises(ValueError):
+        normalization.convert_my_iso_8601('2018-04-06 15:57:25Z')
+
+
+def test_mozdef_transform():
+    guardduty_event = sample('Instance')
+    event = normalization.transform_event(sns_record(guardduty_event), 'mozdef')
+    detail = dict(guardduty_event['detail'])
+    detail['finding'] = detail.pop('service')
+    assert event == {
+        'timestamp': '2021-07-19 16:45:12.345000',
+        'hostname': 'i-0a1b2c3d4e5f67890',
+        'processname': 'guardduty',
+        'processid': 1337,
+        'severity': 'INFO',
+        'summary': detail['description'],
+        'category': detail['type'],
+        'source': 'guardduty',
+        'tags': ['PORT_PROBE'],
+        'details': detail}
+
+
+def test_ecs_transform_nests_dotted_keys():
+    guardduty_event = sample('S3Bucket')
+    event = normalization.transform_event(sns_record(guardduty_event), 'ecs')
+    detail = guardduty_event['detail']
+    assert event['@timestamp'] == '2021-07-19T16:45:12.345Z'
+    assert event['event']['id'] == detail['id']
+    assert event['event']['action'] == 'AWS_API_CALL'
+    assert event['cloud'] == {'provider': 'aws', 'account': {
+        'id': detail['accountId']}, 'region': detail['region']}
+    assert event['host']['name'] == (
+        detail['resource']['s3BucketDetails'][0]['name'])
+
+
+def test_ocsf_transform_maps_severity_and_time():
+    guardduty_event = sample('Lambda')
+    event = normalization.transform_event(sns_record(guardduty_event), 'ocsf')
+    assert event['time'] == 1626713112345
+    assert (event['severity'], event['severity_id']) == ('High', 4)
+    assert event['finding_info']['types'] == [guardduty_event['detail']['type']]
+    assert event['resources'] == [{
+        'type': 'Lambda',
+        'uid': guardduty_event['detail']['resource']['lambdaDetails']['functionName']}]
+
+
+def test_resource_without_hostname_uses_the_account():
+    guardduty_event = sample('AccessKey')
+    event = normalization.transform_event(sns_record(guardduty_event))
+    assert event['hostname'] == 'guardduty-123456789012'
+
+
+def test_unknown_spec_is_rejected():
+    with pytest.raises(ValueError):
+        normalization._object_getter({'a.b': ('unknown',)}, 'Instance')
+
+
+def test_fan_in_records_are_timestamped_with_the_event_time():
+    guardduty_event = sample('Instance')
+    record = {'messageId': 'fan-in', 'eventSource': 'aws:sqs',
+              'body': json.dumps(guardduty_event)}
+    assert normalization._get_record_id(record) == 'fan-in'
+    event = normalization.transform_event(record)
+    assert event['timestamp'] == '2021-07-19 16:45:12'
+    assert event['hostname'] == 'i-0a1b2c3d4e5f67890'
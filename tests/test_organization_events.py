@@ -0,0 +1,69 @@
+import boto3
+
+from lambda_functions import invitation_manager
+from lambda_functions.invitation_manager import (
+    StateStore, get_joined_account_id, invalidate_organization_cache)
+
+
+def cloudtrail_event(event_name, **detail):
+    return {'source': 'aws.organizations', 'account': '123456789012',
+            'detail-type': 'AWS Service Event via CloudTrail',
+            'detail': dict(detail, eventName=event_name,
+                           eventSource='organizations.amazonaws.com')}
+
+
+def accept_handshake(action='INVITE', state='ACCEPTED'):
+    return cloudtrail_event(
+        'AcceptHandshake',
+        userIdentity={'accountId': '222222222222'},
+        responseElements={'handshake': {
+            'action': action, 'state': state,
+            'parties': [{'id': 'o-exampleorgid', 'type': 'ORGANIZATION'},
+                        {'id': '222222222222', 'type': 'ACCOUNT'}]}})
+
+
+def test_created_account_joins():
+    event = cloudtrail_event(
+        'CreateAccountResult', serviceEventDetails={'createAccountStatus': {
+            'accountId': '111111111111', 'state': 'SUCCEEDED'}})
+    assert get_joined_account_id(event) == '111111111111'
+
+
+def test_failed_account_creation_is_ignored():
+    event = cloudtrail_event(
+        'CreateAccountResult', serviceEventDetails={'createAccountStatus': {
+            'state': 'FAILED', 'failureReason': 'EMAIL_ALREADY_EXISTS'}})
+    assert get_joined_account_id(event) is None
+
+
+def test_invited_account_joins_when_it_accepts():
+    assert get_joined_account_id(accept_handshake()) == '222222222222'
+
+
+def test_other_handshakes_are_ignored():
+    assert get_joined_account_id(
+        accept_handshake(action='ENABLE_ALL_FEATURES')) is None
+    assert get_joined_account_id(accept_handshake(state='OPEN')) is None
+
+
+def test_removed_account_does_not_join():
+    event = cloudtrail_event('RemoveAccountFromOrganization',
+                             requestParameters={'accountId': '333333333333'})
+    assert get_joined_account_id(event) is None
+
+
+def test_only_account_events_invalidate_the_cache(stub):
+    boto_session = boto3.session.Session()
+    stubber = stub(invitation_manager.get_client(
+        boto_session, 'dynamodb', 'us-west-2'))
+    state_store = StateStore(boto_session, 'state', 'us-west-2')
+    org_arns = ['arn:aws:iam::123456789012:role/org',
+                'arn:aws:iam::999999999999:role/org']
+    stubber.add_response('delete_item', {}, {
+        'TableName': 'state', 'Key': {'state-key': {
+            'S': invitation_manager.organization_cache_key(org_arns[0])}}})
+
+    assert invalidate_organization_cache(
+        cloudtrail_event('DescribeOrganization'), org_arns, state_store) == []
+    assert invalidate_organization_cache(
+        accept_handshake(), org_arns, state_store) == org_arns[:1]
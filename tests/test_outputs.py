@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from lambda_functions import normalization
+
+from test_normalization import sample
+
+TOPIC_ARN = 'arn:aws:sns:us-west-2:123456789012:output'
+QUEUE_URL = 'https://sqs.us-west-2.amazonaws.com/123456789012/output'
+
+
+@pytest.fixture
+def outputs(monkeypatch, stub, client):
+    """Send to a stubbed topic and a stubbed queue"""
+    monkeypatch.setattr(normalization, 'SNS_OUTPUT_TOPIC_ARN', TOPIC_ARN)
+    monkeypatch.setattr(normalization, 'SQS_OUTPUT_QUEUE_URL', QUEUE_URL)
+    monkeypatch.setattr(normalization, 'DEDUP_WINDOW', 0)
+    monkeypatch.setattr(normalization, 'ARCHIVE_BACKEND', '')
+    monkeypatch.setattr(normalization, 'DELIVERED_OUTPUTS',
+                        normalization.OrderedDict())
+    sns, sqs = client('sns'), client('sqs')
+    monkeypatch.setitem(normalization.CLIENTS, ('sns', None), sns)
+    monkeypatch.setitem(normalization.CLIENTS, ('sqs', None), sqs)
+    return stub(sns), stub(sqs)
+
+
+def sns_record(message_id):
+    return {'Sns': {'MessageId': message_id,
+                    'Timestamp': '2021-07-19T16:45:12.345Z',
+                    'Message': json.dumps(sample('Instance'))}}
+
+
+def test_retry_is_only_sent_to_the_failed_output(outputs):
+    sns, sqs = outputs
+    sns.add_response('publish_batch', {'Successful': [], 'Failed': []})
+    sqs.add_response('send_message_batch', {'Successful': [], 'Failed': [
+        {'Id': '0', 'SenderFault': False, 'Code': 'InternalError'}]})
+    with pytest.raises(RuntimeError):
+        normalization.handle({'Records': [sns_record('1')]}, None)
+
+    sqs.add_response('send_message_batch', {'Successful': [], 'Failed': []})
+    assert normalization.handle({'Records': [sns_record('1')]}, None) == {
+        'batchItemFailures': []}
+
+
+def test_records_are_sent_to_every_output(outputs):
+    sns, sqs = outputs
+    for _ in range(2):
+        sns.add_response('publish_batch', {'Successful': [], 'Failed': []})
+        sqs.add_response('send_message_batch', {'Successful': [], 'Failed': []})
+    normalization.handle({'Records': [sns_record('1')]}, None)
+    normalization.handle({'Records': [sns_record('2')]}, None)
+
+
+def test_records_are_not_dropped_without_an_output(monkeypatch):
+    monkeypatch.setattr(normalization, 'SNS_OUTPUT_TOPIC_ARN', None)
+    monkeypatch.setattr(normalization, 'SQS_OUTPUT_QUEUE_URL', None)
+    with pytest.raises(ValueError):
+        normalization.handle({'Records': [sns_record('1')]}, None)
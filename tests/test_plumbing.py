@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from lambda_functions import plumbing
+
+QUEUE_ARN = 'arn:aws:sqs:us-west-2:123456789012:guardduty-fan-in'
+ROLE_ARN = 'arn:aws:iam::123456789012:role/guardduty-fan-in'
+RULE = {'Name': plumbing.RULE_NAME, 'State': 'ENABLED',
+        'Description': plumbing.RULE_DESCRIPTION,
+        'EventPattern': json.dumps(plumbing.EVENT_PATTERN)}
+SNS_STATEMENT = {'Sid': 'eu-west-1-sns-invoke', 'Condition': {'ArnLike': {
+    'AWS:SourceArn': 'arn:aws:sns:eu-west-1:123456789012:mozilla-gd-plumbing'}}}
+
+
+@pytest.fixture
+def fan_in(monkeypatch):
+    monkeypatch.setattr(plumbing, 'PLUMBING_TOPOLOGY', 'fan-in')
+    monkeypatch.setattr(plumbing, 'FAN_IN_QUEUE_ARN', QUEUE_ARN)
+    monkeypatch.setattr(plumbing, 'FAN_IN_ROLE_ARN', ROLE_ARN)
+
+
+def events_stubber(stub, region):
+    return stub(plumbing.get_client(plumbing.get_region_session(region), 'events'))
+
+
+def test_queue_region_targets_the_queue(fan_in):
+    assert plumbing.fan_in_target('us-west-2') == {
+        'Id': plumbing.FAN_IN_TARGET_ID, 'Arn': QUEUE_ARN}
+
+
+def test_other_regions_target_the_queue_region_event_bus(fan_in):
+    assert plumbing.fan_in_target('eu-west-1') == {
+        'Id': plumbing.FAN_IN_TARGET_ID,
+        'Arn': 'arn:aws:events:us-west-2:123456789012:event-bus/default',
+        'RoleArn': ROLE_ARN}
+
+
+def test_reconciled_region_is_left_alone(fan_in, stub):
+    stubber = events_stubber(stub, 'eu-west-1')
+    stubber.add_response('describe_rule', RULE, {'Name': plumbing.RULE_NAME})
+    stubber.add_response('list_targets_by_rule', {
+        'Targets': [plumbing.fan_in_target('eu-west-1')]})
+
+    assert plumbing.timed_reconcile_region('eu-west-1', {})[0] == []
+
+
+def test_sns_plumbing_is_switched_to_fan_in(fan_in, stub):
+    stubber = events_stubber(stub, 'eu-west-1')
+    lambda_stubber = stub(plumbing.get_client(
+        plumbing.get_region_session('us-east-1'), 'lambda'))
+    stubber.add_response('describe_rule', RULE)
+    stubber.add_response('list_targets_by_rule', {'Targets': [{
+        'Id': plumbing.TARGET_ID,
+        'Arn': 'arn:aws:sns:eu-west-1:123456789012:mozilla-gd-plumbing'}]})
+    stubber.add_response('put_targets', {'FailedEntryCount': 0}, {
+        'Rule': plumbing.RULE_NAME,
+        'Targets': [plumbing.fan_in_target('eu-west-1')]})
+    stubber.add_response('remove_targets', {'FailedEntryCount': 0}, {
+        'Rule': plumbing.RULE_NAME, 'Ids': [plumbing.TARGET_ID]})
+    lambda_stubber.add_response('remove_permission', {}, {
+        'FunctionName': plumbing.NORMALIZER_LAMBDA_FUNCTION.split(':')[6],
+        'StatementId': 'eu-west-1-sns-invoke'})
+
+    changes, _ = plumbing.timed_reconcile_region(
+        'eu-west-1', {'eu-west-1-sns-invoke': SNS_STATEMENT})
+
+    assert changes == ['put_targets', 'remove_targets', 'remove_permission']
+
+
+def test_fan_in_needs_the_queue_and_role(monkeypatch):
+    monkeypatch.setattr(plumbing, 'PLUMBING_TOPOLOGY', 'fan-in')
+    monkeypatch.setattr(plumbing, 'FAN_IN_QUEUE_ARN', None)
+    with pytest.raises(ValueError):
+        plumbing.handle({}, None)
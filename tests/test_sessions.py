@@ -0,0 +1,94 @@
+import gc
+import weakref
+from datetime import datetime, timedelta, timezone
+
+from lambda_functions import invitation_manager
+from lambda_functions.invitation_manager import SessionCache
+
+REGIONS = ['us-east-1', 'us-west-2']
+
+
+class Roles:
+    """Create sessions, remembering the roles they were created for"""
+
+    def __init__(self):
+        self.created = []
+
+    def create_session(self, expiration):
+        def create_session(role_arn):
+            self.created.append(role_arn)
+            return object(), expiration
+        return create_session
+
+
+def test_sessions_are_reused_until_they_expire(monkeypatch):
+    cache = SessionCache(refresh_margin=120)
+    roles = Roles()
+    monkeypatch.setattr('time.time', lambda: 1000)
+    session = cache.get('role', roles.create_session(2000))
+    assert cache.get('role', roles.create_session(2000)) is session
+    monkeypatch.setattr('time.time', lambda: 1880)
+    assert cache.get('role', roles.create_session(5000)) is not session
+    assert roles.created == ['role', 'role']
+    assert cache.stats() == {'hits': 1, 'misses': 2}
+
+
+def test_expired_sessions_are_dropped(monkeypatch):
+    cache = SessionCache(refresh_margin=120)
+    roles = Roles()
+    monkeypatch.setattr('time.time', lambda: 1000)
+    for i in range(10):
+        cache.get('role-{}'.format(i), roles.create_session(2000))
+    monkeypatch.setattr('time.time', lambda: 3000)
+    cache.get('role', roles.create_session(5000))
+    assert list(cache.sessions) == ['role']
+    assert list(cache.role_locks) == ['role']
+
+
+def test_least_recently_used_sessions_are_dropped():
+    cache = SessionCache(max_size=3)
+    roles = Roles()
+    for i in range(300):
+        cache.get('role-{}'.format(i % 100), roles.create_session(None))
+        cache.get('role-0', roles.create_session(None))
+    assert len(cache.sessions) == 3
+    assert len(cache.role_locks) <= 3
+    assert 'role-0' in cache.sessions
+    assert 'role-99' in cache.sessions
+
+
+def test_member_clients_stay_bounded(monkeypatch, stub):
+    monkeypatch.setattr(invitation_manager, 'CLIENT_REGISTRY',
+                        invitation_manager.ClientRegistry(8))
+    monkeypatch.setattr(invitation_manager, 'MEMBER_SESSION_CACHE',
+                        SessionCache(max_size=8))
+    stubber = stub(invitation_manager.get_client(None, 'sts'))
+    expiration = datetime.now(timezone.utc) + timedelta(hours=1)
+    local_session = invitation_manager.get_session()
+    for region_name in REGIONS:
+        invitation_manager.get_client(local_session, 'guardduty', region_name)
+    shared = invitation_manager.CLIENT_REGISTRY.size()
+    first_session = None
+    for i in range(40):
+        role_arn = 'arn:aws:iam::{:012d}:role/member'.format(i)
+        stubber.add_response('assume_role', {'Credentials': {
+            'AccessKeyId': 'ASIAEXAMPLE{:08d}'.format(i),
+            'SecretAccessKey': 'secret', 'SessionToken': 'token',
+            'Expiration': expiration}}, {
+            'RoleArn': role_arn,
+            'RoleSessionName': 'GuardDutyMultiAccountManager',
+            'DurationSeconds': 900})
+        member_session = invitation_manager.get_member_session(role_arn)
+        first_session = first_session or weakref.ref(member_session)
+        for region_name in REGIONS:
+            assert invitation_manager.get_client(
+                member_session, 'guardduty', region_name) is (
+                invitation_manager.get_client(
+                    member_session, 'guardduty', region_name))
+    del member_session
+    gc.collect()
+
+    assert invitation_manager.CLIENT_REGISTRY.size() == shared + 8
+    assert len(invitation_manager.MEMBER_SESSION_CACHE.sessions) == 8
+    # The sessions and clients of the earlier members are freed
+    assert first_session() is None
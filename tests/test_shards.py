@@ -0,0 +1,112 @@
+import json
+
+import pytest
+from botocore.stub import ANY
+
+from lambda_functions import invitation_manager
+from lambda_functions.invitation_manager import (
+    SQS_MAX_BATCH_BYTES, message_batches, plan_shards, shard_id)
+
+REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1',
+           'eu-central-1', 'eu-west-1', 'eu-west-2', 'eu-west-3', 'eu-north-1',
+           'ap-south-1', 'ap-northeast-1', 'ap-northeast-2', 'ap-northeast-3',
+           'ap-southeast-1', 'ap-southeast-2', 'sa-east-1']
+
+
+def organization(size):
+    """Return the account maps of an organization with the email addresses
+    and CloudFormation generated role names of a real one"""
+    account_ids = ['{:012d}'.format(104729 * x) for x in range(1, size + 1)]
+    emails = {x: 'aws-accounts+engineering-team-{}@example.com'.format(x)
+              for x in account_ids}
+    roles = {x: 'arn:aws:iam::{}:role/guardduty-member-GuardDutyMember'
+                'AccountIAMRole-1A2B3C4D5E6F7'.format(x)
+             for x in account_ids}
+    return emails, roles
+
+
+@pytest.fixture
+def sqs_dispatch(monkeypatch, stub):
+    """Dispatch shards to a stubbed queue, returning the stubber and the
+    entries of each SendMessageBatch call"""
+    monkeypatch.setattr(invitation_manager, 'SHARD_DISPATCH', 'sqs')
+    monkeypatch.setattr(invitation_manager, 'SHARD_QUEUE_URL',
+                        'https://sqs.us-west-2.amazonaws.com/123456789012/shards')
+    client = invitation_manager.get_client(None, 'sqs')
+    batches = []
+
+    def capture(params, **kwargs):
+        batches.append(params['Entries'])
+
+    client.meta.events.register(
+        'provide-client-params.sqs.SendMessageBatch', capture)
+    yield stub(client), batches
+    client.meta.events.unregister(
+        'provide-client-params.sqs.SendMessageBatch', capture)
+
+
+def test_message_batches_are_limited_by_entries_and_bytes():
+    messages = [(i, 'x' * 1000) for i in range(25)]
+    assert [len(x) for x in message_batches(messages)] == [10, 10, 5]
+    messages = [(i, 'x' * 100000) for i in range(5)]
+    assert [len(x) for x in message_batches(messages)] == [2, 2, 1]
+    assert list(message_batches([])) == []
+
+
+def test_shards_are_sent_in_batches_within_the_size_limit(sqs_dispatch):
+    stubber, batches = sqs_dispatch
+    emails, roles = organization(1200)
+    shards = plan_shards('job', REGIONS, '123456789012', emails, roles)
+    assert len(shards) == 3 * len(REGIONS)
+    # A shard of 500 accounts fits in a message but ten of them are far
+    # larger than a batch, which holds a region's three shards
+    sizes = [len(json.dumps(x).encode('utf-8')) for x in shards]
+    assert 10 * max(sizes) > SQS_MAX_BATCH_BYTES >= max(sizes)
+    for _ in REGIONS:
+        stubber.add_response(
+            'send_message_batch', {'Successful': [], 'Failed': []},
+            {'QueueUrl': invitation_manager.SHARD_QUEUE_URL, 'Entries': ANY})
+
+    results = invitation_manager.dispatch_shards(shards)
+
+    assert results == {shard_id(x): (None, None) for x in shards}
+    assert sorted(json.loads(x['MessageBody'])['region_name']
+                  for batch in batches for x in batch) == sorted(
+        x['region_name'] for x in shards)
+    for batch in batches:
+        assert len(batch) <= 10
+        assert sum(len(x['MessageBody'].encode('utf-8'))
+                   for x in batch) <= SQS_MAX_BATCH_BYTES
+    assert len(batches) == len(REGIONS)
+
+
+def test_failed_entries_are_reported(sqs_dispatch):
+    stubber, batches = sqs_dispatch
+    emails, roles = organization(10)
+    shards = plan_shards('job', REGIONS[:3], '123456789012', emails, roles)
+    stubber.add_response('send_message_batch', {
+        'Successful': [
+            {'Id': '0', 'MessageId': 'a', 'MD5OfMessageBody': 'a'},
+            {'Id': '2', 'MessageId': 'c', 'MD5OfMessageBody': 'c'}],
+        'Failed': [{'Id': '1', 'SenderFault': False,
+                    'Code': 'InternalError', 'Message': 'Try again'}]})
+
+    results = invitation_manager.dispatch_shards(shards)
+
+    assert results[shard_id(shards[0])] == (None, None)
+    assert isinstance(results[shard_id(shards[1])][1], RuntimeError)
+    assert results[shard_id(shards[2])] == (None, None)
+
+
+def test_shard_larger_than_a_message_fails(sqs_dispatch, monkeypatch):
+    stubber, batches = sqs_dispatch
+    monkeypatch.setattr(invitation_manager, 'SHARD_SIZE', 2000)
+    emails, roles = organization(2100)
+    shards = plan_shards('job', ['us-east-1'], '123456789012', emails, roles)
+    stubber.add_response('send_message_batch', {'Successful': [], 'Failed': []})
+
+    results = invitation_manager.dispatch_shards(shards)
+
+    assert isinstance(results[shard_id(shards[0])][1], ValueError)
+    assert results[shard_id(shards[1])] == (None, None)
+    assert [len(x) for x in batches] == [1]